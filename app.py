@@ -1,17 +1,43 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import json
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from pathlib import Path
 import uuid
+import calendar
+import csv
+import io
+import zlib
 import base64
 import jwt
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 
+import storage
+import importer
+import recurrence
+import receipts
+import gemini
+import scanners
+from cache import DocumentCache
+from records import RecordList, transaction_amount
+from scheduler import RecurringScheduler
+
+class JSONProvider(DefaultJSONProvider):
+    """Serialize the indexed record collections of user documents as lists"""
+    @staticmethod
+    def default(o):
+        if isinstance(o, RecordList):
+            return o.to_list()
+        return DefaultJSONProvider.default(o)
+
 app = Flask(__name__, static_folder='static')
-CORS(app)
+app.json = JSONProvider(app)
+CORS(app, expose_headers=['X-Next-Cursor'])
 
 DATA_DIR = Path('./data')
 USERS_FILE = DATA_DIR / 'users.json'
@@ -19,6 +45,55 @@ USERS_FILE = DATA_DIR / 'users.json'
 # Configuration
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
 JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'dev-secret-key-change-this')
+# Storage backend: 'json' (one file per user) or 'sqlite' (one row per record)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', str(DATA_DIR / 'gider.db'))
+# JSON backend: append row changes to a per-user journal instead of rewriting
+# the whole file, folding it back into the file once it exceeds the threshold
+JSON_JOURNAL = os.environ.get('JSON_JOURNAL', '').lower() in ('1', 'true', 'yes')
+JOURNAL_COMPACT_KB = int(os.environ.get('JOURNAL_COMPACT_KB', 1024))
+# Memory budget for parsed user documents kept between requests (0 disables)
+DATA_CACHE_MB = float(os.environ.get('DATA_CACHE_MB', 64))
+# How often the background scheduler looks for due recurring transactions
+RECURRING_INTERVAL_SECONDS = int(os.environ.get('RECURRING_INTERVAL_SECONDS', 3600))
+# Threads the scheduler uses to process users in parallel
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', 4))
+# Receipt scanning: 'gemini', or 'stub' for a canned answer without network
+RECEIPT_MODEL = os.environ.get('RECEIPT_MODEL', 'gemini')
+# Scan jobs: worker threads per process, unfinished jobs allowed, scans each
+# user may start per minute, and how long finished jobs can be polled
+SCAN_WORKERS = int(os.environ.get('SCAN_WORKERS', 2))
+SCAN_QUEUE_SIZE = int(os.environ.get('SCAN_QUEUE_SIZE', 32))
+SCAN_RATE_LIMIT = int(os.environ.get('SCAN_RATE_LIMIT', 10))
+SCAN_JOB_TTL_SECONDS = int(os.environ.get('SCAN_JOB_TTL_SECONDS', 3600))
+# Batch scans: most images per request, and how many are scanned at once
+SCAN_BATCH_MAX = int(os.environ.get('SCAN_BATCH_MAX', 50))
+SCAN_BATCH_CONCURRENCY = int(os.environ.get('SCAN_BATCH_CONCURRENCY', 4))
+# Receipt scanning engine: 'gemini', 'tesseract' (offline OCR) or 'auto'
+# (Gemini when an API key is set and it is not failing, else Tesseract)
+RECEIPT_SCANNER = os.environ.get('RECEIPT_SCANNER', 'gemini').lower()
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 2))
+OCR_LANGUAGES = os.environ.get('OCR_LANGUAGES', 'eng')
+# Receipt images: largest accepted upload, and how they are shrunk before
+# being sent to the model (longest side in pixels, 'jpeg' or 'webp', quality)
+RECEIPT_MAX_UPLOAD_MB = float(os.environ.get('RECEIPT_MAX_UPLOAD_MB', 10))
+RECEIPT_MAX_DIMENSION = int(os.environ.get('RECEIPT_MAX_DIMENSION', 1600))
+RECEIPT_IMAGE_FORMAT = os.environ.get('RECEIPT_IMAGE_FORMAT', 'jpeg').lower()
+RECEIPT_IMAGE_QUALITY = int(os.environ.get('RECEIPT_IMAGE_QUALITY', 80))
+RECEIPT_GRAYSCALE = os.environ.get('RECEIPT_GRAYSCALE', 'true').lower() in ('1', 'true', 'yes')
+# Gemini calls: seconds per attempt, retries of transient errors with
+# exponential backoff from GEMINI_BACKOFF_SECONDS, and the circuit breaker
+# (failures in a row before calls are refused, and for how long)
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get('GEMINI_TIMEOUT_SECONDS', 30))
+GEMINI_RETRIES = int(os.environ.get('GEMINI_RETRIES', 2))
+GEMINI_BACKOFF_SECONDS = float(os.environ.get('GEMINI_BACKOFF_SECONDS', 1))
+GEMINI_BREAKER_FAILURES = int(os.environ.get('GEMINI_BREAKER_FAILURES', 5))
+GEMINI_BREAKER_RESET_SECONDS = int(os.environ.get('GEMINI_BREAKER_RESET_SECONDS', 30))
+# Parsed scan results kept on disk by image hash (0 disables)
+RECEIPT_CACHE_MB = float(os.environ.get('RECEIPT_CACHE_MB', 64))
+RECEIPT_CACHE_TTL_DAYS = float(os.environ.get('RECEIPT_CACHE_TTL_DAYS', 7))
+# Read notifications older than this are purged by the daily maintenance pass
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', 30))
 
 # Default categories with icons
 DEFAULT_CATEGORIES = [
@@ -41,6 +116,15 @@ DEFAULT_CATEGORIES = [
     {'id': '17', 'name': 'Savings', 'icon': 'savings', 'type': 'income'},
     {'id': '18', 'name': 'Other', 'icon': 'other', 'type': 'both'}
 ]
+
+DEFAULT_SETTINGS = {
+    'currency_symbol': '$',
+    'start_date': 1,
+    'theme': 'dark',
+    'gemini_api_key': '',
+    'notifications_enabled': True
+}
+
 def ensure_data_dir():
     """Create data directory if it doesn't exist"""
     DATA_DIR.mkdir(exist_ok=True)
@@ -56,8 +140,10 @@ def load_users():
 
 def save_users(users):
     ensure_data_dir()
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, indent=2)
+    storage.write_json_atomic(USERS_FILE, users, indent=2)
+
+def all_user_ids():
+    return [user['id'] for user in load_users().values()]
 
 def get_user_data_file(user_id):
     return DATA_DIR / f'data_{user_id}.json'
@@ -79,155 +165,153 @@ def login_required(f):
         try:
             data = jwt.decode(token, JWT_SECRET_KEY, algorithms=['HS256'])
             current_user_id = data['user_id']
+            # Download tokens only work as ?token= on the endpoints that take them
+            if 'scope' in data:
+                raise jwt.InvalidTokenError('Scoped token')
         except:
             return jsonify({'error': 'Token is invalid'}), 401
             
         return f(current_user_id, *args, **kwargs)
     return decorated
 
+def download_token_allowed(f):
+    """Like login_required, but also accept a short-lived ``?token=`` issued by
+    /api/download-token, so the browser can save a response straight to disk"""
+    protected = login_required(f)
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = request.args.get('token')
+        if not token or 'Authorization' in request.headers:
+            return protected(*args, **kwargs)
+        try:
+            data = jwt.decode(token, JWT_SECRET_KEY, algorithms=['HS256'])
+            if data.get('scope') != 'download':
+                raise jwt.InvalidTokenError('Not a download token')
+            current_user_id = data['user_id']
+        except Exception:
+            return jsonify({'error': 'Token is invalid'}), 401
+        return f(current_user_id, *args, **kwargs)
+    return decorated
+
+def user_locked(f):
+    """Hold the user's write lock for a whole read-decide-write handler"""
+    @wraps(f)
+    def decorated(user_id, *args, **kwargs):
+        with store.locks.hold(user_id):
+            return f(user_id, *args, **kwargs)
+    return decorated
+
 # --- Data Management ---
 
-def load_data(user_id):
-    """Load data from JSON file for specific user"""
-    ensure_data_dir()
-    user_file = get_user_data_file(user_id)
-    
-    if not user_file.exists():
+def prepare_user_data(data):
+    """Fill in defaults for a new user or migrate an older stored document"""
+    if data is None:
         # Initialize new user data
         return {
             'transactions': [],
             'recurring_transactions': [],
             'categories': DEFAULT_CATEGORIES.copy(),
             'notifications': [],
-            'settings': {
-                'currency_symbol': '$',
-                'start_date': 1,
-                'theme': 'dark',
-                'gemini_api_key': '',
-                'notifications_enabled': True
-            }
+            'settings': DEFAULT_SETTINGS.copy()
         }
     
-    with open(user_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
     # Ensure structure (migrations)
+    data.setdefault('transactions', [])
+    data.setdefault('recurring_transactions', [])
     if not data.get('categories'):
         data['categories'] = DEFAULT_CATEGORIES.copy()
     if 'notifications' not in data:
         data['notifications'] = []
     if 'settings' not in data:
-        data['settings'] = {
-            'currency_symbol': '$',
-            'start_date': 1,
-            'theme': 'dark',
-            'gemini_api_key': '',
-            'notifications_enabled': True
-        }
+        data['settings'] = DEFAULT_SETTINGS.copy()
     else:
         data['settings'].setdefault('notifications_enabled', True)
     
     return data
 
-def save_data(user_id, data):
-    """Save data to JSON file for specific user"""
+store = storage.create_storage(STORAGE_BACKEND, DATA_DIR, prepare_user_data, SQLITE_PATH,
+                               cache=DocumentCache(int(DATA_CACHE_MB * 1024 * 1024)),
+                               journal=JSON_JOURNAL,
+                               compact_bytes=JOURNAL_COMPACT_KB * 1024)
+
+def load_data(user_id):
+    """Load the full data document for specific user.
+
+    The returned document may be shared with other requests through the
+    cache; change data through ``store`` rather than mutating it.
+    """
     ensure_data_dir()
-    user_file = get_user_data_file(user_id)
-    with open(user_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, default=str)
+    return store.load(user_id)
 
+@user_locked
 def process_recurring_transactions(user_id):
     """Check and create transactions for due recurring items"""
     data = load_data(user_id)
     today = datetime.now().date()
     created = []
+    processed = []
     
-    for rt in data['recurring_transactions']:
-        if not rt.get('is_active', True):
+    # The next-due index yields only active rules with an occurrence by today
+    for _, rt in data['recurring_transactions'].iter_sorted(end=today.isoformat()):
+        # Every occurrence since the last run, computed in one go
+        dates = recurrence.rule_for(rt).between(recurrence.last_processed(rt), today)
+        if not dates:
             continue
-            
-        last_processed = rt.get('last_processed')
-        if last_processed:
-            last_date = datetime.fromisoformat(last_processed.replace('Z', '')).date()
-        else:
-            last_date = None
-        
-        next_date = calculate_next_date(rt, last_date)
         
-        while next_date and next_date <= today:
-            # Create transaction
-            transaction = {
-                'id': str(uuid.uuid4()),
-                'name': rt['name'],
-                'amount': rt['amount'],
-                'category': rt['category'],
-                'is_income': rt.get('is_income', False),
-                'date': next_date.isoformat(),
-                'description': f"Recurring: {rt.get('description', '')}",
-                'recurring_id': rt['id']
-            }
-            data['transactions'].append(transaction)
-            created.append(transaction)
-            
-            # Update last processed
-            rt['last_processed'] = next_date.isoformat()
-            last_date = next_date
-            next_date = calculate_next_date(rt, last_date)
+        description = f"Recurring: {rt.get('description', '')}"
+        created.extend({
+            'id': str(uuid.uuid4()),
+            'name': rt['name'],
+            'amount': rt['amount'],
+            'category': rt['category'],
+            'is_income': rt.get('is_income', False),
+            'date': day.isoformat(),
+            'description': description,
+            'recurring_id': rt['id']
+        } for day in dates)
+        # loaded documents are shared, update a copy; a rule stored without a
+        # start date keeps the one it was processed with
+        processed.append(dict(rt, last_processed=dates[-1].isoformat(),
+                              start_date=recurrence.start_date(rt)))
     
     if created:
-        save_data(user_id, data)
+        # The new transactions and the rules' markers are written together,
+        # so a failure cannot leave transactions that would be created again;
+        # inserting records with existing ids replaces them
+        store.apply(user_id, [
+            {'op': 'insert', 'collection': 'transactions', 'records': created},
+            {'op': 'insert', 'collection': 'recurring_transactions', 'records': processed}
+        ])
     
     return created
 
-def calculate_next_date(rt, last_date):
-    """Calculate next occurrence date for recurring transaction"""
-    frequency = rt.get('frequency', 'monthly')
-    start_date = datetime.fromisoformat(rt.get('start_date', datetime.now().isoformat()).replace('Z', '')).date()
-    end_date = rt.get('end_date')
-    if end_date:
-        end_date = datetime.fromisoformat(end_date.replace('Z', '')).date()
-    
-    if last_date is None:
-        next_date = start_date
-    else:
-        if frequency == 'daily':
-            next_date = last_date + timedelta(days=1)
-        elif frequency == 'weekly':
-            next_date = last_date + timedelta(weeks=1)
-        elif frequency == 'biweekly':
-            next_date = last_date + timedelta(weeks=2)
-        elif frequency == 'monthly':
-            # Add one month
-            month = last_date.month + 1
-            year = last_date.year
-            if month > 12:
-                month = 1
-                year += 1
-            day = min(last_date.day, [31, 29 if year % 4 == 0 else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31][month - 1])
-            next_date = last_date.replace(year=year, month=month, day=day)
-        elif frequency == 'yearly':
-            next_date = last_date.replace(year=last_date.year + 1)
-        else:
-            return None
-    
-    if end_date and next_date > end_date:
-        return None
-    
-    return next_date
-
-
-def next_occurrence(rt):
-    """Calculate next occurrence date (date) for a recurring transaction."""
-    last_processed = rt.get('last_processed')
-    last_date = None
-    if last_processed:
-        last_date = datetime.fromisoformat(last_processed.replace('Z', '')).date()
-    return calculate_next_date(rt, last_date)
-
+@user_locked
+def purge_notifications(user_id):
+    """Physically remove soft-deleted notifications and read ones past retention"""
+    cutoff = (datetime.utcnow() - timedelta(days=NOTIFICATION_RETENTION_DAYS)).isoformat()
+    expired = [n.get('id') for n in load_data(user_id)['notifications']
+               if n.get('deleted_at') or (n.get('read') and (n.get('created_at') or '') < cutoff)]
+    if expired:
+        store.delete(user_id, 'notifications', expired)
+    return len(expired)
+
+def daily_maintenance(user_id):
+    """Per-user work the scheduler runs once a day"""
+    process_recurring_transactions(user_id)
+    purge_notifications(user_id)
+    sync_recurring_notifications(user_id)
+
+# Every worker process runs the scheduler thread; the lock and the state
+# file make sure each day's sweep over all users happens in only one of them
+recurring_scheduler = RecurringScheduler(daily_maintenance,
+                                         interval=RECURRING_INTERVAL_SECONDS,
+                                         user_ids=all_user_ids,
+                                         lock=lambda: store.locks.try_hold('scheduler'),
+                                         state_path=DATA_DIR / 'scheduler.json',
+                                         workers=SCHEDULER_WORKERS)
 
 def create_notification(current_user_id, title, body, notification_type='info'):
     """Create an in-app notification for the user."""
-    data = load_data(current_user_id)
     notification = {
         'id': str(uuid.uuid4()),
         'title': title,
@@ -237,46 +321,30 @@ def create_notification(current_user_id, title, body, notification_type='info'):
         'created_at': datetime.utcnow().isoformat(),
         'deleted_at': None
     }
-    data['notifications'].append(notification)
-    save_data(current_user_id, data)
+    store.insert(current_user_id, 'notifications', [notification])
     return notification
 
 
+@user_locked
 def sync_recurring_notifications(current_user_id):
     """Auto-generate notifications for due/upcoming recurring transactions.
     Called daily to create notifications for upcoming transactions."""
-    if not load_data(current_user_id).get('settings', {}).get('notifications_enabled', True):
+    data = load_data(current_user_id)
+    if not data.get('settings', {}).get('notifications_enabled', True):
         return
     
-    data = load_data(current_user_id)
     today = datetime.now().date()
     horizon = today + timedelta(days=7)  # 7-day horizon for notifications
+    created = []
     
-    # Get all active recurring transactions due within 7 days
-    for rt in data.get('recurring_transactions', []):
-        if not rt.get('is_active', True):
-            continue
-        
-        next_date = next_occurrence(rt)
-        if not next_date:
-            continue
-        
-        # Skip if already past
-        if next_date < today:
-            continue
-        
-        # Only create notification if within horizon
-        if next_date > horizon:
-            continue
+    # Get all active recurring transactions due within 7 days, from the
+    # index of next occurrence dates
+    for (next_iso, _), rt in data['recurring_transactions'].iter_sorted(
+            start=today.isoformat(), end=horizon.isoformat()):
+        next_date = date.fromisoformat(next_iso)
         
         # Check if notification already exists for this recurring transaction on this date
-        existing = [n for n in data.get('notifications', []) 
-                   if not n.get('deleted_at') and 
-                   n.get('type') == 'recurring' and
-                   n.get('recurring_id') == rt['id'] and
-                   n.get('notification_date') == next_date.isoformat()]
-        
-        if existing:
+        if data['notifications'].has_key((rt['id'], next_date.isoformat())):
             continue  # Already notified for this date
         
         # Create notification
@@ -306,9 +374,9 @@ def sync_recurring_notifications(current_user_id):
             'created_at': datetime.utcnow().isoformat(),
             'deleted_at': None
         }
-        data['notifications'].append(notification)
+        created.append(notification)
     
-    save_data(current_user_id, data)
+    store.insert(current_user_id, 'notifications', created)
 
 # --- Auth Routes ---
 
@@ -321,16 +389,17 @@ def register():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
         
-    users = load_users()
-    if username in users:
-        return jsonify({'error': 'Username already exists'}), 400
-        
-    user_id = str(uuid.uuid4())
-    users[username] = {
-        'id': user_id,
-        'password': generate_password_hash(password)
-    }
-    save_users(users)
+    with store.locks.hold('users'):
+        users = load_users()
+        if username in users:
+            return jsonify({'error': 'Username already exists'}), 400
+            
+        user_id = str(uuid.uuid4())
+        users[username] = {
+            'id': user_id,
+            'password': generate_password_hash(password)
+        }
+        save_users(users)
     
     # If this is the first user or we want to migrate old data:
     # Check if old data.json exists and not assigned
@@ -382,19 +451,81 @@ def get_current_user(current_user_id):
 
 # --- API Routes ---
 
+TRANSACTION_QUERY_PARAMS = ('limit', 'cursor', 'from', 'to', 'category', 'is_income', 'q', 'sort')
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+def decode_cursor(token):
+    try:
+        value, record_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        return (str(value), str(record_id))
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def query_transactions(transactions, args):
+    """Filter, sort and paginate transactions using the date index.
+
+    Returns the page and the cursor for the next one (None on the last page).
+    """
+    try:
+        limit = int(args.get('limit', MAX_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    sort = args.get('sort', '-date')
+    if sort not in ('date', '-date'):
+        raise ValueError("sort must be 'date' or '-date'")
+    after = decode_cursor(args['cursor']) if args.get('cursor') else None
+    category = args.get('category')
+    is_income = args.get('is_income')
+    if is_income is not None:
+        is_income = is_income.lower() in ('1', 'true', 'yes')
+    term = (args.get('q') or '').strip().lower()
+
+    page = []
+    cursor = None
+    for position, t in transactions.iter_sorted(start=args.get('from') or None,
+                                                 end=args.get('to') or None,
+                                                 after=after, reverse=sort == '-date'):
+        if category and t.get('category') != category:
+            continue
+        if is_income is not None and bool(t.get('is_income', False)) != is_income:
+            continue
+        if term and not any(term in str(t.get(field) or '').lower()
+                            for field in ('name', 'description', 'category')):
+            continue
+        if len(page) == limit:
+            return page, encode_cursor(cursor)
+        page.append(t)
+        cursor = position
+    return page, None
+
 @app.route('/api/transactions', methods=['GET'])
 @login_required
 def get_transactions(current_user_id):
-    """Get all transactions"""
-    process_recurring_transactions(current_user_id)
+    """Get transactions; all of them unless query parameters ask for a page"""
+    # Normally a no-op: the scheduler has already processed today
+    recurring_scheduler.ensure_processed(current_user_id)
     data = load_data(current_user_id)
-    return jsonify(data['transactions'])
+    if not any(param in request.args for param in TRANSACTION_QUERY_PARAMS):
+        return jsonify(data['transactions'])
+    
+    try:
+        page, next_cursor = query_transactions(data['transactions'], request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    response = jsonify(page)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @app.route('/api/transactions', methods=['POST'])
 @login_required
 def create_transaction(current_user_id):
     """Create a new transaction"""
-    data = load_data(current_user_id)
     transaction = request.json
     
     if 'id' not in transaction or not transaction['id']:
@@ -403,33 +534,176 @@ def create_transaction(current_user_id):
     if 'date' not in transaction or not transaction['date']:
         transaction['date'] = datetime.utcnow().isoformat() + 'Z'
     
-    data['transactions'].append(transaction)
-    save_data(current_user_id, data)
+    store.insert(current_user_id, 'transactions', [transaction])
     return jsonify(transaction), 201
 
+# Bulk import: the upload is parsed as a stream and everything that passes
+# validation and de-duplication is stored with a single write.
+
+MAX_IMPORT_ROWS = 100000
+MAX_IMPORT_ERRORS = 100
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+def validate_import(rows, convert):
+    """Split ``(row, raw)`` pairs into ``(row, transaction)`` candidates and errors"""
+    candidates = []
+    errors = []
+    for count, (row, raw) in enumerate(rows, 1):
+        if count > MAX_IMPORT_ROWS:
+            raise importer.InvalidUpload(f'Too many rows (limit {MAX_IMPORT_ROWS})')
+        try:
+            if isinstance(raw, Exception):
+                raise ValueError(f'invalid JSON: {raw}')
+            candidates.append((row, convert(raw)))
+        except ValueError as e:
+            errors.append({'row': row, 'error': str(e)})
+    return candidates, errors
+
+@user_locked
+def commit_import(user_id, candidates, dedupe=True):
+    """Drop rows already stored (same id, or same content unless ``dedupe`` is
+    off) and insert the rest in one write; returns (accepted, duplicates)"""
+    transactions = load_data(user_id)['transactions']
+    stored = {importer.fingerprint(t) for t in transactions} if dedupe else set()
+    seen_ids = set()
+    accepted = []
+    duplicates = []
+    for row, t in candidates:
+        record_id = t.get('id')
+        if record_id and (record_id in transactions or record_id in seen_ids) or \
+                importer.fingerprint(t) in stored:
+            duplicates.append(row)
+            continue
+        if not t.get('id'):
+            t['id'] = str(uuid.uuid4())
+        seen_ids.add(t['id'])
+        accepted.append(t)
+    if accepted:
+        store.insert(user_id, 'transactions', accepted)
+    return accepted, duplicates
+
+def run_import(user_id, rows, convert):
+    try:
+        candidates, errors = validate_import(rows, convert)
+    except (importer.InvalidUpload, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': str(e)}), 400
+    dedupe = request.args.get('dedupe', 'true').lower() not in ('0', 'false', 'no')
+    accepted, duplicates = commit_import(user_id, candidates, dedupe)
+    return jsonify({
+        'accepted': len(accepted),
+        'duplicates': len(duplicates),
+        'rejected': len(errors),
+        'errors': errors[:MAX_IMPORT_ERRORS]
+    })
+
+@app.route('/api/transactions/bulk', methods=['POST'])
+@login_required
+def bulk_create_transactions(current_user_id):
+    """Create many transactions from a JSON array or NDJSON body"""
+    if request.mimetype in NDJSON_MIMETYPES:
+        rows = enumerate(importer.iter_ndjson(request.stream), 1)
+    else:
+        rows = enumerate(importer.iter_json_array(request.stream), 1)
+    return run_import(current_user_id, rows, importer.validate_transaction)
+
+@app.route('/api/import/csv', methods=['POST'])
+@login_required
+def import_csv(current_user_id):
+    """Import transactions from a CSV upload (multipart ``file`` or raw body)"""
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    return run_import(current_user_id, importer.iter_csv(stream), importer.csv_row_to_transaction)
+
+# Export: rows are serialized and sent in batches as they are produced, so
+# neither the server nor the browser holds the whole file at once.
+
+EXPORT_FORMATS = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+EXPORT_COLUMNS = ['ID', 'Name', 'Category', 'Amount', 'Date', 'Type', 'Tags', 'Description']
+EXPORT_BATCH_ROWS = 500
+DOWNLOAD_TOKEN_SECONDS = 60
+
+def export_chunks(transactions, export_format):
+    """Yield the export as text, EXPORT_BATCH_ROWS rows per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    for count, t in enumerate(transactions, 1):
+        if writer:
+            writer.writerow([t.get('id'), t.get('name'), t.get('category'), t.get('amount'),
+                             t.get('date'), 'Income' if t.get('is_income') else 'Expense',
+                             ';'.join(str(tag) for tag in t.get('tags') or []),
+                             t.get('description')])
+        else:
+            buffer.write(json.dumps(t, default=str) + '\n')
+        if count % EXPORT_BATCH_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/api/download-token', methods=['POST'])
+@login_required
+def create_download_token(current_user_id):
+    """Issue a short-lived token for ``?token=`` on download endpoints"""
+    token = jwt.encode({
+        'user_id': current_user_id,
+        'scope': 'download',
+        'exp': datetime.utcnow() + timedelta(seconds=DOWNLOAD_TOKEN_SECONDS)
+    }, JWT_SECRET_KEY, algorithm='HS256')
+    return jsonify({'token': token, 'expires_in': DOWNLOAD_TOKEN_SECONDS})
+
+@app.route('/api/export', methods=['GET'])
+@download_token_allowed
+def export_transactions(current_user_id):
+    """Stream transactions as CSV or NDJSON, oldest first, gzipped if accepted"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': "format must be 'csv' or 'ndjson'"}), 400
+    transactions = load_data(current_user_id)['transactions']
+    # Take the record references now; serializing happens while streaming
+    rows = [t for _, t in transactions.iter_sorted(start=request.args.get('from') or None,
+                                                   end=request.args.get('to') or None)]
+
+    chunks = export_chunks(rows, export_format)
+    headers = {
+        'Content-Disposition': f'attachment; filename="gider_export_'
+                               f'{datetime.now().date().isoformat()}.{export_format}"',
+        'Vary': 'Accept-Encoding'
+    }
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype=EXPORT_FORMATS[export_format], headers=headers)
+
 @app.route('/api/transactions/<transaction_id>', methods=['GET'])
 @login_required
 def get_transaction(current_user_id, transaction_id):
     """Get a specific transaction"""
     data = load_data(current_user_id)
-    for transaction in data['transactions']:
-        if transaction['id'] == transaction_id:
-            return jsonify(transaction)
+    transaction = data['transactions'].get(transaction_id)
+    if transaction:
+        return jsonify(transaction)
     return jsonify({'error': 'Transaction not found'}), 404
 
 @app.route('/api/transactions/<transaction_id>', methods=['PUT'])
 @login_required
 def update_transaction(current_user_id, transaction_id):
     """Update a transaction"""
-    data = load_data(current_user_id)
     updated_transaction = request.json
     updated_transaction['id'] = transaction_id
     
-    for i, transaction in enumerate(data['transactions']):
-        if transaction['id'] == transaction_id:
-            data['transactions'][i] = updated_transaction
-            save_data(current_user_id, data)
-            return jsonify(updated_transaction)
+    if store.replace(current_user_id, 'transactions', updated_transaction):
+        return jsonify(updated_transaction)
     
     return jsonify({'error': 'Transaction not found'}), 404
 
@@ -437,11 +711,140 @@ def update_transaction(current_user_id, transaction_id):
 @login_required
 def delete_transaction(current_user_id, transaction_id):
     """Delete a transaction"""
-    data = load_data(current_user_id)
-    data['transactions'] = [t for t in data['transactions'] if t['id'] != transaction_id]
-    save_data(current_user_id, data)
+    store.delete(current_user_id, 'transactions', [transaction_id])
     return '', 204
 
+BULK_DELETE_FILTERS = ('from', 'to', 'category', 'is_income', 'recurring_id')
+
+def matching_transaction_ids(transactions, criteria):
+    """Ids of the transactions selected by a bulk delete filter"""
+    unknown = set(criteria) - set(BULK_DELETE_FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown filter: {', '.join(sorted(unknown))}")
+    if not criteria:
+        raise ValueError('filter must not be empty; use {"all": true} to delete everything')
+    for bound in ('from', 'to'):
+        value = criteria.get(bound)
+        if value is None:
+            continue
+        try:
+            valid = date.fromisoformat(value).isoformat() == value
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            raise ValueError(f'{bound} must be a date in YYYY-MM-DD format')
+    matches = []
+    for _, t in transactions.iter_sorted(start=criteria.get('from') or None,
+                                         end=criteria.get('to') or None):
+        if 'category' in criteria and t.get('category') != criteria['category']:
+            continue
+        if 'is_income' in criteria and bool(t.get('is_income', False)) != bool(criteria['is_income']):
+            continue
+        if 'recurring_id' in criteria and t.get('recurring_id') != criteria['recurring_id']:
+            continue
+        matches.append(t.get('id'))
+    return matches
+
+@user_locked
+def delete_transactions(user_id, body):
+    """Resolve a bulk delete request to ids and remove them in one storage operation"""
+    transactions = load_data(user_id)['transactions']
+    if body.get('all') is True:
+        ids = [t.get('id') for t in transactions]
+    elif 'ids' in body:
+        if not isinstance(body['ids'], list):
+            raise ValueError('ids must be a list')
+        ids = [str(i) for i in body['ids']]
+    elif isinstance(body.get('filter'), dict):
+        ids = matching_transaction_ids(transactions, body['filter'])
+    else:
+        raise ValueError('Provide "ids", "filter" or "all": true')
+    return store.delete(user_id, 'transactions', ids) if ids else 0
+
+@app.route('/api/transactions/bulk-delete', methods=['POST'])
+@login_required
+def bulk_delete_transactions(current_user_id):
+    """Delete transactions by id list, by filter, or all of them"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    try:
+        deleted = delete_transactions(current_user_id, body)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'deleted': deleted})
+
+def daily_totals(transactions, year, month):
+    """Per-day income and expense sums for one month, read from the date index"""
+    days = calendar.monthrange(year, month)[1]
+    income = [0.0] * days
+    expense = [0.0] * days
+    prefix = f'{year:04d}-{month:02d}'
+    for _, t in transactions.iter_sorted(start=prefix + '-01', end=f'{prefix}-{days:02d}'):
+        try:
+            day = int(str(t.get('date'))[8:10])
+        except ValueError:
+            continue
+        if not 1 <= day <= days:
+            continue
+        target = income if t.get('is_income') else expense
+        target[day - 1] += transaction_amount(t)
+    return {'income': [round(v, 2) for v in income], 'expense': [round(v, 2) for v in expense]}
+
+@app.route('/api/analytics', methods=['GET'])
+@login_required
+def get_analytics(current_user_id):
+    """Yearly and optional monthly totals, read from the stored per-month rollups"""
+    try:
+        year = int(request.args.get('year', datetime.now().year))
+        month = int(request.args['month']) if request.args.get('month') else None
+    except ValueError:
+        return jsonify({'error': 'year and month must be integers'}), 400
+    if not 1 <= year <= 9999 or (month is not None and not 1 <= month <= 12):
+        return jsonify({'error': 'Invalid year or month'}), 400
+
+    recurring_scheduler.ensure_processed(current_user_id)
+    rollups = store.rollups(current_user_id)
+    months = [f'{year:04d}-{m:02d}' for m in range(1, 13)]
+
+    yearly = rollups.summary(months)
+    result = {
+        'year': year,
+        'income': yearly['income'],
+        'expense': yearly['expense'],
+        'balance': yearly['balance'],
+        'count': yearly['count'],
+        'categories': yearly['categories'],
+        'months': []
+    }
+    for m, key in enumerate(months, 1):
+        summary = rollups.summary([key])
+        del summary['categories']
+        result['months'].append(dict(summary, month=m))
+
+    if month is not None:
+        monthly = rollups.summary([months[month - 1]])
+        monthly['month'] = month
+        monthly['daily'] = daily_totals(load_data(current_user_id)['transactions'], year, month)
+        result['month'] = monthly
+    return jsonify(result)
+
+@app.route('/api/analytics/totals', methods=['GET'])
+@login_required
+def get_analytics_totals(current_user_id):
+    """All-time income and expense totals, counts and per-category sums from the rollups"""
+    recurring_scheduler.ensure_processed(current_user_id)
+    totals = {kind: {'total': 0.0, 'count': 0, 'categories': {}} for kind in ('income', 'expense')}
+    for _, category, kind, amount, count in store.rollups(current_user_id).cells():
+        entry = totals[kind]
+        entry['total'] += amount
+        entry['count'] += count
+        entry['categories'][category] = entry['categories'].get(category, 0.0) + amount
+    for entry in totals.values():
+        entry['total'] = round(entry['total'], 2)
+        entry['categories'] = {c: round(v, 2) for c, v in entry['categories'].items()}
+    return jsonify(totals)
+
 @app.route('/api/recurring', methods=['GET'])
 @login_required
 def get_recurring_transactions(current_user_id):
@@ -453,7 +856,6 @@ def get_recurring_transactions(current_user_id):
 @login_required
 def create_recurring_transaction(current_user_id):
     """Create a new recurring transaction"""
-    data = load_data(current_user_id)
     rt = request.json
     
     if 'id' not in rt or not rt['id']:
@@ -462,23 +864,24 @@ def create_recurring_transaction(current_user_id):
     if 'is_active' not in rt:
         rt['is_active'] = True
     
-    data['recurring_transactions'].append(rt)
-    save_data(current_user_id, data)
+    # Without a start date the rule starts today, and stays anchored there
+    if not rt.get('start_date'):
+        rt['start_date'] = datetime.now().date().isoformat()
+    
+    store.insert(current_user_id, 'recurring_transactions', [rt])
+    recurring_scheduler.run_user(current_user_id)
     return jsonify(rt), 201
 
 @app.route('/api/recurring/<transaction_id>', methods=['PUT'])
 @login_required
 def update_recurring_transaction(current_user_id, transaction_id):
     """Update a recurring transaction"""
-    data = load_data(current_user_id)
     updated_rt = request.json
     updated_rt['id'] = transaction_id
     
-    for i, rt in enumerate(data['recurring_transactions']):
-        if rt['id'] == transaction_id:
-            data['recurring_transactions'][i] = updated_rt
-            save_data(current_user_id, data)
-            return jsonify(updated_rt)
+    if store.replace(current_user_id, 'recurring_transactions', updated_rt):
+        recurring_scheduler.run_user(current_user_id)
+        return jsonify(updated_rt)
     
     return jsonify({'error': 'Recurring transaction not found'}), 404
 
@@ -486,9 +889,7 @@ def update_recurring_transaction(current_user_id, transaction_id):
 @login_required
 def delete_recurring_transaction(current_user_id, transaction_id):
     """Delete a recurring transaction"""
-    data = load_data(current_user_id)
-    data['recurring_transactions'] = [rt for rt in data['recurring_transactions'] if rt['id'] != transaction_id]
-    save_data(current_user_id, data)
+    store.delete(current_user_id, 'recurring_transactions', [transaction_id])
     return '', 204
 
 
@@ -503,14 +904,8 @@ def get_recurring_notifications(current_user_id):
     due = []
     upcoming = []
 
-    for rt in data['recurring_transactions']:
-        if not rt.get('is_active', True):
-            continue
-
-        next_date = next_occurrence(rt)
-        if not next_date:
-            continue
-
+    for (next_iso, _), rt in data['recurring_transactions'].iter_sorted(end=horizon.isoformat()):
+        next_date = date.fromisoformat(next_iso)
         payload = {
             'id': rt['id'],
             'name': rt.get('name', 'Recurring'),
@@ -533,6 +928,7 @@ def get_recurring_notifications(current_user_id):
 @login_required
 def get_notifications(current_user_id):
     """Get all non-deleted notifications for the user."""
+    recurring_scheduler.ensure_processed(current_user_id)
     # First, sync recurring notifications for today
     try:
         sync_recurring_notifications(current_user_id)
@@ -561,27 +957,29 @@ def create_test_notification(current_user_id):
 
 @app.route('/api/notifications/<notification_id>/read', methods=['PUT'])
 @login_required
+@user_locked
 def mark_notification_read(current_user_id, notification_id):
     """Mark a notification as read."""
     data = load_data(current_user_id)
-    for notif in data.get('notifications', []):
-        if notif['id'] == notification_id:
-            notif['read'] = True
-            save_data(current_user_id, data)
-            return jsonify(notif)
+    notif = data['notifications'].get(notification_id)
+    if notif:
+        notif = dict(notif, read=True)
+        store.replace(current_user_id, 'notifications', notif)
+        return jsonify(notif)
     return jsonify({'error': 'Notification not found'}), 404
 
 
 @app.route('/api/notifications/<notification_id>', methods=['DELETE'])
 @login_required
+@user_locked
 def delete_notification(current_user_id, notification_id):
     """Delete (soft delete) a notification."""
     data = load_data(current_user_id)
-    for notif in data.get('notifications', []):
-        if notif['id'] == notification_id:
-            notif['deleted_at'] = datetime.utcnow().isoformat()
-            save_data(current_user_id, data)
-            return '', 204
+    notif = data['notifications'].get(notification_id)
+    if notif:
+        notif = dict(notif, deleted_at=datetime.utcnow().isoformat())
+        store.replace(current_user_id, 'notifications', notif)
+        return '', 204
     return jsonify({'error': 'Notification not found'}), 404
 
 # Category routes
@@ -596,7 +994,6 @@ def get_categories(current_user_id):
 @login_required
 def create_category(current_user_id):
     """Create a new category"""
-    data = load_data(current_user_id)
     category = request.json
     
     if 'id' not in category or not category['id']:
@@ -607,23 +1004,18 @@ def create_category(current_user_id):
     if 'type' not in category:
         category['type'] = 'both'
     
-    data['categories'].append(category)
-    save_data(current_user_id, data)
+    store.insert(current_user_id, 'categories', [category])
     return jsonify(category), 201
 
 @app.route('/api/categories/<category_id>', methods=['PUT'])
 @login_required
 def update_category(current_user_id, category_id):
     """Update a category"""
-    data = load_data(current_user_id)
     updated_category = request.json
     updated_category['id'] = category_id
     
-    for i, category in enumerate(data['categories']):
-        if category['id'] == category_id:
-            data['categories'][i] = updated_category
-            save_data(current_user_id, data)
-            return jsonify(updated_category)
+    if store.replace(current_user_id, 'categories', updated_category):
+        return jsonify(updated_category)
     
     return jsonify({'error': 'Category not found'}), 404
 
@@ -631,9 +1023,7 @@ def update_category(current_user_id, category_id):
 @login_required
 def delete_category(current_user_id, category_id):
     """Delete a category"""
-    data = load_data(current_user_id)
-    data['categories'] = [c for c in data['categories'] if c['id'] != category_id]
-    save_data(current_user_id, data)
+    store.delete(current_user_id, 'categories', [category_id])
     return '', 204
 
 @app.route('/api/settings', methods=['GET'])
@@ -645,6 +1035,7 @@ def get_settings(current_user_id):
 
 @app.route('/api/settings', methods=['PUT'])
 @login_required
+@user_locked
 def update_settings(current_user_id):
     """Update settings"""
     data = load_data(current_user_id)
@@ -652,110 +1043,332 @@ def update_settings(current_user_id):
     # Merge to retain unspecified keys
     merged = data.get('settings', {}).copy()
     merged.update(incoming)
-    data['settings'] = merged
-    save_data(current_user_id, data)
-    return jsonify(data['settings'])
+    store.put_settings(current_user_id, merged)
+    return jsonify(merged)
+
+
+@app.route('/api/metrics', methods=['GET'])
+@login_required
+def get_metrics(current_user_id):
+    """Storage and cache counters for monitoring"""
+    return jsonify({
+        'storage': store.name,
+        'cache': store.cache.stats(),
+        'writes': store.write_stats(),
+        'scheduler': recurring_scheduler.stats(),
+        'scan_jobs': scan_jobs.stats(),
+        'receipt_cache': receipt_cache.stats(),
+        'receipt_images': image_pipeline.stats(),
+        'gemini': receipt_models.stats(),
+        'ocr': receipt_scanners['tesseract'].stats()
+    })
 
 
 # Receipt Scanner API
+scan_jobs = receipts.ScanJobs(DATA_DIR / 'scan_jobs', workers=SCAN_WORKERS,
+                              max_pending=SCAN_QUEUE_SIZE, rate_limit=SCAN_RATE_LIMIT,
+                              ttl=SCAN_JOB_TTL_SECONDS)
+
+receipt_cache = receipts.ResultCache(DATA_DIR / 'receipt_cache',
+                                     max_bytes=int(RECEIPT_CACHE_MB * 1024 * 1024),
+                                     ttl=RECEIPT_CACHE_TTL_DAYS * 86400)
+
+image_pipeline = receipts.ImagePipeline(max_dimension=RECEIPT_MAX_DIMENSION,
+                                        image_format=RECEIPT_IMAGE_FORMAT,
+                                        quality=RECEIPT_IMAGE_QUALITY,
+                                        grayscale=RECEIPT_GRAYSCALE)
+
+def receipt_model(api_key):
+    if RECEIPT_MODEL == 'stub':
+        return receipts.StubModel()
+    return gemini.gemini_model(api_key, receipts.MODEL_NAME)
+
+receipt_models = gemini.ModelPool(receipt_model, timeout=GEMINI_TIMEOUT_SECONDS,
+                                  retries=GEMINI_RETRIES, backoff=GEMINI_BACKOFF_SECONDS,
+                                  breaker=gemini.CircuitBreaker(GEMINI_BREAKER_FAILURES,
+                                                                GEMINI_BREAKER_RESET_SECONDS))
+
+receipt_scanners = {
+    'gemini': scanners.GeminiScanner(receipt_models),
+    'tesseract': scanners.TesseractScanner(OCR_WORKERS, OCR_LANGUAGES)
+}
+
+def receipt_scanner(api_key):
+    """The engine to scan with per RECEIPT_SCANNER, or None if none can run"""
+    if RECEIPT_SCANNER == 'tesseract':
+        return receipt_scanners['tesseract']
+    if RECEIPT_SCANNER == 'auto':
+        for scanner in receipt_scanners.values():
+            if scanner.available(api_key):
+                return scanner
+    return receipt_scanners['gemini'] if api_key is not None else None
+
+def receipt_context(current_user_id):
+    """``(api_key, categories)`` for scanning; the key is None if not configured"""
+    data = load_data(current_user_id)
+    # Get API key from settings or environment
+    api_key = data['settings'].get('gemini_api_key') or GEMINI_API_KEY
+    if not api_key and RECEIPT_MODEL != 'stub':
+        api_key = None
+    return api_key, list(data['categories'])
+
+def read_receipt_upload(current_user_id):
+    """Read the posted image and find the user's API key and categories.
+
+    The image can be a multipart ``image`` field, a raw ``image/*`` body or
+    base64 in a JSON ``image`` field. Returns ``(scan_args, None)`` or
+    ``(None, error_response)``.
+    """
+    api_key, categories = receipt_context(current_user_id)
+    if receipt_scanner(api_key) is None:
+        return None, (jsonify({'error': 'Gemini API key not configured. Please add it in Settings.'}), 400)
+
+    max_bytes = int(RECEIPT_MAX_UPLOAD_MB * 1024 * 1024)
+    # base64 in JSON is a third larger than the image itself
+    limit = max_bytes * 4 // 3 if request.is_json else max_bytes
+    if (request.content_length or 0) > limit + 64 * 1024:
+        return None, (jsonify({'error': f'Image is larger than {RECEIPT_MAX_UPLOAD_MB:g} MB'}), 413)
+    try:
+        if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+            upload = receipts.spool_stream(request.stream, max_bytes)
+        elif request.mimetype == 'multipart/form-data':
+            if 'image' not in request.files:
+                return None, (jsonify({'error': 'No image provided'}), 400)
+            # Copied: the form's own temp file is closed when the request
+            # ends, before a queued scan gets to it
+            upload = receipts.spool_stream(request.files['image'].stream, max_bytes)
+        else:
+            body = request.get_json(silent=True) or {}
+            if not isinstance(body.get('image'), str):
+                return None, (jsonify({'error': 'No image provided'}), 400)
+            upload = receipts.decode_base64(body['image'], max_bytes)
+    except receipts.UploadTooLarge as e:
+        return None, (jsonify({'error': str(e)}), 413)
+    except ValueError as e:
+        return None, (jsonify({'error': str(e)}), 400)
+    return (api_key, upload, categories), None
+
+def run_scan(api_key, upload, categories):
+    """Scan result for the uploaded image file, from the cache when the same
+    image was scanned before by the same engine with the same categories"""
+    with upload:
+        scanner = receipt_scanner(api_key) or receipt_scanners['gemini']
+        key = receipt_cache.key(upload, scanner.name, RECEIPT_MODEL, receipts.MODEL_NAME,
+                                image_pipeline.signature(), receipts.build_prompt(categories))
+        result = receipt_cache.get(key)
+        if result is None:
+            image = image_pipeline.prepare(upload)
+            result = scanner.scan(image, categories, api_key)
+            receipt_cache.put(key, result)
+    return result
+
 @app.route('/api/scan-receipt', methods=['POST'])
 @login_required
 def scan_receipt(current_user_id):
-    """Scan receipt image using Google Gemini API"""
+    """Scan a receipt image with the configured engine"""
     try:
-        import google.generativeai as genai
-        from PIL import Image
-        import io
-        
-        # Get API key from settings or environment
-        data = load_data(current_user_id)
-        api_key = data['settings'].get('gemini_api_key') or GEMINI_API_KEY
-        
-        if not api_key:
-            return jsonify({'error': 'Gemini API key not configured. Please add it in Settings.'}), 400
-        
-        # Get image data from request
-        if 'image' not in request.json:
-            return jsonify({'error': 'No image provided'}), 400
-        
-        image_data = request.json['image']
-        
-        # Remove data URL prefix if present
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Configure Gemini
-        genai.configure(api_key=api_key)
-        
-        # Get available categories for context
-        categories = data['categories']
-        expense_categories = [c['name'] for c in categories if c['type'] in ['expense', 'both']]
-        
-        # Simple prompt to extract key receipt info
-        prompt = f"""Analyze this receipt image and extract the key information in JSON format:
-{{
-    "store_name": "Name of the store/merchant",
-    "subtotal": "Subtotal/price before tax as a number (e.g., 23.50)",
-    "tax": "Tax amount as a number (e.g., 2.49)",
-    "total": "Total/Grand total amount as a number (e.g., 25.99)",
-    "date": "Date in YYYY-MM-DD format if visible, otherwise null",
-    "category": "Best matching category from: {', '.join(expense_categories)}"
-}}
-
-RULES:
-1. The "total" should be the FINAL/GRAND TOTAL amount (subtotal + tax)
-2. "subtotal" is the price before tax
-3. "tax" is the tax amount (VAT, sales tax, MwSt, etc.)
-4. If tax is not visible, calculate: tax = total - subtotal
-5. If information is unclear or not visible, use null
-6. Return ONLY valid JSON, no markdown or extra text"""
-        
-        # Use Gemini 2.0 Flash model
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
-        response = model.generate_content([prompt, image])
-        
-        # Parse response
-        response_text = response.text.strip()
-        
-        # Extract JSON from response (handle markdown code blocks)
-        if '```json' in response_text:
-            response_text = response_text.split('```json')[1].split('```')[0].strip()
-        elif '```' in response_text:
-            response_text = response_text.split('```')[1].split('```')[0].strip()
-        
-        result = json.loads(response_text)
-        
-        # Parse numeric values
-        total = float(result.get('total', 0)) if result.get('total') else 0
-        subtotal = float(result.get('subtotal', 0)) if result.get('subtotal') else None
-        tax = float(result.get('tax', 0)) if result.get('tax') else None
-        
-        # Calculate missing values if possible
-        if total and subtotal and not tax:
-            tax = round(total - subtotal, 2)
-        elif total and tax and not subtotal:
-            subtotal = round(total - tax, 2)
-        
-        return jsonify({
-            'success': True,
-            'data': {
-                'store_name': result.get('store_name') or 'Unknown Store',
-                'subtotal': subtotal,
-                'tax': tax,
-                'total': total,
-                'date': result.get('date'),
-                'category': result.get('category', 'Other')
-            }
-        })
-        
-    except json.JSONDecodeError as e:
-        return jsonify({'error': f'Failed to parse receipt data: {str(e)}'}), 400
+        args, error = read_receipt_upload(current_user_id)
+        if error:
+            return error
+        return jsonify({'success': True, 'data': run_scan(*args)})
+    except (json.JSONDecodeError, receipts.InvalidImage) as e:
+        return jsonify({'error': receipts.describe_error(e)}), 400
+    except gemini.CircuitOpen as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(GEMINI_BREAKER_RESET_SECONDS)}
     except Exception as e:
-        return jsonify({'error': f'Failed to scan receipt: {str(e)}'}), 500
+        return jsonify({'error': receipts.describe_error(e)}), 500
+
+@app.route('/api/scan-receipt/jobs', methods=['POST'])
+@login_required
+def create_scan_job(current_user_id):
+    """Queue a receipt scan and return its job id right away"""
+    args, error = read_receipt_upload(current_user_id)
+    if error:
+        return error
+    try:
+        job = scan_jobs.submit(current_user_id, run_scan, *args)
+    except receipts.RateLimited as e:
+        args[1].close()
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    except receipts.QueueFull as e:
+        args[1].close()
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    except BaseException:
+        # Not queued, so no scan will close the spooled upload
+        args[1].close()
+        raise
+    job.pop('user_id')
+    return jsonify(job), 202, {'Location': f"/api/scan-receipt/jobs/{job['id']}"}
+
+@app.route('/api/scan-receipt/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_scan_job(current_user_id, job_id):
+    """Status of a scan job, with its result once ``status`` is ``done``"""
+    job = scan_jobs.get(current_user_id, job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job.pop('user_id')
+    return jsonify(job)
+
+def read_receipt_batch():
+    """``[(name, upload or error message)]`` for the posted images: multipart
+    ``images`` fields, or a JSON ``images`` array of base64 strings.
+
+    Raises UploadTooLarge, before parsing anything, for a body larger than
+    SCAN_BATCH_MAX images of the maximum size.
+    """
+    max_bytes = int(RECEIPT_MAX_UPLOAD_MB * 1024 * 1024)
+    # base64 in JSON is a third larger than the images themselves
+    limit = SCAN_BATCH_MAX * (max_bytes * 4 // 3 if request.is_json else max_bytes) + 64 * 1024
+    too_large = receipts.UploadTooLarge(
+        f'A batch is limited to {SCAN_BATCH_MAX} images of {RECEIPT_MAX_UPLOAD_MB:g} MB')
+    if (request.content_length or 0) > limit:
+        raise too_large
+    if request.mimetype == 'multipart/form-data':
+        files = request.files.getlist('images') or request.files.getlist('image')
+        sources = [(f.filename or f'image {i + 1}', f.stream) for i, f in enumerate(files)]
+        read = receipts.spool_stream
+    else:
+        # Read up to the limit also when there is no Content-Length (chunked)
+        chunks = []
+        size = 0
+        if request.is_json:
+            for chunk in iter(lambda: request.stream.read(receipts.CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > limit:
+                    raise too_large
+                chunks.append(chunk)
+        try:
+            body = json.loads(b''.join(chunks)) if chunks else {}
+        except ValueError:
+            body = {}
+        images = body.get('images') if isinstance(body, dict) else None
+        if not isinstance(images, list):
+            images = []
+        sources = [(f'image {i + 1}', image) for i, image in enumerate(images)]
+        read = receipts.decode_base64
+    if len(sources) > SCAN_BATCH_MAX:
+        raise ValueError(f'At most {SCAN_BATCH_MAX} images per batch')
+    uploads = []
+    for name, source in sources:
+        try:
+            if not isinstance(source, str) and read is receipts.decode_base64:
+                raise ValueError('Image is not a base64 string')
+            uploads.append((name, read(source, max_bytes)))
+        except ValueError as e:
+            uploads.append((name, str(e)))
+    return uploads
+
+def receipt_transaction(result):
+    """Expense transaction for a scanned receipt, as the checkout form creates it"""
+    items = result.get('items') or []
+    return importer.validate_transaction({
+        'name': result.get('store_name') or 'Unknown Store',
+        'amount': -abs(result.get('total') or 0),
+        'category': result.get('category') or 'Other',
+        'is_income': False,
+        'date': result.get('date') or date.today().isoformat(),
+        'items': items,
+        'description': f'{len(items)} items from receipt scan' if items else ''
+    })
+
+@app.route('/api/scan-receipt/batch', methods=['POST'])
+@login_required
+def scan_receipt_batch(current_user_id):
+    """Scan several receipts concurrently, streaming one NDJSON line per image
+    as it finishes and a summary line at the end; ``?create=true`` also adds
+    the scanned receipts as transactions in one write"""
+    api_key, categories = receipt_context(current_user_id)
+    if receipt_scanner(api_key) is None:
+        return jsonify({'error': 'Gemini API key not configured. Please add it in Settings.'}), 400
+    create = request.args.get('create', 'false').lower() in ('1', 'true', 'yes')
+    try:
+        uploads = read_receipt_batch()
+    except receipts.UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not uploads:
+        return jsonify({'error': 'No images provided'}), 400
+    images = [index for index, (_, upload) in enumerate(uploads) if not isinstance(upload, str)]
+    try:
+        # Every image counts against the user's scan rate limit and the queue
+        admitted = scan_jobs.reserve(current_user_id, len(images)) if images else 0
+    except (receipts.RateLimited, receipts.QueueFull) as e:
+        for index in images:
+            uploads[index][1].close()
+        if isinstance(e, receipts.RateLimited):
+            return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    waiting = deque(images[:admitted])
+    over_limit = images[admitted:]
+    futures = {}
+
+    def close_unscanned():
+        # run_scan closes the uploads it got to; close the rest and give back
+        # the reservations of images never started
+        unscanned = list(waiting) + over_limit
+        scan_jobs.release(len(waiting))
+        waiting.clear()
+        over_limit.clear()
+        for future, line in futures.items():
+            if future.cancel():
+                unscanned.append(line['index'])
+        futures.clear()
+        for index in unscanned:
+            uploads[index][1].close()
+
+    def lines():
+        scanned = []
+        failed = 0
+        try:
+            for index, (name, upload) in enumerate(uploads):
+                error = upload if isinstance(upload, str) else None
+                if index in over_limit:
+                    error = 'Not scanned: too many receipt scans, try again shortly'
+                if error:
+                    failed += 1
+                    yield json.dumps({'index': index, 'name': name, 'status': 'failed',
+                                      'error': error}) + '\n'
+            while waiting or futures:
+                # At most SCAN_BATCH_CONCURRENCY of the batch on the shared pool
+                while waiting and len(futures) < max(1, SCAN_BATCH_CONCURRENCY):
+                    index = waiting.popleft()
+                    name, upload = uploads[index]
+                    futures[scan_jobs.run(run_scan, api_key, upload, categories)] = \
+                        {'index': index, 'name': name}
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    line = futures.pop(future)
+                    try:
+                        line.update(status='done', result=future.result())
+                        scanned.append((line['index'] + 1, line['result']))
+                    except Exception as e:
+                        failed += 1
+                        line.update(status='failed', error=receipts.describe_error(e))
+                    yield json.dumps(line) + '\n'
+            summary = {'done': len(scanned), 'failed': failed}
+            if create:
+                candidates = []
+                skipped = 0
+                for row, result in sorted(scanned, key=lambda pair: pair[0]):
+                    try:
+                        if not result.get('total'):
+                            raise ValueError('no total')
+                        candidates.append((row, receipt_transaction(result)))
+                    except ValueError:
+                        skipped += 1
+                accepted, duplicates = commit_import(current_user_id, candidates)
+                summary.update(created=len(accepted), duplicates=len(duplicates), skipped=skipped,
+                               transaction_ids=[t['id'] for t in accepted])
+            yield json.dumps({'summary': summary}) + '\n'
+        finally:
+            close_unscanned()
+
+    response = Response(lines(), mimetype='application/x-ndjson')
+    # Also when the response is closed before the first line was sent
+    response.call_on_close(close_unscanned)
+    return response
 
 # Static file serving
 @app.route('/')
@@ -773,6 +1386,38 @@ def serve_static(path):
     # Everything else goes to index.html for client-side routing
     return send_from_directory('static', 'index.html')
 
+# --- Maintenance Commands ---
+
+@app.cli.command('migrate-sqlite')
+def migrate_sqlite_command():
+    """Import every data_*.json file into the SQLite database (one-shot)"""
+    source = storage.JsonStorage(DATA_DIR, prepare_user_data)
+    target = store if isinstance(store, storage.SqliteStorage) else \
+        storage.SqliteStorage(SQLITE_PATH, prepare_user_data)
+    migrated = storage.migrate_json_to_sqlite(source, target)
+    print(f"Migrated {len(migrated)} user(s) into {target.db_path}")
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recount every user's monthly/category totals from their transactions"""
+    user_ids = all_user_ids()
+    for user_id in user_ids:
+        store.rebuild_rollups(user_id)
+    print(f"Rebuilt rollups for {len(user_ids)} user(s)")
+
+@app.cli.command('check-rollups')
+def check_rollups_command():
+    """Compare every user's stored rollups with a recount; exit 1 on mismatch"""
+    failed = 0
+    for user_id in all_user_ids():
+        mismatches = store.check_rollups(user_id)
+        for month, category, kind, stored, expected in mismatches:
+            print(f"{user_id} {month} {category} {kind}: stored {stored}, expected {expected}")
+        failed += bool(mismatches)
+    print(f"{failed} user(s) with inconsistent rollups")
+    if failed:
+        raise SystemExit(1)
+
 # --- Admin User Initialization ---
 
 def initialize_admin_user():
@@ -782,26 +1427,39 @@ def initialize_admin_user():
     
     if admin_username and admin_password:
         print(f"Initializing admin user: {admin_username}")
-        users = load_users()
-        
-        # Check if user exists
-        if admin_username not in users:
-            user_id = str(uuid.uuid4())
-            users[admin_username] = {
-                'id': user_id,
-                'password': generate_password_hash(admin_password)
-            }
-            save_users(users)
-            print(f"Admin user '{admin_username}' created successfully.")
-        else:
-            print(f"Admin user '{admin_username}' already exists. Skipping creation.")
+        with store.locks.hold('users'):
+            users = load_users()
+            
+            # Check if user exists
+            if admin_username not in users:
+                user_id = str(uuid.uuid4())
+                users[admin_username] = {
+                    'id': user_id,
+                    'password': generate_password_hash(admin_password)
+                }
+                save_users(users)
+                print(f"Admin user '{admin_username}' created successfully.")
+            else:
+                print(f"Admin user '{admin_username}' already exists. Skipping creation.")
+
+def run_startup_tasks():
+    """One-time startup work, run by the server process before serving.
+
+    Under gunicorn this is called once from the master (see gunicorn.conf.py)
+    rather than on import, so it does not repeat in every worker.
+    """
+    try:
+        initialize_admin_user()
+    except Exception as e:
+        print(f"Error initializing admin user: {e}")
 
-# Initialize admin user on startup
-try:
-    initialize_admin_user()
-except Exception as e:
-    print(f"Error initializing admin user: {e}")
+def start_background_tasks():
+    """Start background threads; call once in every process serving requests"""
+    recurring_scheduler.start()
 
 if __name__ == '__main__':
+    # Development server; production runs gunicorn with gunicorn.conf.py
+    run_startup_tasks()
+    start_background_tasks()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
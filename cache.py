@@ -0,0 +1,103 @@
+"""In-process LRU cache of parsed per-user data documents."""
+import threading
+from collections import OrderedDict
+
+
+class DocumentCache:
+    """Parsed documents keyed by user id, each tagged with a storage version.
+
+    A cached document is only served while the backend still reports the
+    same version (file mtime/size for JSON, a per-user counter for SQLite),
+    so writes made by other processes are picked up on the next read.
+
+    The memory cap is measured in serialized bytes of the stored documents,
+    which is what the backends can report cheaply; the parsed objects take
+    a few times more.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # user_id -> [version, document, size]
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, user_id, version):
+        """Return the cached document if it is still at ``version``"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or version is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, user_id):
+        """Return (version, document) without touching LRU order or counters"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return (entry[0], entry[1]) if entry else (None, None)
+
+    def put(self, user_id, version, document, size):
+        if not self.enabled or version is None or size > self.max_bytes:
+            self.invalidate(user_id)
+            return
+        with self._lock:
+            old = self._entries.pop(user_id, None)
+            if old:
+                self._bytes -= old[2]
+            self._entries[user_id] = [version, document, size]
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self.evictions += 1
+
+    def retag(self, user_id, old_version, new_version, size_delta=0, document=None):
+        """Move an entry to a new version after an update, replacing the
+        cached document with ``document`` (the updated copy) if given.
+
+        Returns False (and drops the entry) if the cached copy was not at
+        ``old_version``, i.e. the update was not applied on top of the
+        stored state.
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return False
+            if entry[0] != old_version:
+                self._bytes -= entry[2]
+                del self._entries[user_id]
+                return False
+            entry[0] = new_version
+            if document is not None:
+                entry[1] = document
+            entry[2] = max(0, entry[2] + size_delta)
+            self._bytes = max(0, self._bytes + size_delta)
+            return True
+
+    def invalidate(self, user_id):
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry:
+                self._bytes -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,183 @@
+"""Shared Gemini model clients with timeouts, retries and a circuit breaker."""
+import random
+import threading
+import time
+from collections import OrderedDict
+
+# HTTP statuses of upstream errors worth retrying; google.api_core
+# exceptions carry theirs as ``code``
+TRANSIENT_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def is_transient(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, 'code', None) in TRANSIENT_CODES
+
+
+# Key of the process-wide configuration, when the SDK has no per-key clients
+_configured_key = None
+_configure_guard = threading.Lock()
+
+
+def gemini_model(api_key, model_name):
+    """A GenerativeModel with a client of its own for ``api_key``.
+
+    ``genai.configure`` sets the key process-wide, so concurrent scans for
+    users with different keys would race; the model gets a client built
+    from a private client manager instead. That relies on internals of
+    google-generativeai 0.8.3, which requirements.txt pins: on an SDK
+    without them the key is configured process-wide, and a scan with any
+    other key fails with a clear error rather than using the wrong key.
+    """
+    import google.generativeai as genai
+    try:
+        from google.generativeai.client import _ClientManager
+    except ImportError:
+        _ClientManager = None
+    model = genai.GenerativeModel(model_name)
+    if _ClientManager is not None and hasattr(_ClientManager, 'make_client') and \
+            hasattr(model, '_client'):
+        manager = _ClientManager()
+        manager.configure(api_key=api_key)
+        model._client = manager.make_client('generative')
+        return model
+    global _configured_key
+    with _configure_guard:
+        if _configured_key is None:
+            genai.configure(api_key=api_key)
+            _configured_key = api_key
+        elif _configured_key != api_key:
+            raise RuntimeError('This google-generativeai version has no per-key clients, so '
+                               'only one Gemini API key can be used; install the version '
+                               'pinned in requirements.txt')
+    return model
+
+
+class CircuitOpen(Exception):
+    """Calls are refused while the upstream keeps failing"""
+
+
+class CircuitBreaker:
+    """Opens after ``failures`` transient errors in a row and refuses calls
+    for ``reset_timeout`` seconds; then lets one trial call through, which
+    closes it again on success."""
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.threshold = failures
+        self.reset_timeout = reset_timeout
+        self._guard = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        with self._guard:
+            return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self._opened_at is None:
+            return 'closed'
+        if now - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Raise CircuitOpen unless a call may go ahead"""
+        with self._guard:
+            state = self._state(time.monotonic())
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return
+        raise CircuitOpen('Receipt scanning is temporarily unavailable, try again shortly')
+
+    def record(self, ok):
+        """Report the outcome of an allowed call (``ok``: it did not fail
+        because of the upstream)"""
+        with self._guard:
+            self._trial = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+class ModelPool:
+    """One model client per API key, created on first use and reused.
+
+    ``generate`` sends a request with a per-attempt ``timeout``, retries
+    transient errors up to ``retries`` times with exponential backoff and
+    jitter, and goes through ``breaker`` so a degraded upstream fails fast.
+    At most ``max_clients`` keys keep a client; the least recently used one
+    is dropped beyond that.
+    """
+
+    def __init__(self, factory, timeout=30, retries=2, backoff=1.0, max_backoff=8.0,
+                 breaker=None, max_clients=64):
+        # factory(api_key) returns an object with generate_content()
+        self.factory = factory
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.max_clients = max_clients
+        self._models = OrderedDict()
+        self._guard = threading.Lock()
+        self._counts = {'calls': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+
+    def model(self, api_key):
+        with self._guard:
+            model = self._models.get(api_key)
+            if model is not None:
+                self._models.move_to_end(api_key)
+                return model
+        model = self.factory(api_key)
+        with self._guard:
+            model = self._models.setdefault(api_key, model)
+            while len(self._models) > self.max_clients:
+                self._models.popitem(last=False)
+        return model
+
+    def generate(self, api_key, parts):
+        """Text of the model's answer to ``parts``"""
+        model = self.model(api_key)
+        attempt = 0
+        while True:
+            try:
+                self.breaker.allow()
+            except CircuitOpen:
+                self._count('rejected')
+                raise
+            self._count('calls')
+            try:
+                response = model.generate_content(
+                    parts, request_options={'timeout': self.timeout, 'retry': None})
+                text = response.text
+            except Exception as e:
+                transient = is_transient(e)
+                self.breaker.record(not transient)
+                if not transient or attempt >= self.retries:
+                    self._count('failures')
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                attempt += 1
+                self._count('retries')
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                continue
+            self.breaker.record(True)
+            return text
+
+    def _count(self, name):
+        with self._guard:
+            self._counts[name] += 1
+
+    def stats(self):
+        with self._guard:
+            return dict(self._counts, clients=len(self._models), circuit=self.breaker.state)
@@ -0,0 +1,34 @@
+"""Gunicorn settings for the production server.
+
+Run with: gunicorn -c gunicorn.conf.py app:app
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# Worker processes x threads per worker. Storage is safe to share between
+# workers (atomic writes, per-user file locks, version-checked caches).
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_class = 'gthread'
+
+# Receipt scans wait on the Gemini API, allow for slow responses
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    """Run one-time startup tasks once in the master, not in every worker"""
+    from app import run_startup_tasks
+    run_startup_tasks()
+
+
+def post_worker_init(worker):
+    """Start the background threads inside each worker process"""
+    from app import start_background_tasks
+    start_background_tasks()
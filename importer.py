@@ -0,0 +1,183 @@
+"""Streaming parsers and row validation for bulk transaction imports."""
+import codecs
+import csv
+import json
+from datetime import datetime
+
+from records import transaction_amount
+
+CHUNK_SIZE = 64 * 1024
+
+# CSV header aliases, lower-cased; exports from the settings page round-trip
+CSV_COLUMNS = {
+    'id': 'id', 'name': 'name', 'category': 'category', 'amount': 'amount',
+    'date': 'date', 'type': 'type', 'tags': 'tags', 'description': 'description'
+}
+CSV_REQUIRED = ('name', 'category', 'amount', 'date')
+
+
+class InvalidUpload(ValueError):
+    """The upload as a whole cannot be parsed (as opposed to a bad row)"""
+
+
+def iter_ndjson(stream):
+    """Yield one parsed value (or the exception it raised) per non-empty line"""
+    for line in codecs.iterdecode(stream, 'utf-8-sig'):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield e
+
+
+def iter_json_array(stream):
+    """Yield the elements of a top-level JSON array without reading it whole"""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = stream.read(CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[pos:] + text_decoder.decode(chunk or b'', final=eof)
+        pos = 0
+
+    def skip_space():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    fill()
+    skip_space()
+    if buffer[pos:pos + 1] != '[':
+        raise InvalidUpload('Expected a JSON array')
+    pos += 1
+    while True:
+        skip_space()
+        if buffer[pos:pos + 1] == ']':
+            pos += 1
+            # Read to the end: only whitespace may follow the array
+            skip_space()
+            if pos < len(buffer):
+                raise InvalidUpload('Unexpected data after the JSON array')
+            return
+        if started:
+            if buffer[pos:pos + 1] != ',':
+                raise InvalidUpload('Malformed JSON array')
+            pos += 1
+            skip_space()
+        started = True
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise InvalidUpload('Malformed JSON array')
+                fill()
+                continue
+            # A number cut off by the end of the buffer decodes as a shorter
+            # one; only trust a value once the character after it is seen
+            if not eof and (end == len(buffer) or buffer[end] not in ' \t\r\n,]'):
+                fill()
+                continue
+            break
+        pos = end
+        yield value
+
+
+def iter_csv(stream):
+    """Yield ``(line_number, {column: value})`` for each data row of a CSV upload"""
+    text = codecs.iterdecode(stream, 'utf-8-sig')
+    reader = csv.reader(text)
+    header = next(reader, None)
+    if header is None:
+        raise InvalidUpload('CSV file is empty')
+    columns = [CSV_COLUMNS.get(h.strip().lower()) for h in header]
+    missing = [c for c in CSV_REQUIRED if c not in columns]
+    if missing:
+        raise InvalidUpload(f"CSV missing required columns: {', '.join(missing)}")
+    for values in reader:
+        if not any(v.strip() for v in values):
+            continue
+        yield reader.line_num, {c: v.strip() for c, v in zip(columns, values) if c}
+
+
+def parse_date(value):
+    """Validate an ISO date or datetime string; returns it unchanged"""
+    if not isinstance(value, str) or not value:
+        raise ValueError('date is required')
+    try:
+        datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'invalid date: {value!r}')
+    return value
+
+
+def parse_amount(value):
+    if isinstance(value, bool) or value in (None, ''):
+        raise ValueError('amount is required')
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid amount: {value!r}')
+    if amount != amount or amount in (float('inf'), float('-inf')):
+        raise ValueError(f'invalid amount: {value!r}')
+    return amount
+
+
+def validate_transaction(record):
+    """Check a transaction in API form; returns a cleaned copy or raises ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError('expected an object')
+    transaction = dict(record)
+    transaction['amount'] = parse_amount(record.get('amount'))
+    transaction['date'] = parse_date(record.get('date'))
+    transaction['is_income'] = bool(record.get('is_income', False))
+    for field in ('name', 'category', 'description'):
+        if transaction.get(field) is not None and not isinstance(transaction[field], str):
+            raise ValueError(f'{field} must be a string')
+    if not isinstance(transaction.setdefault('tags', []), list):
+        raise ValueError('tags must be a list')
+    if transaction.get('id') is not None:
+        transaction['id'] = str(transaction['id'])
+    return transaction
+
+
+def csv_row_to_transaction(row):
+    """Map a CSV row to API form: the amount's sign decides income vs expense
+    unless a Type column says which it is"""
+    amount = parse_amount(row.get('amount'))
+    kind = (row.get('type') or '').lower()
+    if kind not in ('', 'income', 'expense'):
+        raise ValueError(f"invalid type: {row['type']!r}")
+    transaction = {
+        'name': row.get('name', ''),
+        'category': row.get('category', ''),
+        'amount': abs(amount),
+        'date': row.get('date'),
+        'is_income': kind == 'income' if kind else amount >= 0,
+        'tags': [t for t in (row.get('tags') or '').split(';') if t],
+        'description': row.get('description', '')
+    }
+    if row.get('id'):
+        transaction['id'] = row['id']
+    return validate_transaction(transaction)
+
+
+def fingerprint(transaction):
+    """Identity of a transaction's content, used to drop re-imported rows"""
+    return (str(transaction.get('date') or '')[:10],
+            round(transaction_amount(transaction), 2),
+            bool(transaction.get('is_income')),
+            (transaction.get('name') or '').strip().lower(),
+            (transaction.get('category') or '').strip().lower())
@@ -0,0 +1,570 @@
+"""Receipt scanning: image preparation, model prompt and parsing, result cache
+and background job queue."""
+import base64
+import binascii
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from storage import write_json_atomic
+
+MODEL_NAME = 'gemini-2.0-flash-exp'
+
+PROMPT = """Analyze this receipt image and extract the key information in JSON format:
+{{
+    "store_name": "Name of the store/merchant",
+    "subtotal": "Subtotal/price before tax as a number (e.g., 23.50)",
+    "tax": "Tax amount as a number (e.g., 2.49)",
+    "total": "Total/Grand total amount as a number (e.g., 25.99)",
+    "date": "Date in YYYY-MM-DD format if visible, otherwise null",
+    "items": [
+        {{
+            "name": "Item name",
+            "quantity": 1,
+            "price": 5.99
+        }}
+    ],
+    "category": "Best matching category from: {categories}"
+}}
+
+RULES:
+1. The "total" should be the FINAL/GRAND TOTAL amount (subtotal + tax)
+2. "subtotal" is the price before tax
+3. "tax" is the tax amount (VAT, sales tax, MwSt, etc.)
+4. If tax is not visible, calculate: tax = total - subtotal
+5. If information is unclear or not visible, use null
+6. Return ONLY valid JSON, no markdown or extra text
+7. Extract EVERY line item with name, quantity (assume 1 if not specified) and unit price
+8. GROUP IDENTICAL ITEMS: if the same item appears several times, combine them into
+   a single item with the total quantity and the unit price
+9. Use exact item names as they appear on the receipt - do not modify or abbreviate names"""
+
+
+def build_prompt(categories):
+    expense_categories = [c['name'] for c in categories if c['type'] in ['expense', 'both']]
+    return PROMPT.format(categories=', '.join(expense_categories))
+
+
+# Decoded uploads larger than this are spooled to a temporary file
+SPOOL_BYTES = 1024 * 1024
+# Bytes read at a time when hashing an upload
+CHUNK_SIZE = 64 * 1024
+# Base64 characters decoded at a time, a multiple of 4
+DECODE_CHUNK = 256 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """The image is larger than the configured maximum"""
+
+
+class InvalidImage(ValueError):
+    """The upload is not an image Pillow can read"""
+
+
+def decode_base64(text, max_bytes):
+    """Decode a base64 image (optionally a ``data:`` URL) chunk by chunk into
+    a spooled temporary file, refusing it if it would exceed ``max_bytes``"""
+    start = text.find(',') + 1
+    if max_bytes and (len(text) - start) * 3 // 4 > max_bytes + 2:
+        raise UploadTooLarge(f'Image is larger than {max_bytes / (1024 * 1024):.3g} MB')
+    upload = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    try:
+        for offset in range(start, len(text), DECODE_CHUNK):
+            upload.write(base64.b64decode(text[offset:offset + DECODE_CHUNK]))
+    except binascii.Error:
+        # Line breaks inside the data shift the chunk boundaries
+        upload.seek(0)
+        upload.truncate()
+        try:
+            upload.write(base64.b64decode(''.join(text[start:].split())))
+        except ValueError:
+            upload.close()
+            raise ValueError('Image is not valid base64')
+    except ValueError:
+        upload.close()
+        raise ValueError('Image is not valid base64')
+    upload.seek(0)
+    return upload
+
+
+def spool_stream(stream, max_bytes):
+    """Copy an uploaded binary stream into a spooled temporary file, giving
+    up as soon as it exceeds ``max_bytes``"""
+    upload = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    size = 0
+    try:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise UploadTooLarge(f'Image is larger than {max_bytes / (1024 * 1024):.3g} MB')
+            upload.write(chunk)
+    except BaseException:
+        upload.close()
+        raise
+    upload.seek(0)
+    return upload
+
+
+class ImagePipeline:
+    """Shrinks receipt photos before they are sent to the model.
+
+    Applies the EXIF orientation, optionally converts to grayscale, fits the
+    image within ``max_dimension`` pixels and re-encodes it as JPEG or WebP.
+    JPEGs are decoded at a reduced scale when they are much larger than the
+    target, so full-resolution pixels are never held in memory.
+    """
+
+    FORMATS = {'jpeg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp')}
+
+    def __init__(self, max_dimension=1600, image_format='jpeg', quality=80, grayscale=True):
+        self.max_dimension = max_dimension
+        self.format, self.mime_type = self.FORMATS[image_format]
+        self.quality = quality
+        self.grayscale = grayscale
+        self._guard = threading.Lock()
+        self._counts = {'images': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+    def signature(self):
+        """Settings that change the prepared image, for cache keys"""
+        return (self.max_dimension, self.format, self.quality, self.grayscale)
+
+    def prepare(self, upload):
+        """Prepared image from a binary file, as a ``{mime_type, data}`` blob"""
+        from PIL import Image, ImageOps, UnidentifiedImageError
+        started = time.perf_counter()
+        upload.seek(0, os.SEEK_END)
+        bytes_in = upload.tell()
+        upload.seek(0)
+        try:
+            image = Image.open(upload)
+        except UnidentifiedImageError:
+            raise InvalidImage('Not a supported image file')
+        with image:
+            image.draft('L' if self.grayscale else 'RGB',
+                        (self.max_dimension, self.max_dimension))
+            prepared = ImageOps.exif_transpose(image)
+            prepared = prepared.convert('L' if self.grayscale else 'RGB')
+            prepared.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+        output = io.BytesIO()
+        prepared.save(output, self.format, quality=self.quality, optimize=True)
+        data = output.getvalue()
+        with self._guard:
+            self._counts['images'] += 1
+            self._counts['bytes_in'] += bytes_in
+            self._counts['bytes_out'] += len(data)
+            self._counts['seconds'] += time.perf_counter() - started
+        return {'mime_type': self.mime_type, 'data': data}
+
+    def stats(self):
+        with self._guard:
+            counts = dict(self._counts)
+        images = counts.pop('images')
+        seconds = counts.pop('seconds')
+        return dict(counts, images=images,
+                    bytes_saved=counts['bytes_in'] - counts['bytes_out'],
+                    avg_ms=round(seconds * 1000 / images, 1) if images else None)
+
+
+class StubModel:
+    """Stand-in for the Gemini model that answers every image with the same
+    receipt, for tests and offline development (``RECEIPT_MODEL=stub``).
+
+    ``failures`` is a list of exceptions raised by the first calls, to
+    exercise retries and the circuit breaker; ``delay`` makes every call
+    take that many seconds.
+    """
+
+    class Response:
+        def __init__(self, text):
+            self.text = text
+
+    def __init__(self, result=None, delay=0, failures=()):
+        self.result = result or {
+            'store_name': 'Stub Market', 'subtotal': 9.17, 'tax': 0.83,
+            'total': 10.0, 'date': None, 'category': 'Groceries',
+            'items': [{'name': 'Milk', 'quantity': 2, 'price': 1.25},
+                      {'name': 'Bread', 'quantity': 1, 'price': 2.49},
+                      {'name': 'milk', 'quantity': 1, 'price': 1.25}]
+        }
+        self.delay = delay
+        self.failures = list(failures)
+        self.calls = 0
+
+    def generate_content(self, parts, request_options=None):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.failures:
+            raise self.failures.pop(0)
+        return self.Response(json.dumps(self.result))
+
+
+def parse_response(text):
+    """Receipt fields from the model's answer; raises json.JSONDecodeError"""
+    text = text.strip()
+    # Extract JSON from response (handle markdown code blocks)
+    if '```json' in text:
+        text = text.split('```json')[1].split('```')[0].strip()
+    elif '```' in text:
+        text = text.split('```')[1].split('```')[0].strip()
+
+    return normalize_result(json.loads(text))
+
+
+def normalize_result(result):
+    """The scan result schema from raw extracted fields: numbers parsed,
+    missing subtotal or tax derived from the total, items grouped"""
+    # Parse numeric values
+    total = float(result.get('total', 0)) if result.get('total') else 0
+    subtotal = float(result.get('subtotal', 0)) if result.get('subtotal') else None
+    tax = float(result.get('tax', 0)) if result.get('tax') else None
+
+    # Calculate missing values if possible
+    if total and subtotal and not tax:
+        tax = round(total - subtotal, 2)
+    elif total and tax and not subtotal:
+        subtotal = round(total - tax, 2)
+
+    items = group_items(result.get('items') or [])
+
+    return {
+        'store_name': result.get('store_name') or 'Unknown Store',
+        'subtotal': subtotal,
+        'tax': tax,
+        'total': total,
+        'date': result.get('date'),
+        'category': result.get('category', 'Other'),
+        'items': items,
+        'item_count': len(items)
+    }
+
+
+def group_items(raw_items):
+    """Merge line items with the same name (ignoring case), adding up their
+    quantities and averaging differing unit prices by quantity"""
+    items_dict = {}
+    for item in raw_items:
+        name = (item.get('name') or 'Unknown Item').strip()
+        quantity = int(item.get('quantity', 1)) if item.get('quantity') else 1
+        price = float(item.get('price', 0)) if item.get('price') else 0
+
+        # Normalize name for grouping (case-insensitive, trim whitespace)
+        name_key = name.lower()
+
+        if name_key in items_dict:
+            grouped = items_dict[name_key]
+            grouped['quantity'] += quantity
+            # If prices differ significantly, use the weighted average
+            if abs(grouped['price'] - price) > 0.01:
+                total_qty = grouped['quantity']
+                old_total = grouped['price'] * (total_qty - quantity)
+                grouped['price'] = (old_total + price * quantity) / total_qty
+        else:
+            items_dict[name_key] = {
+                'name': name,  # Keep original casing
+                'quantity': quantity,
+                'price': price
+            }
+    return list(items_dict.values())
+
+
+def scan_image(models, api_key, image, prompt):
+    """Run one prepared receipt image through the ``gemini.ModelPool`` and
+    parse the result"""
+    return parse_response(models.generate(api_key, [prompt, image]))
+
+
+class ResultCache:
+    """Parsed scan results on disk, keyed by a hash of the image bytes.
+
+    One JSON file per result in ``cache_dir``; entries older than ``ttl``
+    seconds are treated as missing, and once the files add up to more than
+    ``max_bytes`` the least recently used ones are deleted. Several worker
+    processes can share the directory.
+    """
+
+    def __init__(self, cache_dir, max_bytes, ttl):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._guard = threading.Lock()
+        self._size = None
+        self._counts = {'hits': 0, 'misses': 0, 'expired': 0, 'stores': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(upload, *context):
+        """Hash of the image file and anything else the result depends on
+        (the model, the prompt with the user's categories)"""
+        digest = hashlib.sha256()
+        for part in context:
+            digest.update(str(part).encode('utf-8') + b'\0')
+        upload.seek(0)
+        for chunk in iter(lambda: upload.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+        upload.seek(0)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """The cached result, or None"""
+        if not self.max_bytes:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._count('misses')
+            return None
+        if time.time() - entry.get('stored_at', 0) > self.ttl:
+            self._discard(path)
+            self._count('expired')
+            self._count('misses')
+            return None
+        try:
+            # The modification time orders entries for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        self._count('hits')
+        return entry['result']
+
+    def put(self, key, result):
+        if not self.max_bytes:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        write_json_atomic(path, {'stored_at': time.time(), 'result': result})
+        size = path.stat().st_size
+        with self._guard:
+            self._counts['stores'] += 1
+            if self._size is None:
+                self._size = self._disk_usage()[0]
+            else:
+                self._size += size
+            if self._size <= self.max_bytes:
+                return
+            self._evict()
+
+    def stats(self):
+        with self._guard:
+            if self._size is None and self.max_bytes:
+                self._size = self._disk_usage()[0]
+            lookups = self._counts['hits'] + self._counts['misses']
+            return dict(self._counts, bytes=self._size, max_bytes=self.max_bytes,
+                        hit_rate=round(self._counts['hits'] / lookups, 3) if lookups else None)
+
+    def _evict(self):
+        # Other processes write here too, so recount before deleting anything
+        total, entries = self._disk_usage()
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            if self._discard(path):
+                total -= size
+                self._counts['evictions'] += 1
+        self._size = total
+
+    def _disk_usage(self):
+        entries = []
+        for path in self.cache_dir.glob('*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sum(e[1] for e in entries), entries
+
+    def _discard(self, path):
+        try:
+            path.unlink()
+            return True
+        except OSError:
+            return False
+
+    def _count(self, name):
+        with self._guard:
+            self._counts[name] += 1
+
+    def _path(self, key):
+        return self.cache_dir / f'{key}.json'
+
+
+class RateLimited(Exception):
+    """The user submitted too many jobs recently"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Too many scans, retry in {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class QueueFull(Exception):
+    """Too many jobs are waiting already"""
+
+
+class ScanJobs:
+    """Receipt scans run on a bounded thread pool instead of request threads.
+
+    Each job is a JSON file in ``job_dir`` that is rewritten as it moves from
+    ``queued`` to ``running`` to ``done`` or ``failed``, so a poll can be
+    answered by any worker process, not only the one running the job.
+    Submissions beyond ``max_pending`` unfinished jobs, or beyond
+    ``rate_limit`` per user within ``rate_window`` seconds, are refused.
+    Job files are removed ``ttl`` seconds after they were last written.
+
+    Batch scans reserve their images against the same limits with
+    ``reserve`` and run them on the same pool with ``run``, without job files.
+    """
+
+    def __init__(self, job_dir, workers=2, max_pending=32, rate_limit=10, rate_window=60,
+                 ttl=3600):
+        self.job_dir = Path(job_dir)
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.ttl = ttl
+        self._pool = None
+        self._guard = threading.Lock()
+        self._pending = 0
+        self._recent = {}
+        self._last_purge = 0.0
+        self._counts = {'submitted': 0, 'done': 0, 'failed': 0,
+                        'rate_limited': 0, 'queue_full': 0}
+
+    def reserve(self, user_id, count=1):
+        """Admit up to ``count`` of the user's scans, as far as the rate limit
+        and the queue allow; returns how many, or raises RateLimited /
+        QueueFull if none. Each admitted scan must be passed to ``run`` or
+        given back with ``release``."""
+        now = time.time()
+        with self._guard:
+            recent = self._recent.setdefault(user_id, deque())
+            while recent and recent[0] <= now - self.rate_window:
+                recent.popleft()
+            allowed = min(count, self.rate_limit - len(recent)) if self.rate_limit else count
+            if allowed <= 0:
+                self._counts['rate_limited'] += 1
+                raise RateLimited(max(1, int(recent[0] + self.rate_window - now + 1)))
+            allowed = min(allowed, self.max_pending - self._pending)
+            if allowed <= 0:
+                self._counts['queue_full'] += 1
+                raise QueueFull('Too many receipt scans in progress, try again shortly')
+            recent.extend([now] * allowed)
+            self._pending += allowed
+            self._counts['submitted'] += allowed
+            if self._pool is None:
+                # Created on first use: the app module is imported in the
+                # gunicorn master, and threads do not survive the fork
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='receipt-scan')
+        return allowed
+
+    def release(self, count):
+        """Give back reserved scans that will not be run"""
+        with self._guard:
+            self._pending -= count
+
+    def run(self, fn, *args):
+        """Run a reserved scan ``fn(*args)`` on the pool; returns its Future"""
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        failed = future.cancelled() or future.exception() is not None
+        with self._guard:
+            self._pending -= 1
+            self._counts['failed' if failed else 'done'] += 1
+
+    def submit(self, user_id, fn, *args):
+        """Queue ``fn(*args)``, whose return value becomes the job's result;
+        returns the new job or raises RateLimited / QueueFull"""
+        now = time.time()
+        self.reserve(user_id)
+        job = {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'status': 'queued',
+            'created_at': datetime.utcnow().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+        queued = dict(job)
+        try:
+            self._write(job)
+            self._pool.submit(self._run, job, fn, args)
+        except BaseException:
+            self.release(1)
+            raise
+        self._purge_expired(now)
+        return queued
+
+    def get(self, user_id, job_id):
+        """The user's job, or None if there is no such job"""
+        try:
+            uuid.UUID(job_id)
+            with open(self._path(job_id), 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except (ValueError, OSError):
+            return None
+        return job if job.get('user_id') == user_id else None
+
+    def stats(self):
+        with self._guard:
+            return dict(self._counts, pending=self._pending, workers=self.workers)
+
+    def _run(self, job, fn, args):
+        job['status'] = 'running'
+        job['started_at'] = datetime.utcnow().isoformat()
+        try:
+            self._write(job)
+            job['result'] = fn(*args)
+            job['status'] = 'done'
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = describe_error(e)
+        job['finished_at'] = datetime.utcnow().isoformat()
+        try:
+            self._write(job)
+        except OSError as e:
+            print(f"Error saving receipt scan job {job['id']}: {e}")
+        with self._guard:
+            self._pending -= 1
+            self._counts[job['status']] += 1
+
+    def _path(self, job_id):
+        return self.job_dir / f'{job_id}.json'
+
+    def _write(self, job):
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self._path(job['id']), job)
+
+    def _purge_expired(self, now):
+        # At most once a minute, by the time each job file was last written
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        for path in self.job_dir.glob('*.json'):
+            try:
+                if now - path.stat().st_mtime > self.ttl:
+                    path.unlink()
+            except OSError:
+                pass
+
+
+def describe_error(e):
+    """User-facing message for a failed scan"""
+    if isinstance(e, json.JSONDecodeError):
+        return f'Failed to parse receipt data: {str(e)}'
+    return f'Failed to scan receipt: {str(e)}'
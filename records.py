@@ -0,0 +1,547 @@
+"""In-memory model of a user's record collections."""
+from bisect import bisect_left, bisect_right, insort
+
+from recurrence import last_processed, rule_for
+
+COLLECTIONS = ('transactions', 'recurring_transactions', 'categories', 'notifications')
+
+
+def transaction_date(transaction):
+    return str(transaction.get('date') or '')
+
+
+def next_due_date(rt):
+    """ISO date of an active recurring rule's next occurrence, None if there is none"""
+    if not rt.get('is_active', True):
+        return None
+    try:
+        rule = rule_for(rt)
+        next_date = rule.next_after(last_processed(rt)) if rule else None
+    except (TypeError, ValueError):
+        return None
+    return next_date.isoformat() if next_date else None
+
+
+# Collections that keep a sorted index, and the function giving the sort value
+SORT_KEYS = {'transactions': transaction_date, 'recurring_transactions': next_due_date}
+# Collections that keep per-month rollups
+ROLLUP_COLLECTIONS = ('transactions',)
+
+
+def recurring_notification_key(notification):
+    """(recurring_id, notification_date) of a live recurring notification"""
+    if notification.get('type') != 'recurring' or notification.get('deleted_at'):
+        return None
+    return (notification.get('recurring_id'), notification.get('notification_date'))
+
+
+# Collections that count secondary keys, and the function giving a record's key
+KEY_FUNCS = {'notifications': recurring_notification_key}
+
+_TOMBSTONE = object()
+# Slots per chunk of the record list and of the sorted index
+CHUNK = 256
+# Dicts the id index and the key counts are split into
+SHARDS = 64
+
+
+class _Part(list):
+    """A chunk of a list that copies of its owner share until they change it"""
+    __slots__ = ('owner',)
+
+
+class _Shard(dict):
+    """A part of a dict that copies of its owner share until they change it"""
+    __slots__ = ('owner',)
+
+
+def _new_part(cls, owner, items=()):
+    part = cls(items)
+    part.owner = owner
+    return part
+
+
+def _writable(parts, key, owner):
+    """``parts[key]``, replaced by a copy of its own first unless ``owner`` made it"""
+    part = parts[key]
+    if part.owner is not owner:
+        part = parts[key] = _new_part(type(part), owner, part)
+    return part
+
+
+class RecordList:
+    """Records of one collection in insertion order, indexed by id.
+
+    Lookups, replacements and deletes by id are O(1): deleting leaves a
+    tombstone in place so the positions of later records stay valid, and
+    tombstones are swept out once they make up a quarter of the slots.
+    Iteration skips tombstones, so callers can treat this like a list.
+
+    With a ``sort_key`` the list also keeps ``(value, id, slot)`` entries
+    sorted by the value it returns for each record (records giving None are
+    left out), so ordered and range queries need no sort. With
+    ``rollups`` every change is also applied to those monthly totals, and
+    with a ``key_func`` the list counts the keys it returns (records giving
+    None are not counted) so ``has_key`` is a set lookup.
+
+    The slots and the sorted index are kept in chunks of ``CHUNK`` entries
+    and the id index and key counts in ``SHARDS`` dicts. ``copy`` shares all
+    of them with the original, and either side copies a chunk or shard
+    before its first change to it, so a copy and a change to it cost
+    O(n / CHUNK) rather than O(n).
+    """
+
+    __slots__ = ('_owner', '_chunks', '_size', '_positions', '_dead', '_has_duplicates',
+                 'sort_key', '_sorted', '_maxes', 'rollups', 'key_func', '_keys')
+
+    def __init__(self, records=(), sort_key=None, rollups=None, key_func=None):
+        self._owner = object()
+        self.sort_key = sort_key
+        self.rollups = rollups
+        self.key_func = key_func
+        self._keys = [_new_part(_Shard, self._owner) for _ in range(SHARDS)] \
+            if key_func else None
+        self._rebuild(list(records))
+        for record in self:
+            self._track(record, 1)
+
+    def _rebuild(self, records):
+        owner = self._owner
+        self._chunks = [_new_part(_Part, owner, records[i:i + CHUNK])
+                        for i in range(0, len(records), CHUNK)]
+        self._size = len(records)
+        self._positions = positions = [_new_part(_Shard, owner) for _ in range(SHARDS)]
+        for i, record in enumerate(records):
+            record_id = record.get('id')
+            positions[hash(record_id) % SHARDS].setdefault(record_id, i)
+        self._dead = 0
+        # Stored data may contain repeated ids; those fall back to scanning
+        self._has_duplicates = sum(map(len, positions)) < len(records)
+        self._sorted = self._maxes = None
+        if self.sort_key:
+            entries = (self._sort_entry(r, i) for i, r in enumerate(records))
+            entries = sorted(e for e in entries if e is not None)
+            self._sorted = [_new_part(_Part, owner, entries[i:i + CHUNK])
+                            for i in range(0, len(entries), CHUNK)]
+            self._maxes = [part[-1] for part in self._sorted]
+
+    # --- Chunked slots and sharded id index ---
+
+    def _slot(self, i):
+        return self._chunks[i // CHUNK][i % CHUNK]
+
+    def _set_slot(self, i, record):
+        _writable(self._chunks, i // CHUNK, self._owner)[i % CHUNK] = record
+
+    def _append_slot(self, record):
+        if self._size % CHUNK == 0:
+            self._chunks.append(_new_part(_Part, self._owner))
+        _writable(self._chunks, -1, self._owner).append(record)
+        self._size += 1
+
+    def _position(self, record_id):
+        return self._positions[hash(record_id) % SHARDS].get(record_id)
+
+    def _positions_for(self, record_id):
+        """The writable shard of the id index holding ``record_id``"""
+        return _writable(self._positions, hash(record_id) % SHARDS, self._owner)
+
+    # --- Indexes ---
+
+    def _sort_entry(self, record, slot):
+        value = self.sort_key(record)
+        return None if value is None else (value, str(record.get('id')), slot)
+
+    def _track(self, record, sign):
+        """Apply a record's addition (sign 1) or removal (-1) to rollups and keys"""
+        if self.rollups is not None:
+            self.rollups.add(record, sign)
+        if self._keys is not None:
+            key = self.key_func(record)
+            if key is not None:
+                keys = _writable(self._keys, hash(key) % SHARDS, self._owner)
+                count = keys.get(key, 0) + sign
+                if count > 0:
+                    keys[key] = count
+                else:
+                    keys.pop(key, None)
+
+    def _index_add(self, slot):
+        record = self._slot(slot)
+        self._track(record, 1)
+        if self._sorted is not None:
+            entry = self._sort_entry(record, slot)
+            if entry is not None:
+                self._sorted_insert(entry)
+
+    def _index_remove(self, slot):
+        record = self._slot(slot)
+        self._track(record, -1)
+        if self._sorted is None:
+            return
+        entry = self._sort_entry(record, slot)
+        if entry is not None:
+            j = bisect_left(self._maxes, entry)
+            if j < len(self._maxes):
+                i = bisect_left(self._sorted[j], entry)
+                if self._sorted[j][i] == entry:
+                    self._sorted_delete(j, i)
+                    return
+        # The sort value may depend on the current date (a recurring rule
+        # without a start date), so it can differ from when it was added
+        for j, part in enumerate(self._sorted):
+            for i, existing in enumerate(part):
+                if existing[2] == slot:
+                    self._sorted_delete(j, i)
+                    return
+
+    def _sorted_insert(self, entry):
+        if not self._sorted:
+            self._sorted.append(_new_part(_Part, self._owner, [entry]))
+            self._maxes.append(entry)
+            return
+        j = min(bisect_left(self._maxes, entry), len(self._maxes) - 1)
+        part = _writable(self._sorted, j, self._owner)
+        insort(part, entry)
+        if len(part) > 2 * CHUNK:
+            self._sorted.insert(j + 1, _new_part(_Part, self._owner, part[CHUNK:]))
+            self._maxes.insert(j + 1, part[-1])
+            del part[CHUNK:]
+        self._maxes[j] = part[-1]
+
+    def _sorted_delete(self, j, i):
+        part = _writable(self._sorted, j, self._owner)
+        del part[i]
+        if part:
+            self._maxes[j] = part[-1]
+        else:
+            del self._sorted[j]
+            del self._maxes[j]
+
+    def _sorted_position(self, key, right=False):
+        """``(chunk, index)`` where ``key`` would be inserted into the sorted
+        index, like ``bisect_left`` (or ``bisect_right``) on the whole of it"""
+        find = bisect_right if right else bisect_left
+        j = find(self._maxes, key)
+        if j == len(self._maxes):
+            return j, 0
+        return j, find(self._sorted[j], key)
+
+    # --- List interface ---
+
+    def __iter__(self):
+        return (r for chunk in self._chunks for r in chunk if r is not _TOMBSTONE)
+
+    def __len__(self):
+        return self._size - self._dead
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __contains__(self, record_id):
+        return self._position(record_id) is not None
+
+    def __eq__(self, other):
+        if isinstance(other, RecordList):
+            other = other.to_list()
+        return self.to_list() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'RecordList({self.to_list()!r})'
+
+    def to_list(self):
+        return list(self)
+
+    def copy(self):
+        """A copy sharing the records, chunks and shards with this list.
+
+        Loaded documents are read by several threads at once, so writers
+        change a copy and swap it in rather than changing the shared list.
+        Both lists get a new owner, so neither changes a shared chunk or
+        shard in place.
+        """
+        other = RecordList.__new__(RecordList)
+        self._owner = object()
+        other._owner = object()
+        other.sort_key = self.sort_key
+        other.rollups = self.rollups.copy() if self.rollups is not None else None
+        other.key_func = self.key_func
+        other._keys = list(self._keys) if self._keys is not None else None
+        other._chunks = list(self._chunks)
+        other._size = self._size
+        other._positions = list(self._positions)
+        other._dead = self._dead
+        other._has_duplicates = self._has_duplicates
+        other._sorted = list(self._sorted) if self._sorted is not None else None
+        other._maxes = list(self._maxes) if self._maxes is not None else None
+        return other
+
+    def has_key(self, key):
+        """Whether a record with this ``key_func`` key is present"""
+        return key in self._keys[hash(key) % SHARDS]
+
+    def get(self, record_id, default=None):
+        i = self._position(record_id)
+        return default if i is None else self._slot(i)
+
+    def append(self, record):
+        record_id = record.get('id')
+        if self._position(record_id) is not None:
+            self._has_duplicates = True
+        else:
+            self._positions_for(record_id)[record_id] = self._size
+        self._append_slot(record)
+        self._index_add(self._size - 1)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def replace(self, record):
+        """Replace the record with the same id in place; False if not found"""
+        i = self._position(record['id'])
+        if i is None:
+            return False
+        self._index_remove(i)
+        self._set_slot(i, record)
+        self._index_add(i)
+        return True
+
+    def remove_ids(self, record_ids):
+        """Delete records by id and return how many were removed"""
+        record_ids = set(record_ids)
+        if len(record_ids) > 64 and len(record_ids) * 4 > len(self):
+            return self._remove_many(record_ids)
+        removed = 0
+        for record_id in record_ids:
+            if self._position(record_id) is None:
+                continue
+            i = self._positions_for(record_id).pop(record_id)
+            self._index_remove(i)
+            self._set_slot(i, _TOMBSTONE)
+            self._dead += 1
+            removed += 1
+        if removed and self._has_duplicates:
+            removed += self._remove_duplicates(set(record_ids))
+        if self._dead > 64 and self._dead * 4 > self._size:
+            self._rebuild(self.to_list())
+        return removed
+
+    def iter_sorted(self, start=None, end=None, after=None, reverse=False):
+        """Yield ``(cursor, record)`` pairs ordered by the sort field.
+
+        ``start`` and ``end`` bound the sort value inclusively, where ``end``
+        also matches longer values it is a prefix of (``'2024-01-31'`` covers
+        ``'2024-01-31T18:00:00Z'``). ``after`` is a cursor returned by an
+        earlier call; iteration resumes just past it in the same direction.
+        """
+        parts, chunks = self._sorted, self._chunks
+        lo = (0, 0) if start is None else self._sorted_position((start,))
+        hi = (len(parts), 0) if end is None else \
+            self._sorted_position((end + '\uffff',), right=True)
+        if after is not None:
+            after = tuple(after)
+            if reverse:
+                hi = min(hi, self._sorted_position(after))
+            else:
+                lo = max(lo, self._sorted_position(after + (float('inf'),), right=True))
+        for segment in _segments(parts, lo, hi, reverse):
+            for value, record_id, slot in segment:
+                yield (value, record_id), chunks[slot // CHUNK][slot % CHUNK]
+
+    def _remove_many(self, record_ids):
+        # Dropping a large share of the list: rebuilding the indexes once is
+        # cheaper than deleting entries from the sorted index one by one
+        kept = []
+        for record in self:
+            if record.get('id') in record_ids:
+                self._track(record, -1)
+            else:
+                kept.append(record)
+        removed = len(self) - len(kept)
+        self._rebuild(kept)
+        return removed
+
+    def _remove_duplicates(self, record_ids):
+        removed = 0
+        for i in range(self._size):
+            record = self._slot(i)
+            if record is not _TOMBSTONE and record.get('id') in record_ids:
+                self._index_remove(i)
+                self._set_slot(i, _TOMBSTONE)
+                self._dead += 1
+                removed += 1
+        return removed
+
+
+def _segments(parts, lo, hi, reverse=False):
+    """Runs of entries of a chunked sorted list from position ``lo`` up to
+    ``hi`` (``(chunk, index)`` pairs), backwards from ``hi`` if ``reverse``"""
+    if lo >= hi:
+        return
+    chunks = range(hi[0] if hi[1] else hi[0] - 1, lo[0] - 1, -1) if reverse \
+        else range(lo[0], min(hi[0] + 1, len(parts)))
+    for j in chunks:
+        part = parts[j]
+        start = lo[1] if j == lo[0] else 0
+        stop = hi[1] if j == hi[0] else len(part)
+        if start < stop:
+            yield reversed(part[start:stop]) if reverse else part[start:stop]
+
+
+def month_key(value):
+    """'YYYY-MM' of an ISO date string, or None if it does not look like one"""
+    value = str(value or '')
+    if len(value) >= 7 and value[4] == '-' and value[:4].isdigit() and value[5:7].isdigit():
+        return value[:7]
+    return None
+
+
+def transaction_amount(record):
+    """Absolute amount of a transaction; the sign is given by ``is_income``"""
+    try:
+        return abs(float(record.get('amount') or 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Rollups:
+    """Running totals of transactions per month, category and kind.
+
+    ``by_month['2024-03'][(category, 'income' | 'expense')]`` is a
+    ``(sum, count)`` pair, kept up to date by the owning RecordList so
+    aggregate queries cost O(months x categories) instead of O(history).
+    Copies share the months they have not changed.
+    """
+
+    __slots__ = ('by_month', '_owner')
+
+    def __init__(self):
+        self.by_month = {}
+        self._owner = object()
+
+    @classmethod
+    def build(cls, records):
+        """Rollups recounted from scratch over ``records``"""
+        rollups = cls()
+        for record in records:
+            rollups.add(record)
+        return rollups
+
+    @classmethod
+    def from_cells(cls, cells):
+        """Rollups from ``(month, category, kind, sum, count)`` tuples"""
+        rollups = cls()
+        for month, category, kind, amount, count in cells:
+            rollups._month(month)[(category, kind)] = (amount, count)
+        return rollups
+
+    def copy(self):
+        other = Rollups()
+        other.by_month = dict(self.by_month)
+        self._owner = object()
+        return other
+
+    def _month(self, month):
+        """The writable cells of ``month``, created if missing"""
+        if month not in self.by_month:
+            self.by_month[month] = _new_part(_Shard, self._owner)
+        return _writable(self.by_month, month, self._owner)
+
+    def cells(self):
+        for month, cells in self.by_month.items():
+            for (category, kind), (amount, count) in cells.items():
+                yield month, category, kind, amount, count
+
+    @staticmethod
+    def key(record):
+        month = month_key(record.get('date'))
+        if month is None:
+            return None, None
+        kind = 'income' if record.get('is_income') else 'expense'
+        return month, (record.get('category') or 'Other', kind)
+
+    def add(self, record, sign=1):
+        month, key = self.key(record)
+        if month is None:
+            return
+        cells = self.by_month.get(month)
+        if cells is None or cells.owner is not self._owner:
+            cells = self._month(month)
+        amount, count = cells.get(key, (0.0, 0))
+        amount += sign * transaction_amount(record)
+        count += sign
+        if count == 0:
+            cells.pop(key, None)
+            if not cells:
+                del self.by_month[month]
+        else:
+            cells[key] = (amount, count)
+
+    def remove(self, record):
+        self.add(record, -1)
+
+    def diff(self, other, tolerance=0.005):
+        """Cells that differ from ``other`` as ``(month, category, kind, ours, theirs)``"""
+        ours = {cell[:3]: tuple(cell[3:]) for cell in self.cells()}
+        theirs = {cell[:3]: tuple(cell[3:]) for cell in other.cells()}
+        mismatches = []
+        for key in sorted(set(ours) | set(theirs)):
+            a = ours.get(key, (0.0, 0))
+            b = theirs.get(key, (0.0, 0))
+            if a[1] != b[1] or abs(a[0] - b[0]) > tolerance:
+                mismatches.append(key + (a, b))
+        return mismatches
+
+    def summary(self, months):
+        """Income/expense totals and per-category sums over the given months"""
+        totals = {'income': 0.0, 'expense': 0.0, 'count': 0}
+        categories = {'income': {}, 'expense': {}}
+        for month in months:
+            for (category, kind), (amount, count) in self.by_month.get(month, {}).items():
+                totals[kind] += amount
+                totals['count'] += count
+                categories[kind][category] = categories[kind].get(category, 0.0) + amount
+        return {
+            'income': round(totals['income'], 2),
+            'expense': round(totals['expense'], 2),
+            'balance': round(totals['income'] - totals['expense'], 2),
+            'count': totals['count'],
+            'categories': {kind: {c: round(v, 2) for c, v in sums.items()}
+                           for kind, sums in categories.items()}
+        }
+
+
+def rollup_deltas(added=(), removed=()):
+    """Net ``(month, category, kind) -> [sum, count]`` change of replacing
+    the ``removed`` transactions with the ``added`` ones"""
+    deltas = {}
+    for records, sign in ((added, 1), (removed, -1)):
+        for record in records:
+            month, key = Rollups.key(record)
+            if month is None:
+                continue
+            cell = deltas.setdefault((month,) + key, [0.0, 0])
+            cell[0] += sign * transaction_amount(record)
+            cell[1] += sign
+    return deltas
+
+
+def index_document(data):
+    """Convert a document's collections to RecordLists in place; returns it"""
+    for collection in COLLECTIONS:
+        items = data.get(collection)
+        if items is not None and not isinstance(items, RecordList):
+            data[collection] = RecordList(items, SORT_KEYS.get(collection),
+                                          Rollups() if collection in ROLLUP_COLLECTIONS else None,
+                                          KEY_FUNCS.get(collection))
+    return data
+
+
+def json_default(value):
+    """``default`` hook for json.dump that serializes RecordLists as lists"""
+    if isinstance(value, RecordList):
+        return value.to_list()
+    return str(value)
@@ -0,0 +1,114 @@
+"""Occurrence dates of recurring transactions."""
+import calendar
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+# frequency -> (step, unit)
+FREQUENCIES = {
+    'daily': (1, 'days'),
+    'weekly': (7, 'days'),
+    'biweekly': (14, 'days'),
+    'monthly': (1, 'months'),
+    'yearly': (12, 'months')
+}
+
+
+def parse_date(value):
+    """Date part of an ISO date or datetime string"""
+    return datetime.fromisoformat(value.replace('Z', '')).date()
+
+
+def add_months(day, months):
+    """``day`` moved by whole months, clamped to the length of the target month"""
+    years, month = divmod(day.month - 1 + months, 12)
+    year = day.year + years
+    return date(year, month + 1, min(day.day, calendar.monthrange(year, month + 1)[1]))
+
+
+class Rule:
+    """A parsed recurrence: occurrence ``k`` is ``start`` plus ``k`` steps.
+
+    Occurrences are computed from ``start`` rather than from the previous
+    occurrence, so a monthly rule on the 31st comes back to the 31st after
+    a shorter month, and a yearly rule on Feb 29 falls on Feb 28 in common
+    years and on Feb 29 again in leap years.
+    """
+
+    __slots__ = ('start', 'end', 'step', 'unit')
+
+    def __init__(self, start, end=None, frequency='monthly'):
+        self.start = start
+        self.end = end
+        self.step, self.unit = FREQUENCIES[frequency]
+
+    def occurrence(self, k):
+        if self.unit == 'days':
+            return self.start + timedelta(days=self.step * k)
+        return add_months(self.start, self.step * k)
+
+    def index_after(self, day):
+        """Index of the first occurrence after the ``last_processed`` marker
+        ``day`` (the first one if None).
+
+        For month-based rules an occurrence in the same month as the marker
+        counts as done: the engine before this one moved each occurrence on
+        from the previous one, so a rule on the 31st that went through
+        February has markers on the 29th. A marker before ``start`` leaves
+        every occurrence to do.
+        """
+        if day is None or day < self.start:
+            return 0
+        if self.unit == 'days':
+            return (day - self.start).days // self.step + 1
+        return self._months(day) // self.step + 1
+
+    def count_until(self, day):
+        """Number of occurrences on or before ``day``"""
+        if day < self.start:
+            return 0
+        if self.unit == 'days':
+            return (day - self.start).days // self.step + 1
+        k = self._months(day) // self.step
+        return k + 1 if self.occurrence(k) <= day else k
+
+    def _months(self, day):
+        return (day.year - self.start.year) * 12 + day.month - self.start.month
+
+    def next_after(self, day):
+        """First occurrence after ``day``, or None once the rule has ended"""
+        next_date = self.occurrence(self.index_after(day))
+        if self.end and next_date > self.end:
+            return None
+        return next_date
+
+    def between(self, after, until):
+        """All occurrences after ``after`` (None: from the start) up to ``until``"""
+        if self.end and self.end < until:
+            until = self.end
+        first = self.index_after(after)
+        last = self.count_until(until) - 1
+        return [self.occurrence(k) for k in range(first, last + 1)]
+
+
+@lru_cache(maxsize=4096)
+def _rule(start_date, end_date, frequency):
+    if frequency not in FREQUENCIES:
+        return None
+    return Rule(parse_date(start_date), parse_date(end_date) if end_date else None, frequency)
+
+
+def rule_for(rt):
+    """Parsed Rule of a recurring transaction record (None for an unknown frequency)"""
+    return _rule(start_date(rt), rt.get('end_date'), rt.get('frequency', 'monthly'))
+
+
+def start_date(rt):
+    """ISO start date of a rule. Rules stored without one start at their
+    last processed occurrence, or today if they were never processed, as
+    the first processing day used to be the start."""
+    return rt.get('start_date') or rt.get('last_processed') or date.today().isoformat()
+
+
+def last_processed(rt):
+    value = rt.get('last_processed')
+    return parse_date(value) if value else None
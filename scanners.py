@@ -0,0 +1,226 @@
+"""Receipt scanning engines: Gemini, and offline Tesseract OCR with heuristics."""
+import io
+import multiprocessing
+import re
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from receipts import build_prompt, normalize_result, scan_image
+
+
+class Scanner:
+    """Turns a prepared receipt image (a ``{mime_type, data}`` blob) into the
+    result schema of ``receipts.normalize_result``"""
+
+    name = None
+
+    def available(self, api_key):
+        """Whether the engine can scan for a user with this API key (None: no key)"""
+        return True
+
+    def scan(self, image, categories, api_key):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class GeminiScanner(Scanner):
+    """Sends the image to the Gemini model through a ``gemini.ModelPool``"""
+
+    name = 'gemini'
+
+    def __init__(self, models):
+        self.models = models
+
+    def available(self, api_key):
+        return api_key is not None and self.models.breaker.state != 'open'
+
+    def scan(self, image, categories, api_key):
+        return scan_image(self.models, api_key, image, build_prompt(categories))
+
+    def stats(self):
+        return self.models.stats()
+
+
+class TesseractScanner(Scanner):
+    """Reads the image with Tesseract OCR on a pool of worker processes and
+    picks the receipt fields out of the text, without any network access.
+
+    Needs the ``pytesseract`` package and the ``tesseract`` binary; the
+    process pool is started on first use.
+    """
+
+    name = 'tesseract'
+
+    def __init__(self, workers=2, languages='eng', timeout=30):
+        self.workers = max(1, workers)
+        self.languages = languages
+        self.timeout = timeout
+        self._pool = None
+        self._available = None
+        self._guard = threading.Lock()
+        self._counts = {'scans': 0, 'failures': 0}
+
+    def available(self, api_key=None):
+        if self._available is None:
+            try:
+                import pytesseract  # noqa: F401
+                self._available = shutil.which('tesseract') is not None
+            except ImportError:
+                self._available = False
+        return self._available
+
+    def scan(self, image, categories, api_key=None):
+        if not self.available():
+            raise RuntimeError('Tesseract OCR is not installed')
+        with self._guard:
+            if self._pool is None:
+                # Spawned rather than forked: the web worker has threads running
+                self._pool = ProcessPoolExecutor(self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            pool = self._pool
+        try:
+            text = pool.submit(ocr_text, image['data'], self.languages,
+                               self.timeout).result(self.timeout + 5)
+        except Exception:
+            self._count('failures')
+            raise
+        self._count('scans')
+        return normalize_result(extract_receipt(text, categories))
+
+    def _count(self, name):
+        with self._guard:
+            self._counts[name] += 1
+
+    def stats(self):
+        with self._guard:
+            return dict(self._counts, workers=self.workers, available=self.available())
+
+
+def ocr_text(data, languages, timeout):
+    """Text Tesseract reads from an encoded image; runs in a pool process"""
+    import pytesseract
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        # --psm 6: a single block of text, which suits a receipt's columns
+        return pytesseract.image_to_string(image, lang=languages, config='--psm 6',
+                                           timeout=timeout)
+
+
+# --- Field extraction from OCR text ---
+
+# Amounts with two decimals, with or without thousands separators
+AMOUNT = re.compile(r'(?<![\d.,])-?(?:\d{1,3}(?:[.,\s]\d{3})+|\d+)[.,]\d{2}(?!\d)')
+DATES = (
+    (re.compile(r'\b(\d{4})[-./](\d{1,2})[-./](\d{1,2})\b'), ('y', 'm', 'd')),
+    (re.compile(r'\b(\d{1,2})[-./](\d{1,2})[-./](\d{4})\b'), ('d', 'm', 'y')),
+    (re.compile(r'\b(\d{1,2})[./](\d{1,2})[./](\d{2})\b'), ('d', 'm', 'y')),
+)
+QUANTITY = re.compile(r'(?:^|\s)(\d{1,3})\s*[xX*](?=\s|$)|(?:^|\s)[xX*]\s*(\d{1,3})(?=\s|$)')
+# Lower-case words that mark summary lines, in several receipt languages
+TOTAL_WORDS = ('total', 'grand total', 'amount due', 'balance due', 'summe', 'gesamt',
+               'zu zahlen', 'toplam', 'totale', 'totaal', 'montant', 'importe')
+SUBTOTAL_WORDS = ('subtotal', 'sub total', 'sub-total', 'zwischensumme', 'ara toplam',
+                  'netto', 'net amount')
+TAX_WORDS = ('tax', 'vat', 'mwst', 'ust', 'kdv', 'tva', 'iva', 'btw', 'gst')
+OTHER_WORDS = ('cash', 'card', 'change', 'visa', 'mastercard', 'bar', 'rückgeld', 'nakit',
+               'kredi', 'payment', 'paid', 'tender', 'rounding')
+
+
+def parse_amount(text):
+    """Number from an amount like ``1.234,56`` or ``1,234.56`` (the last
+    separator is the decimal point)"""
+    text = re.sub(r'\s', '', text)
+    whole, cents = text[:-3], text[-2:]
+    return float(re.sub(r'[.,]', '', whole) + '.' + cents)
+
+
+def find_date(text):
+    """First plausible date in the text as ``YYYY-MM-DD``, day-first where ambiguous"""
+    for pattern, order in DATES:
+        for match in pattern.finditer(text):
+            parts = dict(zip(order, (int(g) for g in match.groups())))
+            year = parts['y'] + 2000 if parts['y'] < 100 else parts['y']
+            # Month-first (US) dates show up as an impossible day-first one
+            for month, day in ((parts['m'], parts['d']), (parts['d'], parts['m'])):
+                try:
+                    return date(year, month, day).isoformat()
+                except ValueError:
+                    continue
+    return None
+
+
+def has_word(line, words):
+    return any(re.search(r'(?<![a-zäöüçğış])' + re.escape(w) + r'(?![a-zäöüçğış])', line)
+               for w in words)
+
+
+def extract_receipt(text, categories=()):
+    """Raw receipt fields (store, totals, date, items, category) from OCR text"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    store_name = None
+    total = subtotal = tax = None
+    largest = None
+    items = []
+    summary_started = False
+
+    for line in lines:
+        lower = line.lower()
+        amounts = [parse_amount(a) for a in AMOUNT.findall(line)]
+        if store_name is None and not amounts and sum(c.isalpha() for c in line) >= 3:
+            store_name = line
+            continue
+        if not amounts:
+            continue
+        amount = amounts[-1]
+        is_total = has_word(lower, TOTAL_WORDS)
+        if has_word(lower, SUBTOTAL_WORDS):
+            subtotal = amount
+            summary_started = True
+        elif has_word(lower, TAX_WORDS) and not (is_total and re.search(r'incl|inkl', lower)):
+            # Several tax rates are listed one per line
+            tax = amount if tax is None else round(tax + amount, 2)
+            summary_started = True
+        elif is_total:
+            # The grand total usually comes after subtotals; keep the last
+            total = amount
+            summary_started = True
+        elif has_word(lower, OTHER_WORDS) or summary_started:
+            continue
+        else:
+            name = AMOUNT.split(line)[0]
+            quantity = 1
+            match = QUANTITY.search(name)
+            if match:
+                quantity = int(match.group(1) or match.group(2)) or 1
+                name = QUANTITY.sub(' ', name)
+            name = name.strip(' .:*-\t')
+            if sum(c.isalpha() for c in name) >= 2 and amount > 0:
+                items.append({'name': name, 'quantity': quantity,
+                              'price': round(amount / quantity, 2)})
+        if amount > 0 and (largest is None or amount > largest):
+            largest = amount
+
+    if total is None:
+        total = largest
+    return {
+        'store_name': store_name,
+        'subtotal': subtotal,
+        'tax': tax,
+        'total': total,
+        'date': find_date(text),
+        'category': match_category(text, categories),
+        'items': items
+    }
+
+
+def match_category(text, categories):
+    """The first expense category whose name appears in the text, or 'Other'"""
+    lower = text.lower()
+    for category in categories:
+        if category.get('type') in ('expense', 'both') and category['name'].lower() in lower:
+            return category['name']
+    return 'Other'
@@ -0,0 +1,177 @@
+"""Background processing of recurring transactions."""
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import date, datetime
+
+from storage import write_json_atomic
+
+
+class RecurringScheduler:
+    """Materializes due recurring transactions off the request path.
+
+    Keeps a per-user "last processed day" marker, so request handlers only
+    need a dictionary lookup to know whether today's catch-up already ran.
+    A daemon thread sweeps every user returned by ``user_ids`` once a day,
+    checking every ``interval`` seconds whether today's sweep is still to
+    do, and processes them on a pool of ``workers`` threads.
+
+    With several worker processes, ``lock`` (a callable returning a context
+    manager that yields whether it got the lock without waiting) lets only
+    one of them sweep at a time, and ``state_path`` records the day of the
+    last complete sweep and its timings so the others skip it.
+    """
+
+    def __init__(self, process, interval=3600, user_ids=None, lock=None,
+                 state_path=None, workers=4, history=20):
+        # process(user_id) creates the transactions that are due
+        self.process = process
+        self.interval = interval
+        self.user_ids = user_ids
+        self.lock = lock or (lambda: nullcontext(True))
+        self.state_path = state_path
+        self.workers = max(1, workers)
+        self.runs = deque(maxlen=history)
+        self._processed_on = {}
+        self._swept_on = None
+        self._state_stamp = None
+        self._state_swept_on = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def ensure_processed(self, user_id):
+        """Process the user unless it already happened today, here or in
+        another process's sweep"""
+        today = date.today()
+        if self._processed_on.get(user_id) == today or self._swept_on == today:
+            return
+        if self._shared_swept_on() == today.isoformat():
+            self._swept_on = today
+            return
+        self.run_user(user_id, today)
+
+    def _shared_swept_on(self):
+        # The process holding the lock may have swept since our last tick;
+        # the state file is only re-read after it has been rewritten
+        if not self.state_path:
+            return None
+        try:
+            st = os.stat(self.state_path)
+        except OSError:
+            return None
+        stamp = (st.st_ino, st.st_mtime_ns)
+        if stamp != self._state_stamp:
+            self._state_swept_on = self._read_state().get('swept_on')
+            self._state_stamp = stamp
+        return self._state_swept_on
+
+    def run_user(self, user_id, today=None):
+        today = today or date.today()
+        self.process(user_id)
+        self._processed_on[user_id] = today
+
+    def tick(self):
+        """Sweep all users unless today's sweep is done; returns the run's
+        timings, or None if there was nothing to do or another process has it"""
+        today = date.today()
+        if self._swept_on == today:
+            return None
+        with self.lock() as acquired:
+            if not acquired:
+                return None
+            state = self._read_state()
+            if state.get('swept_on') == today.isoformat():
+                self._swept_on = today
+                return None
+            run = self.sweep(today)
+            if not run['failed']:
+                self._swept_on = today
+                state['swept_on'] = today.isoformat()
+            state['last_run'] = run
+            self._write_state(state)
+            return run
+
+    def sweep(self, today=None):
+        """Process every user not yet processed today on the worker pool"""
+        today = today or date.today()
+        if self.user_ids is None:
+            user_ids = list(self._processed_on)
+        else:
+            user_ids = list(self.user_ids())
+        pending = [u for u in user_ids if self._processed_on.get(u) != today]
+        started_at = datetime.utcnow().isoformat()
+        started = time.perf_counter()
+        failed = 0
+        slowest = 0.0
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='recurring') as pool:
+            futures = {pool.submit(self._timed, user_id, today): user_id for user_id in pending}
+            for future in as_completed(futures):
+                try:
+                    slowest = max(slowest, future.result())
+                except Exception as e:
+                    failed += 1
+                    print(f"Error processing recurring transactions for {futures[future]}: {e}")
+        run = {
+            'started_at': started_at,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+            'users': len(pending),
+            'skipped': len(user_ids) - len(pending),
+            'failed': failed,
+            'slowest_user_ms': round(slowest * 1000, 1)
+        }
+        self.runs.append(run)
+        return run
+
+    def _timed(self, user_id, today):
+        started = time.perf_counter()
+        self.run_user(user_id, today)
+        return time.perf_counter() - started
+
+    def _read_state(self):
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, state):
+        if self.state_path:
+            write_json_atomic(self.state_path, state, indent=2)
+
+    def stats(self):
+        """Settings, the last sweep recorded by any process and this process's runs"""
+        state = self._read_state()
+        return {
+            'interval': self.interval,
+            'workers': self.workers,
+            'swept_on': state.get('swept_on'),
+            'last_run': state.get('last_run'),
+            'runs': list(self.runs)
+        }
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='recurring-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # Sweep right away so a restart does not leave the day's catch-up to
+        # the first requests, then look again every interval
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Error in recurring scheduler: {e}")
+            if self._stop.wait(self.interval):
+                return
@@ -642,6 +642,13 @@ export function getCategoryIcon(categoryName) {
 
 async function refreshTransactions() {
     try {
+        // The transactions view loads its own pages rather than everything
+        if (document.getElementById('transactionsTableBody') &&
+            typeof window.reloadTransactionPages === 'function') {
+            await window.reloadTransactionPages();
+            return;
+        }
+
         const response = await fetch('/api/transactions', { headers: auth.getHeaders() });
         if (!response.ok) throw new Error('Failed to load transactions');
         
@@ -799,7 +806,7 @@ window.saveTransaction = saveTransaction;
 // RECEIPT SCANNER
 // ============================================
 
-let receiptImageData = null;
+let receiptFile = null;
 let scannedData = null;
 let checkoutItems = [];
 
@@ -828,7 +835,7 @@ export function closeScannerModal() {
 }
 
 function resetScannerModal() {
-    receiptImageData = null;
+    clearReceiptFile();
     scannedData = null;
     checkoutItems = [];
 
@@ -867,20 +874,26 @@ function handleReceiptFile(event) {
     const file = event.target.files[0];
     if (!file) return;
 
-    const reader = new FileReader();
-    reader.onload = (e) => {
-        receiptImageData = e.target.result;
+    clearReceiptFile();
+    receiptFile = file;
 
-        // Show preview
-        document.getElementById('receiptImage').src = receiptImageData;
-        document.getElementById('receiptPreview').style.display = 'block';
-        document.getElementById('scanReceiptBtn').style.display = 'inline-flex';
-    };
-    reader.readAsDataURL(file);
+    // Show preview
+    document.getElementById('receiptImage').src = URL.createObjectURL(file);
+    document.getElementById('receiptPreview').style.display = 'block';
+    document.getElementById('scanReceiptBtn').style.display = 'inline-flex';
+}
+
+function clearReceiptFile() {
+    const image = document.getElementById('receiptImage');
+    if (image && image.src.startsWith('blob:')) {
+        URL.revokeObjectURL(image.src);
+        image.removeAttribute('src');
+    }
+    receiptFile = null;
 }
 
 function clearReceiptPreview() {
-    receiptImageData = null;
+    clearReceiptFile();
     document.getElementById('receiptPreview').style.display = 'none';
     document.getElementById('scanReceiptBtn').style.display = 'none';
 
@@ -891,7 +904,7 @@ function clearReceiptPreview() {
 }
 
 async function scanReceipt() {
-    if (!receiptImageData) {
+    if (!receiptFile) {
         showToast('error', 'Error', 'Please select an image first');
         return;
     }
@@ -902,19 +915,35 @@ async function scanReceipt() {
     document.getElementById('scanReceiptBtn').style.display = 'none';
 
     try {
-        const response = await fetch('/api/scan-receipt', {
+        // Upload the file as is rather than as base64 in JSON
+        const contentType = receiptFile.type.startsWith('image/') ? receiptFile.type : 'application/octet-stream';
+        const response = await fetch('/api/scan-receipt/jobs', {
             method: 'POST',
-            headers: auth.getHeaders(),
-            body: JSON.stringify({ image: receiptImageData })
+            headers: { ...auth.getHeaders(), 'Content-Type': contentType },
+            body: receiptFile
         });
 
-        const result = await response.json();
+        let job = await response.json();
 
         if (!response.ok) {
-            throw new Error(result.error || 'Failed to scan receipt');
+            throw new Error(job.error || 'Failed to scan receipt');
+        }
+
+        // The scan runs in the background, poll until it finishes
+        while (job.status === 'queued' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const poll = await fetch(`/api/scan-receipt/jobs/${job.id}`, { headers: auth.getHeaders() });
+            job = await poll.json();
+            if (!poll.ok) {
+                throw new Error(job.error || 'Failed to scan receipt');
+            }
+        }
+
+        if (job.status !== 'done') {
+            throw new Error(job.error || 'Failed to scan receipt');
         }
 
-        scannedData = result.data;
+        scannedData = job.result;
         checkoutItems = scannedData.items || [];
 
         // Show checkout page
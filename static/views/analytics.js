@@ -1,6 +1,6 @@
 import { auth } from '../auth.js';
 import {
-    formatCurrency, getIcon, getCategoryIcon, allTransactions
+    formatCurrency, getIcon, getCategoryIcon, showToast
 } from '../core.js';
 let currentMonth = new Date().getMonth();
 let currentYear = new Date().getFullYear();
@@ -220,38 +220,35 @@ export const AnalyticsView = {
     },
 
     init: async () => {
-        await loadTransactions();
-
         // Expose functions to window
         window.switchAnalyticsTab = switchAnalyticsTab;
         window.changeMonth = changeMonth;
         window.changeYear = changeYear;
         window.updateAnalytics = updateAnalytics;
 
-        updateMonthlyView();
-        updateYearlyView();
+        await updateAnalytics();
     }
 };
 
 // -- Data Loading --
 
-async function loadTransactions() {
+// Totals are aggregated on the server; this only fetches the period on screen
+async function fetchAnalytics(year, month = null) {
+    const params = new URLSearchParams({ year });
+    if (month !== null) params.set('month', month + 1);
     try {
-        const response = await fetch('/api/transactions', { headers: auth.getHeaders() });
-        const json = await response.json();
-        // Update the allTransactions array from core.js
-        allTransactions.length = 0;
-        allTransactions.push(...json);
+        const response = await fetch(`/api/analytics?${params}`, { headers: auth.getHeaders() });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return await response.json();
     } catch (error) {
-        console.error('Failed to load transactions:', error);
+        console.error('Failed to load analytics:', error);
         showToast('error', 'Error', 'Failed to load data');
+        return null;
     }
 }
 
 async function updateAnalytics() {
-    await loadTransactions();
-    updateMonthlyView();
-    updateYearlyView();
+    await Promise.all([updateMonthlyView(), updateYearlyView()]);
 }
 
 // -- Tab Logic --
@@ -283,50 +280,42 @@ function changeMonth(delta) {
     updateMonthlyView();
 }
 
-function updateMonthlyView() {
+async function updateMonthlyView() {
     const label = document.getElementById('currentMonthLabel');
     if (label) label.textContent = `${monthNames[currentMonth]} ${currentYear}`;
 
-    const transactions = allTransactions.filter(t => {
-        const date = new Date(t.date);
-        return date.getMonth() === currentMonth && date.getFullYear() === currentYear;
-    });
-
-    const income = transactions.filter(t => t.is_income).reduce((sum, t) => sum + Math.abs(t.amount), 0);
-    const expenses = transactions.filter(t => !t.is_income).reduce((sum, t) => sum + Math.abs(t.amount), 0);
-    const balance = income - expenses;
+    const analytics = await fetchAnalytics(currentYear, currentMonth);
+    if (!analytics) return;
+    const summary = analytics.month;
 
     const incomeEl = document.getElementById('monthIncome');
     const expensesEl = document.getElementById('monthExpense');
     const balanceEl = document.getElementById('monthBalance');
 
-    if (incomeEl) incomeEl.textContent = formatCurrency(income);
-    if (expensesEl) expensesEl.textContent = formatCurrency(expenses);
-    if (balanceEl) balanceEl.textContent = (balance >= 0 ? '+' : '-') + formatCurrency(Math.abs(balance));
+    if (incomeEl) incomeEl.textContent = formatCurrency(summary.income);
+    if (expensesEl) expensesEl.textContent = formatCurrency(summary.expense);
+    if (balanceEl) balanceEl.textContent = (summary.balance >= 0 ? '+' : '-') + formatCurrency(Math.abs(summary.balance));
 
-    updateMonthExpenseChart(transactions);
-    updateMonthIncomeChart(transactions);
-    updateDailyChart(transactions);
-    updateTopCategories(transactions);
+    updateMonthExpenseChart(summary.categories.expense);
+    updateMonthIncomeChart(summary.categories.income);
+    updateDailyChart(summary.daily);
+    updateTopCategories(summary.categories);
 }
 
 // -- Charts (Monthly) --
 
-function updateMonthExpenseChart(transactions) {
-    renderDoughnutChart('monthExpenseChart', transactions.filter(t => !t.is_income), monthExpenseChart, c => monthExpenseChart = c, ['#ff6b6b', '#ff8787', '#ffa8a8', '#ff4757', '#ee5a24']);
+function updateMonthExpenseChart(categoryMap) {
+    renderDoughnutChart('monthExpenseChart', categoryMap, monthExpenseChart, c => monthExpenseChart = c, ['#ff6b6b', '#ff8787', '#ffa8a8', '#ff4757', '#ee5a24']);
 }
 
-function updateMonthIncomeChart(transactions) {
-    renderDoughnutChart('monthIncomeChart', transactions.filter(t => t.is_income), monthIncomeChart, c => monthIncomeChart = c, ['#00d4aa', '#00cec9', '#55efc4', '#00b894', '#1dd1a1']);
+function updateMonthIncomeChart(categoryMap) {
+    renderDoughnutChart('monthIncomeChart', categoryMap, monthIncomeChart, c => monthIncomeChart = c, ['#00d4aa', '#00cec9', '#55efc4', '#00b894', '#1dd1a1']);
 }
 
-function renderDoughnutChart(canvasId, items, chartInstance, setChart, colors) {
+function renderDoughnutChart(canvasId, categoryMap, chartInstance, setChart, colors) {
     const ctx = document.getElementById(canvasId);
     if (!ctx) return;
 
-    const categoryMap = {};
-    items.forEach(t => categoryMap[t.category] = (categoryMap[t.category] || 0) + Math.abs(t.amount));
-
     const labels = Object.keys(categoryMap);
 
     if (chartInstance) chartInstance.destroy();
@@ -353,29 +342,19 @@ function renderDoughnutChart(canvasId, items, chartInstance, setChart, colors) {
     setChart(newChart);
 }
 
-function updateDailyChart(transactions) {
+function updateDailyChart(daily) {
     const ctx = document.getElementById('dailyChart');
     if (!ctx) return;
 
-    const daysInMonth = new Date(currentYear, currentMonth + 1, 0).getDate();
-    const dailyExpenses = new Array(daysInMonth).fill(0);
-    const dailyIncome = new Array(daysInMonth).fill(0);
-
-    transactions.forEach(t => {
-        const day = new Date(t.date).getDate() - 1;
-        if (t.is_income) dailyIncome[day] += Math.abs(t.amount);
-        else dailyExpenses[day] += Math.abs(t.amount);
-    });
-
     if (dailyChart) dailyChart.destroy();
 
     dailyChart = new Chart(ctx, {
         type: 'bar',
         data: {
-            labels: Array.from({ length: daysInMonth }, (_, i) => i + 1),
+            labels: Array.from({ length: daily.income.length }, (_, i) => i + 1),
             datasets: [
-                { label: 'Income', data: dailyIncome, backgroundColor: 'rgba(0, 212, 170, 0.7)', borderRadius: 4 },
-                { label: 'Expenses', data: dailyExpenses, backgroundColor: 'rgba(255, 107, 107, 0.7)', borderRadius: 4 }
+                { label: 'Income', data: daily.income, backgroundColor: 'rgba(0, 212, 170, 0.7)', borderRadius: 4 },
+                { label: 'Expenses', data: daily.expense, backgroundColor: 'rgba(255, 107, 107, 0.7)', borderRadius: 4 }
             ]
         },
         options: {
@@ -385,13 +364,11 @@ function updateDailyChart(transactions) {
     });
 }
 
-function updateTopCategories(transactions) {
-    const renderList = (items, elementId, colorClass, bgClass) => {
+function updateTopCategories(categories) {
+    const renderList = (map, elementId, colorClass, bgClass) => {
         const el = document.getElementById(elementId);
         if (!el) return;
 
-        const map = {};
-        items.forEach(t => map[t.category] = (map[t.category] || 0) + Math.abs(t.amount));
         const sorted = Object.entries(map).sort((a, b) => b[1] - a[1]).slice(0, 5);
 
         if (!sorted.length) {
@@ -416,8 +393,8 @@ function updateTopCategories(transactions) {
         }).join('');
     };
 
-    renderList(transactions.filter(t => !t.is_income), 'topExpensesList', '--danger', '--danger-bg');
-    renderList(transactions.filter(t => t.is_income), 'topIncomeList', '--success', '--success-bg');
+    renderList(categories.expense, 'topExpensesList', '--danger', '--danger-bg');
+    renderList(categories.income, 'topIncomeList', '--success', '--success-bg');
 }
 
 // -- Yearly View --
@@ -427,43 +404,31 @@ function changeYear(delta) {
     updateYearlyView();
 }
 
-function updateYearlyView() {
+async function updateYearlyView() {
     const label = document.getElementById('currentYearLabel');
     if (label) label.textContent = selectedYear;
 
-    const transactions = allTransactions.filter(t => new Date(t.date).getFullYear() === selectedYear);
-
-    const income = transactions.filter(t => t.is_income).reduce((sum, t) => sum + Math.abs(t.amount), 0);
-    const expenses = transactions.filter(t => !t.is_income).reduce((sum, t) => sum + Math.abs(t.amount), 0);
-    const balance = income - expenses;
+    const analytics = await fetchAnalytics(selectedYear);
+    if (!analytics) return;
 
     const incomeEl = document.getElementById('yearIncome');
     const expensesEl = document.getElementById('yearExpense');
     const balanceEl = document.getElementById('yearBalance');
 
-    if (incomeEl) incomeEl.textContent = formatCurrency(income);
-    if (expensesEl) expensesEl.textContent = formatCurrency(expenses);
-    if (balanceEl) balanceEl.textContent = (balance >= 0 ? '+' : '-') + formatCurrency(Math.abs(balance));
+    if (incomeEl) incomeEl.textContent = formatCurrency(analytics.income);
+    if (expensesEl) expensesEl.textContent = formatCurrency(analytics.expense);
+    if (balanceEl) balanceEl.textContent = (analytics.balance >= 0 ? '+' : '-') + formatCurrency(Math.abs(analytics.balance));
 
-    updateYearlyComparisonChart(transactions);
-    updateYearExpenseChart(transactions);
-    updateYearIncomeChart(transactions);
-    updateMonthlySummaryTable(transactions);
+    updateYearlyComparisonChart(analytics.months);
+    updateYearExpenseChart(analytics.categories.expense);
+    updateYearIncomeChart(analytics.categories.income);
+    updateMonthlySummaryTable(analytics.months);
 }
 
-function updateYearlyComparisonChart(transactions) {
+function updateYearlyComparisonChart(months) {
     const ctx = document.getElementById('yearlyComparisonChart');
     if (!ctx) return;
 
-    const income = new Array(12).fill(0);
-    const expenses = new Array(12).fill(0);
-
-    transactions.forEach(t => {
-        const month = new Date(t.date).getMonth();
-        if (t.is_income) income[month] += Math.abs(t.amount);
-        else expenses[month] += Math.abs(t.amount);
-    });
-
     if (yearlyComparisonChart) yearlyComparisonChart.destroy();
 
     yearlyComparisonChart = new Chart(ctx, {
@@ -471,8 +436,8 @@ function updateYearlyComparisonChart(transactions) {
         data: {
             labels: monthNamesShort,
             datasets: [
-                { label: 'Income', data: income, backgroundColor: 'rgba(0, 212, 170, 0.8)', borderRadius: 4 },
-                { label: 'Expenses', data: expenses, backgroundColor: 'rgba(255, 107, 107, 0.8)', borderRadius: 4 }
+                { label: 'Income', data: months.map(m => m.income), backgroundColor: 'rgba(0, 212, 170, 0.8)', borderRadius: 4 },
+                { label: 'Expenses', data: months.map(m => m.expense), backgroundColor: 'rgba(255, 107, 107, 0.8)', borderRadius: 4 }
             ]
         },
         options: {
@@ -482,31 +447,24 @@ function updateYearlyComparisonChart(transactions) {
     });
 }
 
-function updateYearExpenseChart(transactions) {
-    renderDoughnutChart('yearExpenseChart', transactions.filter(t => !t.is_income), yearExpenseChart, c => yearExpenseChart = c, ['#ff6b6b', '#ff8787', '#ffa8a8']);
+function updateYearExpenseChart(categoryMap) {
+    renderDoughnutChart('yearExpenseChart', categoryMap, yearExpenseChart, c => yearExpenseChart = c, ['#ff6b6b', '#ff8787', '#ffa8a8']);
 }
 
-function updateYearIncomeChart(transactions) {
-    renderDoughnutChart('yearIncomeChart', transactions.filter(t => t.is_income), yearIncomeChart, c => yearIncomeChart = c, ['#00d4aa', '#00cec9', '#55efc4']);
+function updateYearIncomeChart(categoryMap) {
+    renderDoughnutChart('yearIncomeChart', categoryMap, yearIncomeChart, c => yearIncomeChart = c, ['#00d4aa', '#00cec9', '#55efc4']);
 }
 
-function updateMonthlySummaryTable(transactions) {
+function updateMonthlySummaryTable(months) {
     const tbody = document.getElementById('monthlySummaryBody');
     if (!tbody) return;
 
-    const data = monthNames.map((m, i) => {
-        const trans = transactions.filter(t => new Date(t.date).getMonth() === i);
-        const inc = trans.filter(t => t.is_income).reduce((s, t) => s + Math.abs(t.amount), 0);
-        const exp = trans.filter(t => !t.is_income).reduce((s, t) => s + Math.abs(t.amount), 0);
-        return { month: m, income: inc, expenses: exp, net: inc - exp, count: trans.length };
-    });
-
-    tbody.innerHTML = data.map(d => `
+    tbody.innerHTML = months.map((d, i) => `
         <tr>
-            <td><strong>${d.month}</strong></td>
+            <td><strong>${monthNames[i]}</strong></td>
             <td class="text-success">${formatCurrency(d.income)}</td>
-            <td class="text-danger">${formatCurrency(d.expenses)}</td>
-            <td class="${d.net >= 0 ? 'text-success' : 'text-danger'}">${d.net >= 0 ? '+' : '-'}${formatCurrency(Math.abs(d.net))}</td>
+            <td class="text-danger">${formatCurrency(d.expense)}</td>
+            <td class="${d.balance >= 0 ? 'text-success' : 'text-danger'}">${d.balance >= 0 ? '+' : '-'}${formatCurrency(Math.abs(d.balance))}</td>
             <td>${d.count}</td>
         </tr>
     `).join('');
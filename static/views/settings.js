@@ -515,86 +515,46 @@ async function deleteCategory(id) {
 
 // -- Data Management --
 
-function exportData() {
-    fetch('/api/transactions', { headers: auth.getHeaders() })
-        .then(res => res.json())
-        .then(transactions => {
-            if (!transactions.length) {
-                showToast('warning', 'No Data', 'No transactions to export');
-                return;
-            }
-            const headers = ['ID', 'Name', 'Category', 'Amount', 'Date', 'Type', 'Tags', 'Description'];
-            const rows = transactions.map(t => [
-                t.id, t.name, t.category, t.amount, t.date,
-                t.is_income ? 'Income' : 'Expense', t.tags?.join(';') || '', t.description || ''
-            ]);
-            const csv = [headers.join(','), ...rows.map(r => r.map(c => `"${String(c).replace(/"/g, '""')}"`).join(','))].join('\n');
-            const blob = new Blob([csv], { type: 'text/csv' });
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = `gider_export_${new Date().toISOString().split('T')[0]}.csv`;
-            a.click();
-            window.URL.revokeObjectURL(url);
-            showToast('success', 'Exported', `${transactions.length} transactions exported`);
-        })
-        .catch(e => showToast('error', 'Error', 'Failed to export'));
+async function exportData() {
+    try {
+        const response = await fetch('/api/download-token', { method: 'POST', headers: auth.getHeaders() });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const { token } = await response.json();
+        // Navigate to the export so the browser streams it to disk
+        const a = document.createElement('a');
+        a.href = `/api/export?format=csv&token=${encodeURIComponent(token)}`;
+        a.click();
+        showToast('success', 'Exporting', 'Your download will start shortly');
+    } catch (e) {
+        showToast('error', 'Error', 'Failed to export');
+    }
 }
 
-function importData(event) {
+async function importData(event) {
     const file = event.target.files[0];
     if (!file) return;
 
-    const reader = new FileReader();
-    reader.onload = async (e) => {
-        const text = e.target.result;
-        const lines = text.split('\n');
-        const headers = lines[0].split(',').map(h => h.trim().replace(/"/g, '').toLowerCase());
-
-        const nameIdx = headers.indexOf('name');
-        const categoryIdx = headers.indexOf('category');
-        const amountIdx = headers.indexOf('amount');
-        const dateIdx = headers.indexOf('date');
-
-        if (nameIdx === -1 || categoryIdx === -1 || amountIdx === -1 || dateIdx === -1) {
-            showToast('error', 'Invalid File', 'CSV missing required columns');
+    showToast('warning', 'Importing...', 'Please wait');
+    try {
+        // The server parses, validates and stores the whole file in one write
+        const response = await fetch('/api/import/csv', {
+            method: 'POST',
+            headers: { ...auth.getHeaders(), 'Content-Type': 'text/csv' },
+            body: file
+        });
+        const result = await response.json();
+        if (!response.ok) {
+            showToast('error', 'Invalid File', result.error || 'Import failed');
             return;
         }
-
-        let imported = 0;
-        showToast('warning', 'Importing...', 'Please wait');
-
-        for (let i = 1; i < lines.length; i++) {
-            if (!lines[i].trim()) continue;
-            // Simple CSV split handling (naive)
-            const values = lines[i].split(',').map(v => v.trim().replace(/^"|"$/g, ''));
-
-            try {
-                const amount = parseFloat(values[amountIdx]);
-                if (isNaN(amount)) continue;
-
-                const transaction = {
-                    name: values[nameIdx],
-                    category: values[categoryIdx],
-                    amount: Math.abs(amount),
-                    date: new Date(values[dateIdx]).toISOString(),
-                    is_income: amount >= 0,
-                    tags: [],
-                    description: ''
-                };
-
-                await fetch('/api/transactions', {
-                    method: 'POST',
-                    headers: auth.getHeaders(),
-                    body: JSON.stringify(transaction)
-                });
-                imported++;
-            } catch (err) { }
-        }
-        showToast('success', 'Complete', `${imported} transactions imported`);
+        const skipped = result.duplicates + result.rejected;
+        showToast('success', 'Complete', `${result.accepted} transactions imported` +
+            (skipped ? `, ${result.duplicates} duplicates and ${result.rejected} invalid rows skipped` : ''));
+    } catch (err) {
+        showToast('error', 'Error', 'Failed to import');
+    } finally {
         event.target.value = '';
-    };
-    reader.readAsText(file);
+    }
 }
 
 function confirmClearData() {
@@ -607,15 +567,13 @@ function closeClearDataModal() {
 
 async function clearAllData() {
     try {
-        const res = await fetch('/api/transactions', { headers: auth.getHeaders() });
-        const transactions = await res.json();
         showToast('warning', 'Clearing...', 'Please wait');
-        for (const t of transactions) {
-            await fetch(`/api/transactions/${t.id}`, {
-                method: 'DELETE',
-                headers: auth.getHeaders()
-            });
-        }
+        const res = await fetch('/api/transactions/bulk-delete', {
+            method: 'POST',
+            headers: auth.getHeaders(),
+            body: JSON.stringify({ all: true })
+        });
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
         closeClearDataModal();
         showToast('success', 'Cleared', 'All data deleted');
     } catch (e) {
@@ -190,14 +190,17 @@ export const TransactionsView = {
     init: async () => {
         // Load data
         await loadCategories();
-        await loadTransactions();
         loadCategorySelect();
+        resetFilters();
+        await reloadTransactionPages();
 
         // Expose functions to window for inline onclick handlers
         window.switchTab = switchTab;
         window.filterTransactions = filterTransactions;
         window.filterExpenses = filterExpenses;
         window.filterIncome = filterIncome;
+        window.loadMoreTransactions = loadMoreTransactions;
+        window.reloadTransactionPages = reloadTransactionPages;
         window.showDeleteModal = showDeleteModal;
         window.confirmDelete = confirmDelete;
         window.closeDeleteModal = closeDeleteModal;
@@ -210,27 +213,93 @@ export const TransactionsView = {
         window.closeDetailsModal = closeDetailsModal;
         window.saveTransaction = saveTransaction;
         window.setTransactionType = setTransactionType;
-
-        // Initial render
-        renderAllTabs();
     }
 };
 
 // -- Data Loading --
 
-async function loadTransactions() {
+// Each table loads pages of PAGE_SIZE rows from the server, newest first,
+// filtered by the server; "Load more" follows the X-Next-Cursor header.
+const PAGE_SIZE = 100;
+
+const lists = {
+    all: { params: {}, items: [], cursor: null },
+    expenses: { params: { is_income: 'false' }, items: [], cursor: null },
+    income: { params: { is_income: 'true' }, items: [], cursor: null }
+};
+
+// The search boxes are empty whenever the view is rendered
+function resetFilters() {
+    lists.all.params = {};
+    lists.expenses.params = { is_income: 'false' };
+    lists.income.params = { is_income: 'true' };
+}
+
+// All-time totals per type for the stat cards and charts
+let totals = null;
+
+async function loadPage(tab, reset) {
+    const list = lists[tab];
+    const query = new URLSearchParams({ limit: PAGE_SIZE });
+    Object.entries(list.params).forEach(([key, value]) => {
+        if (value) query.set(key, value);
+    });
+    if (!reset && list.cursor) query.set('cursor', list.cursor);
+
     try {
-        const response = await fetch('/api/transactions', { headers: auth.getHeaders() });
-        const json = await response.json();
-        // Update the allTransactions array from core.js
-        allTransactions.length = 0;
-        allTransactions.push(...json);
+        const response = await fetch(`/api/transactions?${query}`, { headers: auth.getHeaders() });
+        if (!response.ok) throw new Error('Failed to load transactions');
+        const page = await response.json();
+        list.items = reset ? page : list.items.concat(page);
+        list.cursor = response.headers.get('X-Next-Cursor');
+        syncLoadedTransactions();
     } catch (error) {
         console.error('Failed to load transactions:', error);
         showToast('error', 'Error', 'Failed to load transactions');
     }
 }
 
+async function loadTotals() {
+    try {
+        const response = await fetch('/api/analytics/totals', { headers: auth.getHeaders() });
+        if (response.ok) totals = await response.json();
+    } catch (error) {
+        console.error('Failed to load totals:', error);
+    }
+}
+
+// The details and edit modals in core.js look transactions up in allTransactions
+function syncLoadedTransactions() {
+    const loaded = new Map();
+    Object.values(lists).forEach(list => list.items.forEach(t => loaded.set(t.id, t)));
+    allTransactions.length = 0;
+    allTransactions.push(...loaded.values());
+}
+
+async function reloadTransactionPages() {
+    await Promise.all([loadPage('all', true), loadPage('expenses', true),
+                       loadPage('income', true), loadTotals()]);
+    renderAllTabs();
+}
+
+async function loadMoreTransactions(tab) {
+    await loadPage(tab, false);
+    if (tab === 'all') renderTable(lists.all.items);
+    else if (tab === 'expenses') renderExpensesTable(lists.expenses.items);
+    else renderIncomeTable(lists.income.items);
+}
+
+function loadMoreRow(tab, columns) {
+    if (!lists[tab].cursor) return '';
+    return `
+        <tr>
+            <td colspan="${columns}" class="text-center" style="padding: 1rem;">
+                <button class="btn btn-ghost" onclick="window.loadMoreTransactions('${tab}')">Load more</button>
+            </td>
+        </tr>
+    `;
+}
+
 let allCategories = [];
 async function loadCategories() {
     try {
@@ -282,7 +351,7 @@ function switchTab(tab) {
 // -- Rendering Tables --
 
 function renderAllTabs() {
-    renderTable(allTransactions);
+    renderTable(lists.all.items);
     renderExpensesTab();
     renderIncomeTab();
 }
@@ -303,8 +372,6 @@ function renderTable(transactions) {
         return;
     }
 
-    transactions.sort((a, b) => new Date(b.date) - new Date(a.date));
-
     tbody.innerHTML = transactions.map(t => {
         const type = t.is_income ? 'income' : 'expense';
         const iconName = getCategoryIconFromList(t.category);
@@ -338,26 +405,26 @@ function renderTable(transactions) {
                 </td>
             </tr>
         `;
-    }).join('');
+    }).join('') + loadMoreRow('all', 6);
 }
 
 function renderExpensesTab() {
-    const expenses = allTransactions.filter(t => !t.is_income);
-    updateStats('expenses', expenses);
-    renderExpensesPieChart(expenses);
-    renderExpensesTable(expenses);
+    const summary = totals?.expense;
+    updateStats('expenses', summary);
+    renderExpensesPieChart(summary?.categories || {});
+    renderExpensesTable(lists.expenses.items);
 }
 
 function renderIncomeTab() {
-    const income = allTransactions.filter(t => t.is_income);
-    updateStats('income', income);
-    renderIncomePieChart(income);
-    renderIncomeTable(income);
+    const summary = totals?.income;
+    updateStats('income', summary);
+    renderIncomePieChart(summary?.categories || {});
+    renderIncomeTable(lists.income.items);
 }
 
-function updateStats(type, items) {
-    const total = items.reduce((sum, t) => sum + Math.abs(t.amount), 0);
-    const avg = items.length > 0 ? total / items.length : 0;
+function updateStats(type, summary) {
+    const total = summary?.total || 0;
+    const avg = summary?.count ? total / summary.count : 0;
 
     const totalEl = document.getElementById(`${type}Total`);
     const avgEl = document.getElementById(`${type}Avg`);
@@ -375,8 +442,6 @@ function renderExpensesTable(expenses) {
         return;
     }
 
-    expenses.sort((a, b) => new Date(b.date) - new Date(a.date));
-
     tbody.innerHTML = expenses.map(t => {
         const iconName = getCategoryIconFromList(t.category);
         return `
@@ -391,7 +456,7 @@ function renderExpensesTable(expenses) {
                 </td>
             </tr>
         `;
-    }).join('');
+    }).join('') + loadMoreRow('expenses', 5);
 }
 
 function renderIncomeTable(income) {
@@ -403,8 +468,6 @@ function renderIncomeTable(income) {
         return;
     }
 
-    income.sort((a, b) => new Date(b.date) - new Date(a.date));
-
     tbody.innerHTML = income.map(t => {
         const iconName = getCategoryIconFromList(t.category);
         return `
@@ -419,26 +482,23 @@ function renderIncomeTable(income) {
                 </td>
             </tr>
         `;
-    }).join('');
+    }).join('') + loadMoreRow('income', 5);
 }
 
 // -- Charts --
 
-function renderExpensesPieChart(items) {
-    renderPieChart('expensesPieChart', items, expensesPieChart, (chart) => expensesPieChart = chart);
+function renderExpensesPieChart(categoryMap) {
+    renderPieChart('expensesPieChart', categoryMap, expensesPieChart, (chart) => expensesPieChart = chart);
 }
 
-function renderIncomePieChart(items) {
-    renderPieChart('incomePieChart', items, incomePieChart, (chart) => incomePieChart = chart);
+function renderIncomePieChart(categoryMap) {
+    renderPieChart('incomePieChart', categoryMap, incomePieChart, (chart) => incomePieChart = chart);
 }
 
-function renderPieChart(canvasId, items, chartInstance, setChart) {
+function renderPieChart(canvasId, categoryMap, chartInstance, setChart) {
     const ctx = document.getElementById(canvasId);
     if (!ctx) return;
 
-    const categoryMap = {};
-    items.forEach(t => categoryMap[t.category] = (categoryMap[t.category] || 0) + Math.abs(t.amount));
-
     const labels = Object.keys(categoryMap);
     const data = Object.values(categoryMap);
 
@@ -470,29 +530,33 @@ function renderPieChart(canvasId, items, chartInstance, setChart) {
 
 // -- Filters --
 
+// Filters are applied by the server; wait for a pause in typing before
+// fetching the first page again
+const filterTimers = {};
+
+function refilter(tab, params, render) {
+    clearTimeout(filterTimers[tab]);
+    filterTimers[tab] = setTimeout(async () => {
+        lists[tab].params = { ...lists[tab].params, ...params };
+        await loadPage(tab, true);
+        render(lists[tab].items);
+    }, 250);
+}
+
 function filterTransactions() {
-    const term = document.getElementById('searchInput')?.value.toLowerCase() || '';
+    const term = document.getElementById('searchInput')?.value.trim() || '';
     const cat = document.getElementById('categoryFilter')?.value || 'all';
-
-    let filtered = allTransactions;
-    if (term) filtered = filtered.filter(t => t.name.toLowerCase().includes(term));
-    if (cat !== 'all') filtered = filtered.filter(t => t.category === cat);
-
-    renderTable(filtered);
+    refilter('all', { q: term, category: cat === 'all' ? '' : cat }, renderTable);
 }
 
 function filterExpenses() {
-    const term = document.getElementById('searchInputExpenses')?.value.toLowerCase() || '';
-    let filtered = allTransactions.filter(t => !t.is_income);
-    if (term) filtered = filtered.filter(t => t.name.toLowerCase().includes(term));
-    renderExpensesTable(filtered);
+    const term = document.getElementById('searchInputExpenses')?.value.trim() || '';
+    refilter('expenses', { q: term }, renderExpensesTable);
 }
 
 function filterIncome() {
-    const term = document.getElementById('searchInputIncome')?.value.toLowerCase() || '';
-    let filtered = allTransactions.filter(t => t.is_income);
-    if (term) filtered = filtered.filter(t => t.name.toLowerCase().includes(term));
-    renderIncomeTable(filtered);
+    const term = document.getElementById('searchInputIncome')?.value.trim() || '';
+    refilter('income', { q: term }, renderIncomeTable);
 }
 
 // -- Delete Modal --
@@ -538,8 +602,7 @@ async function confirmDelete() {
         if (response.ok) {
             document.getElementById('deleteModal').classList.remove('show', 'active');
             showToast('success', 'Deleted', 'Transaction deleted');
-            await loadTransactions();
-            renderAllTabs();
+            await reloadTransactionPages();
         } else {
             throw new Error('Failed to delete');
         }
@@ -0,0 +1,917 @@
+"""Storage backends for per-user data documents.
+
+Every user owns one document with the shape::
+
+    {'transactions': [...], 'recurring_transactions': [...],
+     'categories': [...], 'notifications': [...], 'settings': {...}}
+
+Backends expose whole-document ``load``/``save`` plus row-level operations
+(``insert``, ``replace``, ``delete``, ``put_settings``) so that a single
+mutation does not have to rewrite the user's whole history when the backend
+can avoid it. ``apply`` takes several such changes, in the form stored in
+the journal, and writes them all or none of them.
+
+Loaded documents hold each collection as a ``records.RecordList`` (indexed
+by id) rather than a plain list. Parsed documents are kept in a shared
+``DocumentCache``. Documents returned
+by ``load`` may therefore be shared between requests and must be treated as
+read-only; all changes go through the storage operations, which keep the
+cached copy in step with what was written. They never change a cached
+document that readers may be iterating: the change is applied to a copy of
+the affected collections, which then replaces it in the cache.
+
+Row-level operations that would not change anything (an empty insert, a
+replace with an identical record, a delete of absent ids, unchanged
+settings) are detected and skip the write entirely; ``write_stats`` counts
+writes performed and avoided.
+
+Both backends also keep per-month transaction totals (``records.Rollups``)
+up to date with every write: ``rollups(user_id)`` returns them,
+``rebuild_rollups`` recounts them from the stored transactions and
+``check_rollups`` reports cells that disagree with a recount of the
+transactions as stored.
+
+Writers are serialized per user by ``LockManager`` (a thread lock plus an
+``fcntl`` file lock, so several worker processes can share a data
+directory) and JSON files are replaced atomically, so readers never see a
+half-written document.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process locking only
+    fcntl = None
+
+from cache import DocumentCache
+from records import (COLLECTIONS, ROLLUP_COLLECTIONS, Rollups, index_document, json_default,
+                     rollup_deltas)
+
+
+class LockManager:
+    """Named, re-entrant locks shared by threads and worker processes.
+
+    ``hold(name)`` takes an in-process lock and, where ``fcntl`` is
+    available, an exclusive ``flock`` on ``<lock_dir>/<name>.lock``.
+    Nested ``hold`` calls for the same name in one thread do not block.
+    """
+
+    def __init__(self, lock_dir):
+        self.lock_dir = Path(lock_dir)
+        self._locks = {}
+        self._guard = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def hold(self, name):
+        held = self._local.__dict__.setdefault('held', {})
+        if held.get(name):
+            held[name] += 1
+            try:
+                yield
+            finally:
+                held[name] -= 1
+            return
+        with self._guard:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            fd = self._acquire_file(name)
+            held[name] = 1
+            try:
+                yield
+            finally:
+                held[name] = 0
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+
+    @contextmanager
+    def try_hold(self, name):
+        """Like ``hold`` but never waits: yields False, without holding
+        anything, if another thread or process has the lock"""
+        with self._guard:
+            lock = self._locks.setdefault(name, threading.Lock())
+        if not lock.acquire(blocking=False):
+            yield False
+            return
+        try:
+            try:
+                fd = self._acquire_file(name, blocking=False)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+        finally:
+            lock.release()
+
+    def _acquire_file(self, name, blocking=True):
+        if fcntl is None:
+            return None
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.lock_dir / f'{name}.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+
+def write_json_atomic(path, data, **dump_kwargs):
+    """Write JSON to a temp file in the same directory and rename it over ``path``"""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{path.name}.', suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class JsonStorage:
+    """One ``data_{user_id}.json`` file per user.
+
+    By default every change rewrites the file. In journal mode row-level
+    changes are instead appended to ``data_{user_id}.journal`` (one JSON
+    record per line) and the snapshot is only rewritten when a background
+    compaction folds the journal back in once it exceeds ``compact_bytes``.
+    An existing journal is replayed on load in either mode.
+    """
+
+    name = 'json'
+
+    def __init__(self, data_dir, prepare, cache=None, locks=None, journal=False,
+                 compact_bytes=1024 * 1024):
+        self.data_dir = Path(data_dir)
+        # prepare(raw_or_None) -> document with defaults filled in
+        self.prepare = prepare
+        self.cache = cache or DocumentCache(0)
+        self.locks = locks or LockManager(self.data_dir / '.locks')
+        self.journal = journal
+        self.compact_bytes = compact_bytes
+        self.writes = 0
+        self.avoided_writes = 0
+        self._compacting = set()
+        self._compacting_lock = threading.Lock()
+
+    def path(self, user_id):
+        return self.data_dir / f'data_{user_id}.json'
+
+    def journal_path(self, user_id):
+        return self.data_dir / f'data_{user_id}.journal'
+
+    def exists(self, user_id):
+        return self.path(user_id).exists() or self.journal_path(user_id).exists()
+
+    @staticmethod
+    def _stat_version(snapshot_st, journal_st=None, journal_size=None):
+        # Every save renames a new file into place, so the inode changes too
+        if snapshot_st is None and journal_st is None:
+            return None
+        snapshot = (snapshot_st.st_ino, snapshot_st.st_mtime_ns, snapshot_st.st_size) \
+            if snapshot_st else None
+        journal = (journal_st.st_ino,
+                   journal_st.st_size if journal_size is None else journal_size) \
+            if journal_st else None
+        return (snapshot, journal)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def load(self, user_id):
+        # Open the journal before the snapshot: a compaction in between leaves
+        # us replaying an already folded-in journal, which is harmless.
+        journal = _open_or_none(self.journal_path(user_id), 'rb')
+        snapshot = _open_or_none(self.path(user_id), 'r', encoding='utf-8')
+        try:
+            snapshot_st = os.fstat(snapshot.fileno()) if snapshot else None
+            journal_st = os.fstat(journal.fileno()) if journal else None
+            version = self._stat_version(snapshot_st, journal_st)
+            if version is None:
+                return index_document(self.prepare(None))
+            data = self.cache.get(user_id, version)
+            if data is not None:
+                return data
+            data, consumed = self._parse(snapshot, journal)
+            size = snapshot_st.st_size if snapshot_st else 0
+            if journal:
+                version = self._stat_version(snapshot_st, journal_st, consumed)
+                size += consumed
+        finally:
+            for f in (journal, snapshot):
+                if f:
+                    f.close()
+        self.cache.put(user_id, version, data, size)
+        return data
+
+    def _parse(self, snapshot, journal):
+        """The document in open snapshot and journal files (either may be
+        None), and the number of journal bytes replayed"""
+        data = index_document(self.prepare(json.load(snapshot) if snapshot else None))
+        return data, replay_journal(data, journal) if journal else 0
+
+    def _read_stored(self, user_id):
+        """The document as stored on disk, parsed without the cache"""
+        journal = _open_or_none(self.journal_path(user_id), 'rb')
+        snapshot = _open_or_none(self.path(user_id), 'r', encoding='utf-8')
+        try:
+            return self._parse(snapshot, journal)[0]
+        finally:
+            for f in (journal, snapshot):
+                if f:
+                    f.close()
+
+    def save(self, user_id, data):
+        """Replace the document"""
+        self.data_dir.mkdir(exist_ok=True)
+        path = self.path(user_id)
+        with self.locks.hold(user_id):
+            write_json_atomic(path, data, indent=2, default=json_default)
+            self.writes += 1
+            # The snapshot now holds everything the journal did
+            try:
+                os.unlink(self.journal_path(user_id))
+            except FileNotFoundError:
+                pass
+            st = os.stat(path)
+            self.cache.put(user_id, self._stat_version(st), index_document(data), st.st_size)
+
+    def compact(self, user_id):
+        """Fold the user's journal into the snapshot"""
+        with self.locks.hold(user_id):
+            if self.journal_path(user_id).exists():
+                self.save(user_id, self.load(user_id))
+
+    def _compact_in_background(self, user_id):
+        with self._compacting_lock:
+            if user_id in self._compacting:
+                return
+            self._compacting.add(user_id)
+
+        def run():
+            try:
+                self.compact(user_id)
+            except Exception as e:
+                print(f"Error compacting journal for {user_id}: {e}")
+            finally:
+                with self._compacting_lock:
+                    self._compacting.discard(user_id)
+
+        threading.Thread(target=run, name=f'compact-{user_id}', daemon=True).start()
+
+    def _append(self, user_id, data, entry):
+        """Append one journal record and retag the cached document"""
+        self.data_dir.mkdir(exist_ok=True)
+        line = (_dumps(entry) + '\n').encode('utf-8')
+        fd = os.open(self.journal_path(user_id), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Writers hold the user's lock, so a line without newline at the
+            # end was torn by a crash; appending after it would corrupt both
+            _truncate_partial_line(fd)
+            view = memoryview(line)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+            journal_st = os.fstat(fd)
+        finally:
+            os.close(fd)
+        self.writes += 1
+        snapshot_st = self._stat(self.path(user_id))
+        size = (snapshot_st.st_size if snapshot_st else 0) + journal_st.st_size
+        self.cache.put(user_id, self._stat_version(snapshot_st, journal_st), data, size)
+        if journal_st.st_size > self.compact_bytes:
+            self._compact_in_background(user_id)
+
+    # Row-level operations: load-modify-write on a copy of the cached
+    # document, under the user's lock so concurrent writers cannot lose each
+    # other's changes. Without the journal the JSON file has no finer
+    # granularity than the whole document.
+
+    def _modify(self, user_id, entry):
+        with self.locks.hold(user_id):
+            data = self.load(user_id)
+            changes, result = preview_entry(data, entry)
+            if not changes:
+                self.avoided_writes += 1
+                return result
+            data = writable_copy(data, entry_collections(entry))
+            try:
+                result = apply_entry(data, entry)
+                if entry['op'] == 'batch' or (result is not False and result != 0):
+                    if self.journal:
+                        self._append(user_id, data, entry)
+                    else:
+                        self.save(user_id, data)
+            except BaseException:
+                self.cache.invalidate(user_id)
+                raise
+        return result
+
+    def insert(self, user_id, collection, records):
+        self._modify(user_id, {'op': 'insert', 'collection': collection, 'records': records})
+
+    def apply(self, user_id, entries):
+        """Apply several row-level changes (in journal form) as one journal
+        record or file write; returns their results"""
+        return self._modify(user_id, {'op': 'batch', 'entries': list(entries)})
+
+    def replace(self, user_id, collection, record):
+        """Replace the record with the same id in place; False if not found"""
+        return self._modify(user_id, {'op': 'replace', 'collection': collection, 'record': record})
+
+    def delete(self, user_id, collection, record_ids):
+        """Delete records by id and return how many were removed"""
+        return self._modify(user_id, {'op': 'delete', 'collection': collection,
+                                      'ids': list(record_ids)})
+
+    def put_settings(self, user_id, settings):
+        self._modify(user_id, {'op': 'settings', 'settings': settings})
+
+    def write_stats(self):
+        return {'writes': self.writes, 'avoided_writes': self.avoided_writes}
+
+    # The JSON document is parsed whole anyway, so its rollups live on the
+    # loaded transactions list rather than being stored a second time.
+
+    def rollups(self, user_id):
+        return self.load(user_id)['transactions'].rollups
+
+    def rebuild_rollups(self, user_id):
+        """Recount the cached rollups; like a write, on a copy of the cached
+        document that then replaces it"""
+        with self.locks.hold(user_id):
+            data = self.load(user_id)
+            version, cached = self.cache.peek(user_id)
+            if cached is not data:
+                # Not cached: the next load counts them afresh anyway
+                return
+            data = writable_copy(data, {'transactions'})
+            data['transactions'].rollups = Rollups.build(data['transactions'])
+            self.cache.retag(user_id, version, version, 0, data)
+
+    def check_rollups(self, user_id):
+        """Mismatches between the rollups kept up to date in memory and a
+        recount of the transactions read back from disk"""
+        with self.locks.hold(user_id):
+            kept = self.load(user_id)['transactions'].rollups
+            # Parsing counts the rollups of the read-back document afresh
+            return kept.diff(self._read_stored(user_id)['transactions'].rollups)
+
+
+# Record ids looked up per SELECT ... WHERE id IN (...)
+ID_QUERY_CHUNK = 500
+
+
+class SqliteStorage:
+    """All users in a single SQLite database (WAL mode), one row per record.
+
+    Records keep their JSON body in a ``body`` column; insertion order is the
+    table's rowid order, and ``UPDATE`` keeps the rowid so edited records do
+    not move. The ``rollups`` table holds a (sum, count) per user, month,
+    category and kind, adjusted in the same transaction as every write to
+    ``transactions``, so totals can be read without loading any records.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, db_path, prepare, legacy=None, cache=None, locks=None):
+        self.db_path = str(db_path)
+        self.prepare = prepare
+        # Optional JsonStorage to import users from on first access
+        self.legacy = legacy
+        self.cache = cache or DocumentCache(0)
+        # Writes are serialized by SQLite itself (BEGIN IMMEDIATE); these
+        # locks are for callers that read, decide and then write.
+        self.locks = locks or LockManager(Path(self.db_path).parent / '.locks')
+        self.writes = 0
+        self.avoided_writes = 0
+        self._local = threading.local()
+        self._init_schema()
+
+    def connect(self):
+        """Connection for the current thread.
+
+        Connections are never shared across a fork: a worker process that
+        inherited one from the server master opens its own.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        conn = self.connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS users ('
+                     'user_id TEXT PRIMARY KEY, settings TEXT NOT NULL, '
+                     'version INTEGER NOT NULL DEFAULT 0)')
+        for collection in COLLECTIONS:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {collection} ('
+                         'user_id TEXT NOT NULL, id TEXT NOT NULL, body TEXT NOT NULL, '
+                         'PRIMARY KEY (user_id, id))')
+        with self._write() as conn:
+            fresh = conn.execute("SELECT 1 FROM sqlite_master "
+                                 "WHERE type = 'table' AND name = 'rollups'").fetchone() is None
+            conn.execute('CREATE TABLE IF NOT EXISTS rollups ('
+                         'user_id TEXT NOT NULL, month TEXT NOT NULL, category TEXT NOT NULL, '
+                         'kind TEXT NOT NULL, total REAL NOT NULL, count INTEGER NOT NULL, '
+                         'PRIMARY KEY (user_id, month, category, kind))')
+            if fresh:
+                # Database from before rollups existed: count the stored history once
+                for (user_id,) in conn.execute('SELECT user_id FROM users').fetchall():
+                    self._rebuild_rollups(conn, user_id)
+
+    def _write(self):
+        """Context manager for a write transaction that takes the lock up front"""
+        return _Transaction(self.connect())
+
+    def exists(self, user_id):
+        row = self.connect().execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return row is not None
+
+    def _ensure_user(self, conn, user_id):
+        """Create the user's rows on first write, importing legacy JSON if present.
+
+        Returns the user's version before the write that is about to happen.
+        """
+        row = conn.execute('SELECT version FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        if row:
+            return row[0]
+        if self.legacy and self.legacy.exists(user_id):
+            data = self.legacy.load(user_id)
+        else:
+            data = self.prepare(None)
+        self._write_document(conn, user_id, data)
+        return None
+
+    def _bump(self, conn, user_id):
+        conn.execute('UPDATE users SET version = version + 1 WHERE user_id = ?', (user_id,))
+        return conn.execute('SELECT version FROM users WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    def _write_document(self, conn, user_id, data):
+        conn.execute('INSERT INTO users (user_id, settings) VALUES (?, ?) '
+                     'ON CONFLICT (user_id) DO UPDATE SET settings = excluded.settings',
+                     (user_id, _dumps(data.get('settings', {}))))
+        for collection in COLLECTIONS:
+            conn.execute(f'DELETE FROM {collection} WHERE user_id = ?', (user_id,))
+            conn.executemany(
+                f'INSERT OR REPLACE INTO {collection} (user_id, id, body) VALUES (?, ?, ?)',
+                [(user_id, str(r.get('id')), _dumps(r)) for r in data.get(collection, [])])
+        conn.execute('DELETE FROM rollups WHERE user_id = ?', (user_id,))
+        self._adjust_rollups(conn, user_id, data.get('transactions', []))
+
+    def _adjust_rollups(self, conn, user_id, added=(), removed=()):
+        """Apply the rollup change of replacing ``removed`` transactions with ``added``"""
+        deltas = rollup_deltas(added, removed)
+        if not deltas:
+            return
+        conn.executemany('INSERT INTO rollups (user_id, month, category, kind, total, count) '
+                         'VALUES (?, ?, ?, ?, ?, ?) '
+                         'ON CONFLICT (user_id, month, category, kind) DO UPDATE SET '
+                         'total = total + excluded.total, count = count + excluded.count',
+                         [(user_id,) + key + tuple(cell) for key, cell in deltas.items()])
+        conn.execute('DELETE FROM rollups WHERE user_id = ? AND count <= 0', (user_id,))
+
+    def _rebuild_rollups(self, conn, user_id):
+        conn.execute('DELETE FROM rollups WHERE user_id = ?', (user_id,))
+        rows = conn.execute('SELECT body FROM transactions WHERE user_id = ?', (user_id,))
+        self._adjust_rollups(conn, user_id, [json.loads(body) for (body,) in rows])
+
+    def _read_rollups(self, conn, user_id):
+        return Rollups.from_cells(conn.execute(
+            'SELECT month, category, kind, total, count FROM rollups WHERE user_id = ?',
+            (user_id,)))
+
+    def _stored_bodies(self, conn, collection, user_id, record_ids):
+        """Serialized bodies of the records that exist, by id"""
+        record_ids = list(dict.fromkeys(str(record_id) for record_id in record_ids))
+        bodies = {}
+        # A few hundred ids per query, well below SQLite's limit on parameters
+        for i in range(0, len(record_ids), ID_QUERY_CHUNK):
+            chunk = record_ids[i:i + ID_QUERY_CHUNK]
+            placeholders = ', '.join('?' * len(chunk))
+            bodies.update(conn.execute(f'SELECT id, body FROM {collection} '
+                                       f'WHERE user_id = ? AND id IN ({placeholders})',
+                                       [user_id] + chunk))
+        return bodies
+
+    def load(self, user_id):
+        conn = self.connect()
+        conn.execute('BEGIN')
+        try:
+            row = conn.execute('SELECT settings, version FROM users WHERE user_id = ?',
+                               (user_id,)).fetchone()
+            if row is None:
+                data = None
+            else:
+                data = self.cache.get(user_id, row[1])
+                if data is not None:
+                    return data
+                data, size = {'settings': json.loads(row[0])}, len(row[0])
+                for collection in COLLECTIONS:
+                    rows = conn.execute(f'SELECT body FROM {collection} WHERE user_id = ? '
+                                        'ORDER BY rowid', (user_id,))
+                    items = data[collection] = []
+                    for (body,) in rows:
+                        items.append(json.loads(body))
+                        size += len(body)
+        finally:
+            conn.execute('COMMIT')
+        if data is None:
+            if self.legacy and self.legacy.exists(user_id):
+                with self._write() as conn:
+                    self._ensure_user(conn, user_id)
+                return self.load(user_id)
+            return index_document(self.prepare(None))
+        data = index_document(self.prepare(data))
+        self.cache.put(user_id, row[1], data, size)
+        return data
+
+    def save(self, user_id, data):
+        """Replace the document"""
+        with self._write() as conn:
+            self._write_document(conn, user_id, data)
+            version = self._bump(conn, user_id)
+        self.writes += 1
+        self.cache.put(user_id, version, index_document(data), len(_dumps(data)))
+
+    def _modify(self, user_id, operations):
+        """Run the operations' writes in one transaction, then mirror them on
+        the cached copy.
+
+        An operation is ``(collection, write, change, size_delta)``.
+        ``write(conn)`` returns ``(result, changed)``; when nothing changed
+        the version is left alone, so cached copies everywhere stay valid.
+        ``change(document)`` applies the same modification to a copy of the
+        cached document (``collection`` is the one it changes, None for the
+        settings), which then replaces it; without ``change`` (or if the
+        cache is stale) the entry is dropped. Returns the results of the
+        writes.
+        """
+        results = []
+        changed = False
+        with self._write() as conn:
+            old_version = self._ensure_user(conn, user_id)
+            for _, write, _, _ in operations:
+                result, wrote = write(conn)
+                results.append(result)
+                changed = changed or wrote
+            new_version = self._bump(conn, user_id) if changed else old_version
+        if not changed:
+            self.avoided_writes += 1
+            return results
+        self.writes += 1
+        cached_version, data = self.cache.peek(user_id)
+        if any(operation[2] is None for operation in operations) or data is None or \
+                cached_version != old_version:
+            self.cache.invalidate(user_id)
+            return results
+        data = writable_copy(data, {operation[0] for operation in operations} - {None})
+        for _, _, change, _ in operations:
+            change(data)
+        self.cache.retag(user_id, old_version, new_version,
+                         sum(operation[3] for operation in operations), data)
+        return results
+
+    def _operation(self, user_id, entry):
+        """The ``_modify`` operation for a row-level change in journal form"""
+        op = entry['op']
+        if op == 'insert':
+            return self._insert_op(user_id, entry['collection'], entry['records'])
+        if op == 'replace':
+            return self._replace_op(user_id, entry['collection'], entry['record'])
+        if op == 'delete':
+            return self._delete_op(user_id, entry['collection'], entry['ids'])
+        if op == 'settings':
+            return self._settings_op(user_id, entry['settings'])
+        raise ValueError(f"Unknown journal operation: {op}")
+
+    def insert(self, user_id, collection, records):
+        if not records:
+            self.avoided_writes += 1
+            return
+        self._modify(user_id, [self._insert_op(user_id, collection, records)])
+
+    def _insert_op(self, user_id, collection, records):
+        rows = [(user_id, str(r['id']), _dumps(r)) for r in records]
+        existing = set()
+
+        def write(conn):
+            if not rows:
+                return 0, False
+            previous = self._stored_bodies(conn, collection, user_id, [row[1] for row in rows])
+            existing.update(previous)
+            changed = [row for row in rows if not _same_body(previous.get(row[1]), row[2])]
+            if not changed:
+                return len(rows), False
+            # A record whose id is already stored overwrites it in place
+            conn.executemany(f'INSERT INTO {collection} (user_id, id, body) VALUES (?, ?, ?) '
+                             'ON CONFLICT (user_id, id) DO UPDATE SET body = excluded.body', changed)
+            if collection in ROLLUP_COLLECTIONS:
+                self._adjust_rollups(conn, user_id, records,
+                                     [json.loads(body) for body in previous.values()])
+            return len(rows), True
+
+        def change(data):
+            for record in records:
+                if str(record['id']) in existing:
+                    data[collection].replace(record)
+                else:
+                    data[collection].append(record)
+
+        return collection, write, change, sum(len(row[2]) for row in rows)
+
+    def replace(self, user_id, collection, record):
+        return self._modify(user_id, [self._replace_op(user_id, collection, record)])[0]
+
+    def _replace_op(self, user_id, collection, record):
+        body = _dumps(record)
+
+        def write(conn):
+            previous = self._stored_bodies(conn, collection, user_id, [record['id']])
+            if not previous:
+                return False, False
+            if _same_body(previous[str(record['id'])], body):
+                return True, False
+            conn.execute(f'UPDATE {collection} SET body = ? WHERE user_id = ? AND id = ?',
+                         (body, user_id, str(record['id'])))
+            if collection in ROLLUP_COLLECTIONS:
+                self._adjust_rollups(conn, user_id, [record],
+                                     [json.loads(b) for b in previous.values()])
+            return True, True
+
+        return collection, write, lambda data: apply_replace(data, collection, record), 0
+
+    def delete(self, user_id, collection, record_ids):
+        record_ids = list(record_ids)
+        if not record_ids:
+            self.avoided_writes += 1
+            return 0
+        return self._modify(user_id, [self._delete_op(user_id, collection, record_ids)])[0]
+
+    def _delete_op(self, user_id, collection, record_ids):
+        record_ids = list(record_ids)
+
+        def write(conn):
+            previous = self._stored_bodies(conn, collection, user_id, set(record_ids))
+            if not previous:
+                return 0, False
+            if collection in ROLLUP_COLLECTIONS:
+                self._adjust_rollups(conn, user_id,
+                                     removed=[json.loads(b) for b in previous.values()])
+            conn.executemany(f'DELETE FROM {collection} WHERE user_id = ? AND id = ?',
+                             [(user_id, i) for i in previous])
+            return len(previous), True
+
+        return collection, write, lambda data: apply_delete(data, collection, record_ids), 0
+
+    def put_settings(self, user_id, settings):
+        self._modify(user_id, [self._settings_op(user_id, settings)])
+
+    def _settings_op(self, user_id, settings):
+        body = _dumps(settings)
+
+        def write(conn):
+            row = conn.execute('SELECT settings FROM users WHERE user_id = ?',
+                               (user_id,)).fetchone()
+            if _same_body(row[0], body):
+                return True, False
+            conn.execute('UPDATE users SET settings = ? WHERE user_id = ?', (body, user_id))
+            return True, True
+
+        return None, write, lambda data: data.__setitem__('settings', settings), 0
+
+    def apply(self, user_id, entries):
+        """Apply several row-level changes (in journal form) in one
+        transaction; returns their results"""
+        return self._modify(user_id, [self._operation(user_id, entry) for entry in entries])
+
+    def write_stats(self):
+        return {'writes': self.writes, 'avoided_writes': self.avoided_writes}
+
+    def rollups(self, user_id):
+        """Per-month transaction totals, read from the rollups table"""
+        return self._read_rollups(self.connect(), user_id)
+
+    def rebuild_rollups(self, user_id):
+        """Recount the user's rollups from the stored transactions"""
+        with self._write() as conn:
+            self._rebuild_rollups(conn, user_id)
+
+    def check_rollups(self, user_id):
+        """Mismatches between the rollups table and a recount of the transactions"""
+        conn = self.connect()
+        conn.execute('BEGIN')
+        try:
+            stored = self._read_rollups(conn, user_id)
+            rows = conn.execute('SELECT body FROM transactions WHERE user_id = ?', (user_id,))
+            expected = Rollups.build(json.loads(body) for (body,) in rows)
+        finally:
+            conn.execute('COMMIT')
+        return stored.diff(expected)
+
+
+class _Transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+def apply_entry(data, entry):
+    """Apply one row-level change, in the form stored in the journal"""
+    op = entry['op']
+    if op == 'insert':
+        return apply_insert(data, entry['collection'], entry['records'])
+    if op == 'replace':
+        return apply_replace(data, entry['collection'], entry['record'])
+    if op == 'delete':
+        return apply_delete(data, entry['collection'], entry['ids'])
+    if op == 'settings':
+        data['settings'] = entry['settings']
+        return True
+    if op == 'batch':
+        return [apply_entry(data, e) for e in entry['entries']]
+    raise ValueError(f"Unknown journal operation: {op}")
+
+
+def preview_entry(data, entry):
+    """``(changes, result)`` for a row-level change: whether applying it would
+    modify ``data``, and what applying it returns when it would not"""
+    op = entry['op']
+    if op == 'settings':
+        return data.get('settings') != entry['settings'], True
+    if op == 'batch':
+        previews = [preview_entry(data, e) for e in entry['entries']]
+        return any(changes for changes, _ in previews), [result for _, result in previews]
+    items = data[entry['collection']]
+    if op == 'insert':
+        return any(items.get(r.get('id')) != r for r in entry['records']), len(entry['records'])
+    if op == 'replace':
+        current = items.get(entry['record'].get('id'))
+        return current is not None and current != entry['record'], current is not None
+    if op == 'delete':
+        return any(record_id in items for record_id in entry['ids']), 0
+    raise ValueError(f"Unknown journal operation: {op}")
+
+
+def entry_collections(entry):
+    """Names of the collections a row-level change modifies"""
+    if entry['op'] == 'batch':
+        return {name for e in entry['entries'] for name in entry_collections(e)}
+    return {entry['collection']} if 'collection' in entry else set()
+
+
+def writable_copy(data, collections):
+    """Shallow copy of a document with its own copies of ``collections``.
+
+    The copied RecordLists share every chunk the change does not touch with
+    the cached ones, so this costs a small fraction of the collection size.
+    """
+    data = dict(data)
+    for collection in collections:
+        data[collection] = data[collection].copy()
+    return data
+
+
+def replay_journal(data, f):
+    """Apply the complete records of a binary journal file to ``data``.
+
+    Returns the number of bytes consumed; a trailing line without newline is
+    a write still in progress (or torn by a crash, which the next append cuts
+    off) and is left out. Lines that are not valid JSON are skipped with a
+    warning rather than making the whole document unreadable. Replay is
+    idempotent (an insert for an id that is already present overwrites it in
+    place), so replaying a journal that was already folded into the snapshot
+    gives the same document.
+    """
+    consumed = 0
+    for line in f:
+        if not line.endswith(b'\n'):
+            break
+        try:
+            entry = json.loads(line)
+        except ValueError as e:
+            print(f"Skipping unreadable journal line at byte {consumed} of "
+                  f"{getattr(f, 'name', 'journal')}: {e}")
+            entry = None
+        consumed += len(line)
+        if entry is not None:
+            apply_entry(data, entry)
+    return consumed
+
+
+def _truncate_partial_line(fd, chunk_size=4096):
+    """Cut an unterminated last line off the file open as ``fd``"""
+    size = os.fstat(fd).st_size
+    if size == 0 or os.pread(fd, 1, size - 1) == b'\n':
+        return
+    end = size
+    keep = 0
+    while end > 0:
+        start = max(0, end - chunk_size)
+        newline = os.pread(fd, end - start, start).rfind(b'\n')
+        if newline >= 0:
+            keep = start + newline + 1
+            break
+        end = start
+    os.ftruncate(fd, keep)
+
+
+def apply_insert(data, collection, records):
+    """Append records; one whose id is already present replaces it in place"""
+    items = data[collection]
+    for record in records:
+        if not items.replace(record):
+            items.append(record)
+    return len(records)
+
+
+def apply_replace(data, collection, record):
+    return data[collection].replace(record)
+
+
+def apply_delete(data, collection, record_ids):
+    return data[collection].remove_ids(record_ids)
+
+
+def _open_or_none(path, mode, **kwargs):
+    try:
+        return open(path, mode, **kwargs)
+    except FileNotFoundError:
+        return None
+
+
+def _same_body(stored, body):
+    """Whether two serialized records are equal, ignoring key order"""
+    return stored == body or (stored is not None and json.loads(stored) == json.loads(body))
+
+
+def _dumps(value):
+    return json.dumps(value, default=json_default, separators=(',', ':'))
+
+
+def create_storage(backend, data_dir, prepare, sqlite_path=None, cache=None, locks=None,
+                   journal=False, compact_bytes=1024 * 1024):
+    """Build the storage backend selected by name ('json' or 'sqlite')"""
+    locks = locks or LockManager(Path(data_dir) / '.locks')
+    if backend == 'json':
+        return JsonStorage(data_dir, prepare, cache=cache, locks=locks, journal=journal,
+                           compact_bytes=compact_bytes)
+    if backend == 'sqlite':
+        return SqliteStorage(sqlite_path or Path(data_dir) / 'gider.db', prepare,
+                             legacy=JsonStorage(data_dir, prepare, locks=locks),
+                             cache=cache, locks=locks)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def migrate_json_to_sqlite(source, target, user_ids=None):
+    """Copy every data_* document from a JsonStorage into a SqliteStorage.
+
+    Users already present in the database are skipped, so the migration can be
+    re-run safely. Returns the list of migrated user ids.
+    """
+    if user_ids is None:
+        user_ids = sorted({p.stem[len('data_'):] for pattern in ('data_*.json', 'data_*.journal')
+                           for p in source.data_dir.glob(pattern)})
+    migrated = []
+    for user_id in user_ids:
+        if target.exists(user_id) or not source.exists(user_id):
+            continue
+        target.save(user_id, source.load(user_id))
+        migrated.append(user_id)
+    return migrated
@@ -0,0 +1,61 @@
+"""Shared fixtures: the app on a throwaway data directory with the stub model."""
+import io
+import os
+import uuid
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The ``app`` module, imported with ``./data`` inside a temporary directory"""
+    os.chdir(tmp_path_factory.mktemp('gider'))
+    os.environ.update(RECEIPT_MODEL='stub', RECEIPT_CACHE_MB='0')
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    """A test client and the auth headers of a newly registered user"""
+    client = app_module.app.test_client()
+    credentials = {'username': f'user-{uuid.uuid4().hex[:12]}', 'password': 'password123'}
+    assert client.post('/api/auth/register', json=credentials).status_code in (200, 201)
+    token = client.post('/api/auth/login', json=credentials).get_json()['token']
+    return client, {'Authorization': f'Bearer {token}'}
+
+
+@pytest.fixture
+def jpeg():
+    """Builds a small JPEG; different seeds give different bytes"""
+    def build(seed=0):
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 48), (seed * 37 % 256, seed * 11 % 256, 90)).save(buffer, 'JPEG')
+        return buffer.getvalue()
+    return build
+
+
+@pytest.fixture
+def use_model(app_module, monkeypatch):
+    """Makes the app scan with the given model, e.g. a configured StubModel"""
+    import gemini
+    import scanners
+
+    def use(model, **options):
+        pool = gemini.ModelPool(lambda api_key: model, **options)
+        monkeypatch.setitem(app_module.receipt_scanners, 'gemini', scanners.GeminiScanner(pool))
+        return pool
+    return use
+
+
+@pytest.fixture
+def use_scan_jobs(app_module, monkeypatch, tmp_path):
+    """Gives the app a fresh ScanJobs with the given limits"""
+    import receipts
+
+    def use(**options):
+        jobs = receipts.ScanJobs(tmp_path / 'scan_jobs', **options)
+        monkeypatch.setattr(app_module, 'scan_jobs', jobs)
+        return jobs
+    return use
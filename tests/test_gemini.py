@@ -0,0 +1,154 @@
+"""ModelPool retries and backoff, and the circuit breaker, driven by the stub model."""
+import json
+import time
+
+import pytest
+
+import gemini
+from receipts import StubModel
+
+
+class Unavailable(Exception):
+    code = 503
+
+
+class BadRequest(Exception):
+    code = 400
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Backoff sleeps of the pool, recorded instead of slept, without jitter"""
+    slept = []
+    monkeypatch.setattr(gemini.time, 'sleep', slept.append)
+    monkeypatch.setattr(gemini.random, 'uniform', lambda low, high: high)
+    return slept
+
+
+def pool_for(model, **options):
+    return gemini.ModelPool(lambda api_key: model, **options)
+
+
+def test_transient_errors_are_retried_with_exponential_backoff(sleeps):
+    model = StubModel(failures=[Unavailable('busy'), TimeoutError('slow'), ConnectionError('reset')])
+    pool = pool_for(model, retries=3, backoff=0.5, max_backoff=1.5)
+
+    assert json.loads(pool.generate('key', ['prompt']))['total'] == 10.0
+    assert model.calls == 4
+    assert sleeps == [0.5, 1.0, 1.5]
+    assert pool.stats()['retries'] == 3
+    assert pool.stats()['failures'] == 0
+
+
+def test_retries_give_up_after_the_limit(sleeps):
+    model = StubModel(failures=[Unavailable('busy')] * 5)
+    pool = pool_for(model, retries=2, backoff=0.1)
+
+    with pytest.raises(Unavailable):
+        pool.generate('key', ['prompt'])
+    assert model.calls == 3
+    assert len(sleeps) == 2
+    assert pool.stats()['failures'] == 1
+
+
+def test_other_errors_are_not_retried(sleeps):
+    model = StubModel(failures=[BadRequest('bad key')])
+    pool = pool_for(model, retries=2)
+
+    with pytest.raises(BadRequest):
+        pool.generate('key', ['prompt'])
+    assert model.calls == 1
+    assert sleeps == []
+    # Not the upstream's fault: the breaker does not count it
+    assert pool.breaker.state == 'closed'
+
+
+def test_the_timeout_is_passed_with_each_request():
+    seen = []
+
+    class Recording(StubModel):
+        def generate_content(self, parts, request_options=None):
+            seen.append(request_options)
+            return super().generate_content(parts, request_options)
+
+    pool_for(Recording(), timeout=7).generate('key', ['prompt'])
+    assert seen == [{'timeout': 7, 'retry': None}]
+
+
+def test_clients_are_reused_per_key_and_capped():
+    made = []
+
+    def factory(api_key):
+        made.append(api_key)
+        return StubModel()
+
+    pool = gemini.ModelPool(factory, max_clients=2)
+    for api_key in ('a', 'a', 'b', 'c', 'a'):
+        pool.generate(api_key, ['prompt'])
+    assert made == ['a', 'b', 'c', 'a']
+    assert pool.stats()['clients'] == 2
+
+
+def test_breaker_opens_then_half_opens_then_closes():
+    model = StubModel(failures=[Unavailable('down')] * 3)
+    pool = pool_for(model, retries=0, breaker=gemini.CircuitBreaker(failures=2, reset_timeout=0.2))
+
+    for _ in range(2):
+        with pytest.raises(Unavailable):
+            pool.generate('key', ['prompt'])
+    assert pool.breaker.state == 'open'
+
+    # Refused without calling the model while open
+    with pytest.raises(gemini.CircuitOpen):
+        pool.generate('key', ['prompt'])
+    assert model.calls == 2
+    assert pool.stats()['rejected'] == 1
+
+    time.sleep(0.25)
+    assert pool.breaker.state == 'half-open'
+    # A failed trial call opens it again for another reset_timeout
+    with pytest.raises(Unavailable):
+        pool.generate('key', ['prompt'])
+    assert pool.breaker.state == 'open'
+
+    time.sleep(0.25)
+    assert json.loads(pool.generate('key', ['prompt']))['total'] == 10.0
+    assert pool.breaker.state == 'closed'
+    assert model.calls == 4
+
+
+def test_half_open_breaker_lets_one_trial_call_through():
+    breaker = gemini.CircuitBreaker(failures=1, reset_timeout=0.1)
+    breaker.allow()
+    breaker.record(False)
+    time.sleep(0.15)
+
+    breaker.allow()
+    with pytest.raises(gemini.CircuitOpen):
+        breaker.allow()
+    breaker.record(True)
+    assert breaker.state == 'closed'
+    breaker.allow()
+
+
+def test_each_key_gets_a_client_of_its_own():
+    pytest.importorskip('google.generativeai')
+    first = gemini.gemini_model('key-1', 'gemini-test')
+    second = gemini.gemini_model('key-2', 'gemini-test')
+    assert first._client is not None
+    assert first._client is not second._client
+
+
+def test_without_per_key_clients_only_one_key_is_configured(monkeypatch):
+    genai = pytest.importorskip('google.generativeai')
+    import google.generativeai.client as client
+    configured = []
+    monkeypatch.delattr(client, '_ClientManager')
+    monkeypatch.setattr(genai, 'configure', lambda api_key: configured.append(api_key))
+    monkeypatch.setattr(gemini, '_configured_key', None)
+
+    gemini.gemini_model('key-1', 'gemini-test')
+    gemini.gemini_model('key-1', 'gemini-test')
+    with pytest.raises(RuntimeError, match='only one Gemini API key'):
+        gemini.gemini_model('key-2', 'gemini-test')
+    assert configured == ['key-1']
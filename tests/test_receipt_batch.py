@@ -0,0 +1,182 @@
+"""Batch scans: admission against the scan limits, concurrency and cleanup."""
+import base64
+import io
+import json
+import threading
+import time
+
+from receipts import StubModel
+
+
+def post_batch(client, headers, images, query=''):
+    files = [(io.BytesIO(data), f'{index}.jpg', 'image/jpeg') for index, data in enumerate(images)]
+    return client.post(f'/api/scan-receipt/batch{query}', data={'images': files},
+                       headers=headers, content_type='multipart/form-data')
+
+
+def read_lines(response):
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return lines[:-1], lines[-1]['summary']
+
+
+class Concurrency(StubModel):
+    """Stub that records how many calls were in progress at once"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._guard = threading.Lock()
+        self.active = self.peak = 0
+
+    def generate_content(self, parts, request_options=None):
+        with self._guard:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            return super().generate_content(parts, request_options)
+        finally:
+            with self._guard:
+                self.active -= 1
+
+
+def test_every_image_counts_against_the_rate_limit(client, use_scan_jobs, jpeg):
+    client, headers = client
+    jobs = use_scan_jobs(rate_limit=3)
+
+    lines, summary = read_lines(post_batch(client, headers, [jpeg(i) for i in range(5)]))
+    assert summary == {'done': 3, 'failed': 2}
+    skipped = [line for line in lines if line['status'] == 'failed']
+    assert [line['index'] for line in skipped] == [3, 4]
+    assert all(line['error'].startswith('Not scanned') for line in skipped)
+    assert jobs.stats()['submitted'] == 3
+    assert jobs.stats()['pending'] == 0
+
+    response = post_batch(client, headers, [jpeg()])
+    assert response.status_code == 429
+    assert response.headers['Retry-After']
+    # A single job is refused too: both share the limit
+    response = client.post('/api/scan-receipt/jobs', data=jpeg(), headers=headers,
+                           content_type='image/jpeg')
+    assert response.status_code == 429
+
+
+def test_full_queue_answers_503(client, use_scan_jobs, jpeg):
+    client, headers = client
+    use_scan_jobs(max_pending=0)
+    response = post_batch(client, headers, [jpeg()])
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+
+
+def test_unreadable_images_do_not_use_the_rate_limit(client, use_scan_jobs, jpeg):
+    client, headers = client
+    jobs = use_scan_jobs(rate_limit=1)
+    response = client.post('/api/scan-receipt/batch',
+                           json={'images': ['not base64!', 5, base64.b64encode(jpeg()).decode()]},
+                           headers=headers)
+    lines, summary = read_lines(response)
+    assert summary == {'done': 1, 'failed': 2}
+    assert jobs.stats()['submitted'] == 1
+
+
+def test_images_run_on_the_shared_pool_within_the_batch_limit(app_module, client, use_model,
+                                                               use_scan_jobs, jpeg, monkeypatch):
+    client, headers = client
+    model = Concurrency(delay=0.05)
+    use_model(model)
+    jobs = use_scan_jobs(workers=4, rate_limit=0)
+    monkeypatch.setattr(app_module, 'SCAN_BATCH_CONCURRENCY', 2)
+
+    lines, summary = read_lines(post_batch(client, headers, [jpeg(i) for i in range(6)]))
+    assert summary == {'done': 6, 'failed': 0}
+    assert sorted(line['index'] for line in lines) == list(range(6))
+    assert model.peak == 2
+    assert jobs.stats()['done'] == 6
+
+
+def test_failed_scans_are_reported_and_settled(client, use_model, use_scan_jobs, jpeg):
+    client, headers = client
+    use_model(StubModel(failures=[ValueError('unreadable')]), retries=0)
+    jobs = use_scan_jobs()
+
+    lines, summary = read_lines(post_batch(client, headers, [jpeg(1), jpeg(2)], '?create=true'))
+    assert summary['done'] == 1
+    assert summary['failed'] == 1
+    assert summary['created'] == 1
+    assert [line['error'] for line in lines if line['status'] == 'failed'] == \
+        ['Failed to scan receipt: unreadable']
+    assert jobs.stats()['pending'] == 0
+    assert jobs.stats()['failed'] == 1
+
+
+def test_closing_the_response_unread_releases_reservations(app_module, client, use_scan_jobs,
+                                                           jpeg):
+    _, headers = client
+    jobs = use_scan_jobs(rate_limit=0)
+    files = [(io.BytesIO(jpeg(i)), f'{i}.jpg', 'image/jpeg') for i in range(3)]
+    with app_module.app.test_request_context('/api/scan-receipt/batch', method='POST',
+                                             headers=headers, data={'images': files},
+                                             content_type='multipart/form-data'):
+        response = app_module.scan_receipt_batch()
+        assert jobs.stats()['pending'] == 3
+        response.close()
+    assert jobs.stats()['pending'] == 0
+    assert jobs.stats()['done'] == 0
+
+
+def test_stopping_midway_cancels_the_images_not_started(client, use_model, use_scan_jobs, jpeg,
+                                                       app_module, monkeypatch):
+    _, headers = client
+    use_model(StubModel(delay=0.05))
+    jobs = use_scan_jobs(workers=1, rate_limit=0)
+    monkeypatch.setattr(app_module, 'SCAN_BATCH_CONCURRENCY', 2)
+    files = [(io.BytesIO(jpeg(i)), f'{i}.jpg', 'image/jpeg') for i in range(5)]
+    with app_module.app.test_request_context('/api/scan-receipt/batch', method='POST',
+                                             headers=headers, data={'images': files},
+                                             content_type='multipart/form-data'):
+        response = app_module.scan_receipt_batch()
+        lines = iter(response.response)
+        assert json.loads(next(lines))['status'] == 'done'
+        response.close()
+
+    # The three images not started were given back; the one in flight
+    # when the response closed finishes or is cancelled
+    assert jobs.stats()['pending'] <= 1
+    deadline = time.monotonic() + 5
+    while jobs.stats()['pending'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats = jobs.stats()
+    assert stats['pending'] == 0
+    assert stats['submitted'] == 5
+    assert stats['done'] + stats['failed'] == 2
+
+
+def test_oversized_batch_is_refused_before_parsing(app_module, client, use_scan_jobs,
+                                                   monkeypatch):
+    client, headers = client
+    jobs = use_scan_jobs()
+    monkeypatch.setattr(app_module, 'SCAN_BATCH_MAX', 2)
+    monkeypatch.setattr(app_module, 'RECEIPT_MAX_UPLOAD_MB', 0.01)
+    body = json.dumps({'images': ['A' * 50000] * 2}).encode()
+
+    response = client.post('/api/scan-receipt/batch', data=body, headers=headers,
+                           content_type='application/json')
+    assert response.status_code == 413
+
+    # Without a Content-Length the body is read only up to the limit
+    response = client.post('/api/scan-receipt/batch', input_stream=io.BytesIO(body),
+                           headers=headers, content_type='application/json',
+                           environ_overrides={'CONTENT_LENGTH': '', 'wsgi.input_terminated': True})
+    assert response.status_code == 413
+    assert jobs.stats()['submitted'] == 0
+
+
+def test_oversized_image_in_a_batch_fails_alone(app_module, client, use_scan_jobs, jpeg,
+                                               monkeypatch):
+    client, headers = client
+    use_scan_jobs()
+    monkeypatch.setattr(app_module, 'RECEIPT_MAX_UPLOAD_MB', 0.01)
+    response = client.post('/api/scan-receipt/batch', headers=headers,
+                           json={'images': [base64.b64encode(jpeg()).decode(), 'A' * 20000]})
+    lines, summary = read_lines(response)
+    assert summary == {'done': 1, 'failed': 1}
+    assert lines[0]['error'].startswith('Image is larger than')
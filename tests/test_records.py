@@ -0,0 +1,87 @@
+"""RecordList indexes, and copies that share unchanged chunks with the original."""
+import random
+
+import pytest
+
+import records
+from records import RecordList, Rollups
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # Small chunks and few shards, so a handful of records spans many of them
+    monkeypatch.setattr(records, 'CHUNK', 4)
+    monkeypatch.setattr(records, 'SHARDS', 3)
+
+
+def transaction(number, month=1, amount=10, category='Food'):
+    return {'id': f't{number}', 'date': f'2024-{month:02d}-{number % 28 + 1:02d}',
+            'amount': amount, 'category': category}
+
+
+def transactions(items=()):
+    return RecordList(items, records.SORT_KEYS['transactions'], Rollups())
+
+
+def sorted_ids(items, **options):
+    return [cursor[1] for cursor, _ in items.iter_sorted(**options)]
+
+
+def test_sorted_index_spans_chunks():
+    rng = random.Random(7)
+    items = transactions()
+    stored = [transaction(n, month=rng.randint(1, 12)) for n in range(60)]
+    for record in stored:
+        items.append(record)
+    items.remove_ids([f't{n}' for n in range(0, 60, 3)])
+    for n in range(1, 60, 3):
+        items.replace(transaction(n, month=rng.randint(1, 12)))
+
+    expected = sorted((r['date'], r['id']) for r in items)
+    assert [(c[0], c[1]) for c, _ in items.iter_sorted()] == expected
+    assert sorted_ids(items, reverse=True) == [i for _, i in reversed(expected)]
+    in_range = [i for d, i in expected if '2024-03-01' <= d <= '2024-06-31']
+    assert sorted_ids(items, start='2024-03-01', end='2024-06-31') == in_range
+    cursor = expected[17]
+    assert sorted_ids(items, after=cursor) == [i for _, i in expected[18:]]
+    assert sorted_ids(items, after=cursor, reverse=True) == [i for _, i in reversed(expected[:17])]
+
+
+def test_changes_to_a_copy_leave_the_original_alone():
+    original = transactions(transaction(n, month=n % 3 + 1) for n in range(30))
+    before = (original.to_list(), sorted_ids(original), sorted(original.rollups.cells()))
+
+    copy = original.copy()
+    copy.append(transaction(100, month=5, category='Rent'))
+    copy.replace(transaction(3, month=9, amount=99))
+    copy.remove_ids(['t4', 't5', 't6'])
+
+    assert (original.to_list(), sorted_ids(original), sorted(original.rollups.cells())) == before
+    assert 't4' in original and 't4' not in copy
+    assert original.get('t3')['amount'] == 10
+    assert copy.get('t3')['amount'] == 99
+    assert len(copy) == 28
+    assert not copy.rollups.diff(Rollups.build(copy))
+    assert not original.rollups.diff(Rollups.build(original))
+
+    # Further changes to the original do not reach the copy either
+    original.remove_ids(['t0'])
+    assert 't0' in copy
+
+
+def test_copy_shares_unchanged_chunks():
+    original = transactions(transaction(n) for n in range(40))
+    copy = original.copy()
+    copy.replace(transaction(1, amount=5))
+    shared = sum(a is b for a, b in zip(original._chunks, copy._chunks))
+    assert shared == len(original._chunks) - 1
+
+
+def test_key_counts_of_copies_are_separate():
+    notification = {'id': 'n1', 'type': 'recurring', 'recurring_id': 'r1',
+                    'notification_date': '2024-01-01'}
+    original = RecordList([notification], key_func=records.recurring_notification_key)
+    copy = original.copy()
+    copy.remove_ids(['n1'])
+    assert original.has_key(('r1', '2024-01-01'))
+    assert not copy.has_key(('r1', '2024-01-01'))
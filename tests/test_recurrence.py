@@ -0,0 +1,40 @@
+"""Occurrence dates of recurring rules."""
+from datetime import date
+
+from recurrence import Rule
+
+
+def test_marker_before_start_in_the_start_month_keeps_the_first_occurrence():
+    rule = Rule(date(2024, 5, 10), frequency='monthly')
+    assert rule.index_after(date(2024, 5, 5)) == 0
+    assert rule.between(date(2024, 5, 5), date(2024, 6, 30)) == [date(2024, 5, 10), date(2024, 6, 10)]
+
+
+def test_marker_on_or_after_start_counts_its_month_as_done():
+    rule = Rule(date(2024, 5, 10), frequency='monthly')
+    assert rule.between(date(2024, 5, 10), date(2024, 6, 30)) == [date(2024, 6, 10)]
+    assert rule.between(date(2024, 5, 20), date(2024, 6, 30)) == [date(2024, 6, 10)]
+
+
+def test_drifted_marker_of_a_month_end_rule_is_not_charged_twice():
+    # The old engine left the marker on Feb 29 for a rule on the 31st
+    rule = Rule(date(2024, 1, 31), frequency='monthly')
+    assert rule.between(date(2024, 2, 29), date(2024, 4, 30)) == [date(2024, 3, 31), date(2024, 4, 30)]
+
+
+def test_yearly_rule_with_marker_before_start():
+    rule = Rule(date(2024, 5, 10), frequency='yearly')
+    assert rule.between(date(2024, 1, 1), date(2025, 6, 1)) == [date(2024, 5, 10), date(2025, 5, 10)]
+
+
+def test_day_based_rules():
+    rule = Rule(date(2024, 5, 10), frequency='weekly')
+    assert rule.between(date(2024, 5, 1), date(2024, 5, 24)) == \
+        [date(2024, 5, 10), date(2024, 5, 17), date(2024, 5, 24)]
+    assert rule.between(date(2024, 5, 12), date(2024, 5, 24)) == [date(2024, 5, 17), date(2024, 5, 24)]
+
+
+def test_end_date_stops_occurrences():
+    rule = Rule(date(2024, 1, 31), end=date(2024, 3, 15), frequency='monthly')
+    assert rule.between(None, date(2024, 12, 31)) == [date(2024, 1, 31), date(2024, 2, 29)]
+    assert rule.next_after(date(2024, 2, 29)) is None
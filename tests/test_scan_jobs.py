@@ -0,0 +1,184 @@
+"""ScanJobs: the job lifecycle, the per-user rate limit and the queue bound."""
+import threading
+import time
+
+import pytest
+
+import receipts
+from receipts import StubModel
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def poll(client, headers, job_id, *statuses):
+    job = {}
+
+    def reached():
+        job.update(client.get(f'/api/scan-receipt/jobs/{job_id}', headers=headers).get_json())
+        return job['status'] in statuses
+    wait_for(reached)
+    return job
+
+
+def test_job_goes_from_queued_to_running_to_done(client, use_model, use_scan_jobs, jpeg):
+    client, headers = client
+    model = StubModel(delay=0.3)
+    use_model(model)
+    jobs = use_scan_jobs(workers=1)
+
+    response = client.post('/api/scan-receipt/jobs', data=jpeg(), headers=headers,
+                           content_type='image/jpeg')
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job['status'] == 'queued'
+    assert response.headers['Location'] == f"/api/scan-receipt/jobs/{job['id']}"
+
+    running = poll(client, headers, job['id'], 'running', 'done')
+    assert running['status'] == 'running'
+    assert running['started_at'] and running['result'] is None
+
+    done = poll(client, headers, job['id'], 'done')
+    assert done['result']['total'] == 10.0
+    assert done['finished_at']
+    assert model.calls == 1
+    wait_for(lambda: jobs.stats()['pending'] == 0)
+    assert jobs.stats()['done'] == 1
+
+
+def test_failed_scan_marks_the_job_failed(client, use_model, use_scan_jobs, jpeg):
+    client, headers = client
+    use_model(StubModel(failures=[ValueError('unreadable')]))
+    jobs = use_scan_jobs()
+
+    job = client.post('/api/scan-receipt/jobs', data=jpeg(), headers=headers,
+                      content_type='image/jpeg').get_json()
+    failed = poll(client, headers, job['id'], 'failed')
+    assert failed['error'] == 'Failed to scan receipt: unreadable'
+    wait_for(lambda: jobs.stats()['pending'] == 0)
+    assert jobs.stats()['failed'] == 1
+
+
+def test_jobs_are_private_to_their_user(app_module, client, use_scan_jobs, jpeg):
+    client, headers = client
+    use_scan_jobs()
+    job = client.post('/api/scan-receipt/jobs', data=jpeg(), headers=headers,
+                      content_type='image/jpeg').get_json()
+
+    other = app_module.app.test_client()
+    credentials = {'username': f"other-{job['id'][:8]}", 'password': 'password123'}
+    other.post('/api/auth/register', json=credentials)
+    token = other.post('/api/auth/login', json=credentials).get_json()['token']
+    response = other.get(f"/api/scan-receipt/jobs/{job['id']}",
+                         headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 404
+    assert client.get('/api/scan-receipt/jobs/not-a-uuid', headers=headers).status_code == 404
+
+
+def test_rate_limit_answers_429_with_retry_after(client, use_scan_jobs, jpeg):
+    client, headers = client
+    jobs = use_scan_jobs(rate_limit=2, rate_window=60)
+
+    for seed in range(2):
+        response = client.post('/api/scan-receipt/jobs', data=jpeg(seed), headers=headers,
+                               content_type='image/jpeg')
+        assert response.status_code == 202
+    response = client.post('/api/scan-receipt/jobs', data=jpeg(2), headers=headers,
+                           content_type='image/jpeg')
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= 61
+    assert jobs.stats()['rate_limited'] == 1
+
+
+def test_rate_limit_is_per_user_and_window(tmp_path):
+    jobs = receipts.ScanJobs(tmp_path, rate_limit=2, rate_window=0.3)
+    for _ in range(2):
+        jobs.submit('alice', lambda: None)
+    with pytest.raises(receipts.RateLimited):
+        jobs.submit('alice', lambda: None)
+    jobs.submit('bob', lambda: None)
+
+    time.sleep(0.35)
+    jobs.submit('alice', lambda: None)
+
+
+def test_full_queue_refuses_without_using_the_rate_limit(tmp_path):
+    jobs = receipts.ScanJobs(tmp_path, workers=1, max_pending=1, rate_limit=2)
+    release = threading.Event()
+    jobs.submit('alice', release.wait)
+
+    with pytest.raises(receipts.QueueFull):
+        jobs.submit('alice', lambda: None)
+    release.set()
+    wait_for(lambda: jobs.stats()['pending'] == 0)
+
+    # The refused submission did not count against alice's two scans
+    jobs.submit('alice', lambda: None)
+    assert jobs.stats()['queue_full'] == 1
+    assert jobs.stats()['submitted'] == 2
+
+
+def test_queue_full_answers_503(client, use_scan_jobs, jpeg):
+    client, headers = client
+    use_scan_jobs(max_pending=0)
+    response = client.post('/api/scan-receipt/jobs', data=jpeg(), headers=headers,
+                           content_type='image/jpeg')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+
+
+def test_reserve_admits_what_the_limits_allow(tmp_path):
+    jobs = receipts.ScanJobs(tmp_path, max_pending=4, rate_limit=3)
+    assert jobs.reserve('alice', 5) == 3
+    with pytest.raises(receipts.RateLimited):
+        jobs.reserve('alice')
+    # Each user has a rate limit of their own; the queue is shared
+    assert jobs.reserve('bob', 5) == 1
+    with pytest.raises(receipts.QueueFull):
+        jobs.reserve('carol')
+
+    jobs.release(3)
+    assert jobs.stats()['pending'] == 1
+
+
+def test_run_settles_reservations_when_scans_finish(tmp_path):
+    jobs = receipts.ScanJobs(tmp_path, workers=2)
+    assert jobs.reserve('alice', 2) == 2
+    done = jobs.run(lambda: 'ok')
+    failed = jobs.run(StubModel(failures=[ValueError('bad')]).generate_content, [])
+
+    assert done.result() == 'ok'
+    with pytest.raises(ValueError):
+        failed.result()
+    wait_for(lambda: jobs.stats()['pending'] == 0)
+    assert jobs.stats()['done'] == 1
+    assert jobs.stats()['failed'] == 1
+
+
+def test_upload_is_closed_when_queueing_fails(app_module, client, use_scan_jobs, jpeg,
+                                              monkeypatch):
+    _, headers = client
+    jobs = use_scan_jobs()
+    uploads = []
+    spool_stream = receipts.spool_stream
+
+    def spool(stream, max_bytes):
+        uploads.append(spool_stream(stream, max_bytes))
+        return uploads[-1]
+
+    def write(job):
+        raise OSError('disk full')
+    monkeypatch.setattr(receipts, 'spool_stream', spool)
+    monkeypatch.setattr(jobs, '_write', write)
+
+    with app_module.app.test_request_context('/api/scan-receipt/jobs', method='POST',
+                                             headers=headers, data=jpeg(),
+                                             content_type='image/jpeg'):
+        with pytest.raises(OSError):
+            app_module.create_scan_job()
+    assert len(uploads) == 1 and uploads[0].closed
+    assert jobs.stats()['pending'] == 0
@@ -0,0 +1,36 @@
+"""Recurring scheduler: daily sweeps shared between worker processes."""
+from scheduler import RecurringScheduler
+
+
+def scheduler(state_path, processed):
+    return RecurringScheduler(processed.append, user_ids=lambda: ['u1', 'u2'],
+                              state_path=state_path)
+
+
+def test_request_after_another_process_swept_skips_the_user(tmp_path):
+    state_path = tmp_path / 'scheduler.json'
+    sweeper_calls, worker_calls = [], []
+    sweeper = scheduler(state_path, sweeper_calls)
+    worker = scheduler(state_path, worker_calls)
+
+    # Before the sweep the request handles its own user
+    worker.ensure_processed('u1')
+    assert worker_calls == ['u1']
+
+    assert sweeper.tick()['users'] == 2
+    assert sorted(sweeper_calls) == ['u1', 'u2']
+
+    # The worker has not ticked since, but the state file says today is done
+    worker.ensure_processed('u2')
+    assert worker_calls == ['u1']
+    assert worker.tick() is None
+
+
+def test_stale_state_file_still_processes_per_user(tmp_path):
+    state_path = tmp_path / 'scheduler.json'
+    state_path.write_text('{"swept_on": "2000-01-01"}')
+    calls = []
+    worker = scheduler(state_path, calls)
+    worker.ensure_processed('u1')
+    worker.ensure_processed('u1')
+    assert calls == ['u1']
@@ -0,0 +1,108 @@
+"""Storage backends: row-level writes, batches and rollups."""
+import pytest
+
+import storage
+from cache import DocumentCache
+
+
+def prepare(data):
+    data = dict(data or {})
+    for collection in storage.COLLECTIONS:
+        data.setdefault(collection, [])
+    data.setdefault('settings', {})
+    return data
+
+
+@pytest.fixture(params=['json', 'journal', 'sqlite'])
+def store(request, tmp_path):
+    backend = 'sqlite' if request.param == 'sqlite' else 'json'
+    return storage.create_storage(backend, tmp_path, prepare, tmp_path / 'gider.db',
+                                  cache=DocumentCache(64 * 1024 * 1024),
+                                  journal=request.param == 'journal')
+
+
+def transaction(number, amount=10, month=1):
+    return {'id': f't{number}', 'date': f'2024-{month:02d}-01', 'amount': amount,
+            'category': 'Food', 'is_income': False}
+
+
+def test_bulk_writes_look_up_stored_rows_in_chunks(tmp_path):
+    store = storage.SqliteStorage(tmp_path / 'gider.db', prepare)
+    store.insert('u1', 'transactions', [transaction(n) for n in range(1200)])
+    selects = []
+    store.connect().set_trace_callback(
+        lambda sql: selects.append(sql) if sql.startswith('SELECT id, body') else None)
+
+    assert store.delete('u1', 'transactions', [f't{n}' for n in range(1100)] + ['missing']) == 1100
+    store.insert('u1', 'transactions', [transaction(n, amount=5) for n in range(1050, 1200)])
+    store.connect().set_trace_callback(None)
+
+    assert len(selects) == 3 + 1
+    transactions = store.load('u1')['transactions']
+    assert len(transactions) == 150
+    assert transactions.get('t1060')['amount'] == 5
+    assert store.check_rollups('u1') == []
+
+
+def test_writes_show_up_in_later_loads(store):
+    store.insert('u1', 'transactions', [transaction(n) for n in range(5)])
+    assert store.replace('u1', 'transactions', transaction(2, amount=20)) is True
+    assert store.replace('u1', 'transactions', transaction(9)) is False
+    assert store.delete('u1', 'transactions', ['t0', 't1', 'missing']) == 2
+
+    transactions = store.load('u1')['transactions']
+    assert [t['id'] for t in transactions] == ['t2', 't3', 't4']
+    assert transactions.get('t2')['amount'] == 20
+    assert store.rollups('u1').by_month['2024-01'][('Food', 'expense')] == (40.0, 3)
+
+
+def test_a_loaded_document_does_not_change_under_its_reader(store):
+    store.insert('u1', 'transactions', [transaction(n) for n in range(5)])
+    before = store.load('u1')
+    store.insert('u1', 'transactions', [transaction(9)])
+    store.delete('u1', 'transactions', ['t0'])
+    assert [t['id'] for t in before['transactions']] == ['t0', 't1', 't2', 't3', 't4']
+    assert [t['id'] for t in store.load('u1')['transactions']] == ['t1', 't2', 't3', 't4', 't9']
+
+
+def test_batch_applies_all_entries(store):
+    results = store.apply('u1', [
+        {'op': 'insert', 'collection': 'transactions', 'records': [transaction(1)]},
+        {'op': 'insert', 'collection': 'notifications', 'records': [{'id': 'n1'}]},
+        {'op': 'settings', 'settings': {'currency': 'EUR'}},
+    ])
+    assert results == [1, 1, True]
+    data = store.load('u1')
+    assert 't1' in data['transactions'] and 'n1' in data['notifications']
+    assert data['settings'] == {'currency': 'EUR'}
+
+
+def test_json_rollups_are_checked_against_the_file(tmp_path):
+    store = storage.JsonStorage(tmp_path, prepare, cache=DocumentCache(64 * 1024 * 1024),
+                                journal=True)
+    store.insert('u1', 'transactions', [transaction(n) for n in range(3)])
+    assert store.check_rollups('u1') == []
+
+    # The cached document picks up a transaction that never reached the file;
+    # its rollups agree with its own list, but not with what is stored
+    version, cached = store.cache.peek('u1')
+    drifted = storage.writable_copy(cached, {'transactions'})
+    drifted['transactions'].append(transaction(7, amount=5, month=2))
+    store.cache.retag('u1', version, version, 0, drifted)
+    assert store.check_rollups('u1') == [('2024-02', 'Food', 'expense', (5.0, 1), (0.0, 0))]
+
+
+def test_json_rollup_rebuild_replaces_the_cached_document(tmp_path):
+    store = storage.JsonStorage(tmp_path, prepare, cache=DocumentCache(64 * 1024 * 1024))
+    store.insert('u1', 'transactions', [transaction(n) for n in range(3)])
+    before = store.load('u1')
+    rollups = before['transactions'].rollups
+    # Simulate drift of the totals kept in memory
+    rollups.by_month['2024-01'][('Food', 'expense')] = (1.0, 1)
+
+    store.rebuild_rollups('u1')
+    after = store.load('u1')
+    assert after is not before
+    assert before['transactions'].rollups is rollups
+    assert after['transactions'].rollups.by_month['2024-01'][('Food', 'expense')] == (30.0, 3)
+    assert store.check_rollups('u1') == []